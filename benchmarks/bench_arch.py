@@ -0,0 +1,74 @@
+'''
+bench_arch.py
+Compares DpkgArchTable with CompiledDpkgArchTable: loading the dpkg tables
+(parsed, compiled, and from the cached compiled form) and evaluating 200000
+(architecture, restriction list) pairs shaped like the architecture
+restrictions of a Packages index. Needs the dpkg tables (tupletable and
+cputable), from /usr/share/dpkg unless another directory is given.
+
+    python benchmarks/bench_arch.py [dpkg table directory]
+'''
+
+import sys
+import random
+import tempfile
+from functools import partial
+
+from common import measure, report
+
+from debian._arch_table import DpkgArchTable, CompiledDpkgArchTable
+
+PAIRS = 200000
+ARCHITECTURES = ('amd64', 'arm64', 'armhf', 'i386', 'ppc64el', 's390x', 'riscv64',
+    'linux-amd64', 'kfreebsd-amd64', 'hurd-i386', 'all')
+RESTRICTIONS = ('linux-any', 'any-amd64', 'any-arm64', 'any-i386', 'amd64', 'arm64',
+    'kfreebsd-any', 'hurd-any', 'any-arm', 'i386', 's390x', 'ppc64el')
+
+
+def restriction_lists(rand, count=200):
+    '''returns distinct restriction lists, all positive or all negative'''
+    lists = []
+    for _ in range(count):
+        restrictions = rand.sample(RESTRICTIONS, rand.randint(1, 4))
+        if rand.random() < 0.3:
+            restrictions = ['!' + restriction for restriction in restrictions]
+        lists.append(restrictions)
+    return lists
+
+
+def one_by_one(table, pairs):
+    '''evaluates the pairs with architecture_is_concerned'''
+    return [table.architecture_is_concerned(architecture, restrictions) \
+        for architecture, restrictions in pairs]
+
+
+def main():
+    '''runs the benchmark'''
+    path = sys.argv[1] if len(sys.argv) > 1 else '/usr/share/dpkg'
+    rand = random.Random(42)
+    lists = restriction_lists(rand)
+    pairs = [(rand.choice(ARCHITECTURES), rand.choice(lists)) for _ in range(PAIRS)]
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        baseline = measure(partial(DpkgArchTable.load_arch_table, path), repeat=20)
+        report("DpkgArchTable.load_arch_table", baseline)
+        report("CompiledDpkgArchTable.load_arch_table, no cache", measure(partial(
+            CompiledDpkgArchTable.load_arch_table, path, use_cache=False), repeat=20), baseline)
+        CompiledDpkgArchTable.load_arch_table(path, cache_dir)
+        report("CompiledDpkgArchTable.load_arch_table, cached", measure(partial(
+            CompiledDpkgArchTable.load_arch_table, path, cache_dir), repeat=20), baseline)
+
+    table = DpkgArchTable.load_arch_table(path)
+    compiled = CompiledDpkgArchTable.load_arch_table(path, use_cache=False)
+    assert one_by_one(table, pairs) == compiled.architectures_are_concerned(pairs)
+
+    baseline = measure(partial(one_by_one, table, pairs), repeat=3)
+    report(f"DpkgArchTable.architecture_is_concerned, {PAIRS} pairs", baseline)
+    report(f"CompiledDpkgArchTable.architecture_is_concerned, {PAIRS} pairs",
+        measure(partial(one_by_one, compiled, pairs), repeat=3), baseline)
+    report(f"CompiledDpkgArchTable.architectures_are_concerned, {PAIRS} pairs",
+        measure(partial(compiled.architectures_are_concerned, pairs), repeat=3), baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+'''
+bench_imports.py
+Measures the import time of every Lambda handler in a fresh interpreter with
+python -X importtime, the way a cold start imports it. Reports the best total
+of several runs, the slowest modules by cumulative time, and the modules of
+src/ each handler loads; these are the files its deployment package needs
+(source_files of the handler in main.tf). Set PYTHONDONTWRITEBYTECODE=1 to
+include compiling the modules, as a deployment package without __pycache__ does.
+
+    python benchmarks/bench_imports.py [runs] [modules shown per handler]
+'''
+
+import os
+import sys
+import subprocess
+
+from common import SRC_DIR, report
+
+HANDLERS = ('initiate', 'list_instances', 'validate_instance_compliance')
+RUNS = 10
+TOP = 8
+
+
+def import_times(module):
+    '''imports module in a new interpreter, returns
+    ({module: (self us, cumulative us)}, [files of src/ that were loaded])'''
+    code = f"import os, sys, {module}\n" \
+        "print('\\n'.join(os.path.relpath(loaded.__file__, sys.argv[1]) \
+            for loaded in list(sys.modules.values()) \
+            if getattr(loaded, '__file__', None) and \
+            os.path.abspath(loaded.__file__).startswith(sys.argv[1] + os.sep)))"
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code,
+        os.path.abspath(SRC_DIR)],
+        cwd=SRC_DIR, env={**os.environ, 'PYTHONPATH': SRC_DIR},
+        capture_output=True, text=True, check=True)
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(own), int(cumulative))
+    return times, sorted(result.stdout.split())
+
+
+def main():
+    '''runs the benchmark'''
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else RUNS
+    top = int(sys.argv[2]) if len(sys.argv) > 2 else TOP
+    for handler in HANDLERS:
+        best, files = import_times(handler)
+        for _ in range(runs - 1):
+            times, files = import_times(handler)
+            if times[handler][1] < best[handler][1]:
+                best = times
+        report(f"import {handler}", best[handler][1] / 1e6)
+        slowest = sorted(best.items(), key=lambda item: item[1][1], reverse=True)
+        for name, (own, cumulative) in slowest[1:top + 1]:
+            print(f"    {name:<44} {cumulative / 1000:10.3f} ms  (self {own / 1000:.3f} ms)")
+        print(f"    loads from src/: {' '.join(files)}")
+
+
+if __name__ == '__main__':
+    main()
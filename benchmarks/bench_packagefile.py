@@ -0,0 +1,99 @@
+'''
+bench_packagefile.py
+Compares debian_support.PackageFile with the memory-mapped MappedPackageFile
+on a Packages index. Pass a real index (e.g. an uncompressed
+jammy-updates main binary-amd64 Packages file); without one a synthetic
+index of 60000 stanzas is generated.
+
+    python benchmarks/bench_packagefile.py [Packages file]
+'''
+
+import os
+import sys
+import random
+import tempfile
+
+from common import measure, report
+
+from debian.debian_support import PackageFile, MappedPackageFile
+
+STANZAS = 60000
+
+
+def write_synthetic_index(path, count=STANZAS):
+    '''writes a Packages index shaped like an Ubuntu archive index'''
+    rand = random.Random(42)
+    with open(path, 'w', encoding='utf8') as file:
+        for number in range(count):
+            name = f"pkg{number}-{''.join(rand.choice('abcdefgh') for _ in range(6))}"
+            version = f"{rand.randint(1, 9)}.{rand.randint(0, 40)}-{rand.randint(0, 5)}ubuntu1"
+            file.write(f"Package: {name}\n"
+                f"Architecture: amd64\n"
+                f"Version: {version}\n"
+                f"Priority: optional\n"
+                f"Section: libs\n"
+                f"Origin: Ubuntu\n"
+                f"Maintainer: Ubuntu Developers <ubuntu-devel-discuss@lists.ubuntu.com>\n"
+                f"Installed-Size: {rand.randint(10, 9000)}\n"
+                f"Depends: libc6 (>= 2.34), libgcc-s1 (>= 3.0)\n"
+                f"Filename: pool/main/p/{name}/{name}_{version}_amd64.deb\n"
+                f"Size: {rand.randint(1000, 900000)}\n"
+                f"MD5sum: {rand.getrandbits(128):032x}\n"
+                f"SHA256: {rand.getrandbits(256):064x}\n"
+                f"Description: synthetic package {number}\n"
+                f" Long description of the synthetic package,\n"
+                f" .\n"
+                f" spread over several continuation lines.\n"
+                f"\n")
+
+
+def package_versions(path):
+    '''the {Package: Version} projection with PackageFile'''
+    versions = {}
+    with open(path, 'rb') as file:
+        for record in PackageFile(path, file):
+            fields = dict(record)
+            versions[fields['Package']] = fields['Version']
+    return versions
+
+
+def main():
+    '''runs the benchmark'''
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+        temp = None
+    else:
+        temp = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        path = os.path.join(temp.name, 'Packages')
+        write_synthetic_index(path)
+
+    def mapped_records():
+        with MappedPackageFile(path) as packages:
+            return list(packages)
+
+    def mapped_versions():
+        with MappedPackageFile(path) as packages:
+            return packages.package_versions()
+
+    with open(path, 'rb') as file:
+        assert list(PackageFile(path, file)) == mapped_records()
+    assert package_versions(path) == mapped_versions()
+    print(f"{os.path.getsize(path)} bytes, {len(mapped_versions())} packages")
+
+    def records():
+        with open(path, 'rb') as file:
+            return list(PackageFile(path, file))
+
+    baseline = measure(records, repeat=3)
+    report("PackageFile records", baseline)
+    report("MappedPackageFile records", measure(mapped_records, repeat=3), baseline)
+    baseline = measure(lambda: package_versions(path), repeat=3)
+    report("PackageFile Package/Version", baseline)
+    report("MappedPackageFile.package_versions", measure(mapped_versions, repeat=3), baseline)
+
+    if temp is not None:
+        temp.cleanup()
+
+
+if __name__ == '__main__':
+    main()
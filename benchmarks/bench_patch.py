@@ -0,0 +1,87 @@
+'''
+bench_patch.py
+Compares applying chains of ed-script patches (pdiffs) one by one with
+debian_support.patch_lines against composing them with compose_patches and
+applying the result in one pass with iter_patched_lines. Every patch has
+100 hunks; the file is a synthetic Packages index of 600000 lines (about the
+size of jammy-updates main) unless another line count is given.
+
+    python benchmarks/bench_patch.py [lines]
+'''
+
+import sys
+import random
+from functools import partial
+
+from common import measure, report
+
+from debian.debian_support import (compose_patches,
+    iter_patched_lines,
+    patch_lines,
+    patches_from_ed_script)
+
+LINES = 600000
+HUNKS = 100
+CHAINS = (10, 50, 200)
+
+
+def ed_script(rand, length, hunks=HUNKS):
+    '''returns the lines of a diff -e style script for a file of length lines,
+    and the length of the patched file'''
+    script = []
+    positions = sorted(rand.sample(range(1, length, 3), hunks), reverse=True)
+    for position in positions:
+        if (command := rand.choice('acd')) == 'd':
+            script.append(f"{position}d\n")
+            length -= 1
+            continue
+        new_lines = [f"Version: {rand.randint(0, 99)}.{rand.randint(0, 9)}\n" \
+            for _ in range(rand.randint(1, 3))]
+        if command == 'c':
+            script.append(f"{position},{position + 1}c\n")
+            length -= 2
+        else:
+            script.append(f"{position}a\n")
+        script.extend(new_lines)
+        script.append(".\n")
+        length += len(new_lines)
+    return script, length
+
+
+def sequential(base, scripts):
+    '''applies the patches one by one'''
+    lines = list(base)
+    for script in scripts:
+        patch_lines(lines, patches_from_ed_script(script))
+    return lines
+
+
+def composed(base, scripts):
+    '''composes the patches and applies them in one pass'''
+    edits = compose_patches([patches_from_ed_script(script) for script in scripts], len(base))
+    return list(iter_patched_lines(base, edits))
+
+
+def main():
+    '''runs the benchmark'''
+    rand = random.Random(42)
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else LINES
+    base = [f"Package: pkg{i // 3}\n" if i % 3 == 0 else f"Version: 1.{i}\n" \
+        for i in range(size)]
+
+    scripts = []
+    length = len(base)
+    for _ in range(max(CHAINS)):
+        script, length = ed_script(rand, length)
+        scripts.append(script)
+
+    for chain in CHAINS:
+        assert sequential(base, scripts[:chain]) == composed(base, scripts[:chain])
+        baseline = measure(partial(sequential, base, scripts[:chain]), repeat=3)
+        report(f"patch_lines, {chain} patches", baseline)
+        report(f"compose_patches + iter_patched_lines, {chain} patches",
+            measure(partial(composed, base, scripts[:chain]), repeat=3), baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+'''
+bench_serialization.py
+Compares json.dumps of every per-instance SQS message with PayloadTemplate,
+which encodes the baselines and account fields once per platform.
+
+    python benchmarks/bench_serialization.py [instances] [packages]
+'''
+
+import sys
+import json
+import random
+
+from common import measure, report
+
+from utils.serialization import PayloadTemplate
+
+
+def synthetic_messages(instances, packages):
+    '''returns (shared fields, per-instance fields) shaped like list_instances messages'''
+    rand = random.Random(42)
+    baseline = {f"package-{i}": f"{rand.randint(0, 9)}.{rand.randint(0, 99)}-{i}ubuntu0.22.04.1" \
+        for i in range(packages)}
+    shared = {
+        'ScanTime': '2024-01-01 00:00:00',
+        'Baselines': {'n-1': {'ComplaintPackages': baseline, 'BaselineId': 'c159bb58910eb176'}},
+        'ScanType': 'n-1',
+        'Region': 'us-east-1',
+        'AccountId': '123456789012',
+        'AccountName': 'workload'
+    }
+    fleet = [{
+        'InstanceId': f"i-{i:017x}",
+        'PlatformName': 'Ubuntu',
+        'PlatformVersion': '22.04',
+        'Name': f"host-{i}"
+    } for i in range(instances)]
+    return shared, fleet
+
+
+def main():
+    '''runs the benchmark'''
+    instances = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    packages = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    shared, fleet = synthetic_messages(instances, packages)
+
+    def full_dump():
+        for instance in fleet:
+            json.dumps(dict(instance, **shared), default=str)
+
+    def template_render():
+        template = PayloadTemplate(shared)
+        for instance in fleet:
+            template.render(instance)
+
+    assert PayloadTemplate(shared).render(fleet[0]) == \
+        json.dumps(dict(fleet[0], **shared), default=str)
+
+    print(f"{instances} messages, {packages} packages per baseline")
+    baseline = measure(full_dump, repeat=3)
+    report("json.dumps per message", baseline)
+    report("PayloadTemplate.render", measure(template_render, repeat=3), baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+'''
+bench_wire.py
+Compares the size and parse time of package maps as plain JSON and in the
+compact utils.wire encoding. A dpkg status file or "name version" list can be
+given to use real package names instead of synthetic ones.
+
+    python benchmarks/bench_wire.py [status or manifest file]
+'''
+
+import sys
+import json
+import random
+
+from common import measure, report
+
+from utils.wire import encode_packages, decode_packages, _decode_map, _decode_text
+
+# messages per validate_instance_compliance invocation (SQS batch size)
+BATCH_SIZE = 50
+
+PREFIXES = ('lib', 'libx', 'libgl', 'libpython3', 'python3-', 'linux-', 'gir1.2-', 'fonts-')
+
+
+def synthetic_packages(count=2000):
+    '''returns a {name: version} map shaped like an Ubuntu server inventory'''
+    rand = random.Random(42)
+    packages = {}
+    while len(packages) < count:
+        name = rand.choice(PREFIXES) + ''.join(rand.choice('abcdefgh') for _ in range(6))
+        packages[name] = f"{rand.randint(1, 9)}.{rand.randint(0, 40)}.{rand.randint(0, 9)}" \
+            f"-{rand.randint(0, 5)}ubuntu{rand.randint(0, 3)}.22.04.{rand.randint(1, 3)}"
+    return packages
+
+
+def read_packages(path):
+    '''reads Package/Version pairs of a dpkg status file or "name version" lines'''
+    packages = {}
+    name = None
+    with open(path, 'r', encoding='utf8') as file:
+        for line in file:
+            if line.startswith('Package:'):
+                name = line.split(':', 1)[1].strip()
+            elif line.startswith('Version:') and name:
+                packages[name] = line.split(':', 1)[1].strip()
+            elif len(fields := line.split()) == 2 and not line.endswith(':'):
+                packages[fields[0]] = fields[1]
+    return packages
+
+
+def main():
+    '''runs the benchmark'''
+    packages = read_packages(sys.argv[1]) if len(sys.argv) > 1 else synthetic_packages()
+    plain = json.dumps(packages)
+    encoded = encode_packages(packages)
+    compact = json.dumps(encode_packages(packages, compress=False), separators=(',', ':'))
+    assert decode_packages(encoded) == packages
+
+    print(f"{len(packages)} packages")
+    print(f"plain JSON          {len(plain):8} bytes")
+    print(f"encoded             {len(compact):8} bytes  ({len(plain) / len(compact):4.1f}x)")
+    print(f"encoded + zlib      {len(encoded):8} bytes  ({len(plain) / len(encoded):4.1f}x)")
+
+    def parse_batch(bodies, decode):
+        # one validate_instance_compliance batch, all messages carry the same baseline
+        _decode_map.cache_clear()
+        _decode_text.cache_clear()
+        for body in bodies:
+            decode(json.loads(body)['Baselines']['n-1']['ComplaintPackages'])
+
+    plain_bodies = [json.dumps({'InstanceId': f"i-{i}", 'Baselines': \
+        {'n-1': {'ComplaintPackages': packages}}}) for i in range(BATCH_SIZE)]
+    encoded_bodies = [json.dumps({'InstanceId': f"i-{i}", 'Baselines': \
+        {'n-1': {'ComplaintPackages': encoded}}}) for i in range(BATCH_SIZE)]
+
+    baseline = measure(lambda: parse_batch(plain_bodies, lambda packages: packages))
+    report(f"parse {BATCH_SIZE} plain messages", baseline)
+    report(f"parse {BATCH_SIZE} encoded messages",
+        measure(lambda: parse_batch(encoded_bodies, decode_packages)), baseline)
+    report("encode_packages", measure(lambda: encode_packages(packages), number=5))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+'''
+common.py
+Helpers shared by the benchmark scripts. Benchmarks import the lambda code
+from src/, the same way the lambda runtime does
+'''
+
+import os
+import sys
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+
+def measure(func, repeat=5, number=1):
+    '''returns the best wall time in seconds of number calls to func'''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = (time.perf_counter() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def report(name, seconds, baseline=None):
+    '''prints one benchmark result, with the speedup against baseline seconds'''
+    line = f"{name:<48} {seconds * 1000:10.3f} ms"
+    if baseline:
+        line += f"  ({baseline / seconds:5.1f}x)"
+    print(line)
@@ -0,0 +1,312 @@
+'''
+fake_aws.py
+In-process stand-in for the EC2, SSM, STS, SQS and EventBridge operations the
+lambda functions use, for load tests without an AWS estate. Install it with
+helpers.set_client_factory(FakeAws(...).client). Every call is counted per
+operation, and can be slowed down (latency), throttled (ThrottlingException at
+throttle_rate, for the services of throttled_services) and paginated
+(page_size) like the real APIs
+'''
+
+# the keyword arguments of the fakes are the boto3 parameter names
+# pylint: disable=invalid-name
+
+import time
+import random
+import fnmatch
+import threading
+from collections import Counter, deque
+from datetime import datetime, timedelta
+
+DEFAULT_ACCOUNT = '000000000000'
+DEFAULT_REGION = 'us-east-1'
+
+
+class ClientError(Exception):
+    '''error raised by the fakes, shaped like botocore ClientError'''
+
+    def __init__(self, code, operation):
+        super().__init__(f"An error occurred ({code}) when calling the {operation} operation")
+        self.response = {'Error': {'Code': code, 'Message': str(self)}}
+        self.operation_name = operation
+
+
+class Exceptions:
+    '''client.exceptions of the fakes'''
+    ClientError = ClientError
+
+
+class MemoryStore:
+    '''state store kept in memory, with the interface of utils.store'''
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        '''returns the value stored for key or None when missing or expired'''
+        if (item := self.items.get(key)) is None:
+            return None
+        value, expires_at = item
+        if expires_at is not None and expires_at < time.time():
+            return None
+        return value
+
+    def put(self, key, value, ttl=None):
+        '''stores value for key, expiring after ttl seconds if given'''
+        self.items[key] = (value, time.time() + ttl if ttl else None)
+
+    def put_if_absent(self, key, value, ttl=None):
+        '''stores value for key unless an unexpired value is stored.
+        Returns True when value was stored'''
+        with self.lock:
+            if self.get(key) is not None:
+                return False
+            self.put(key, value, ttl)
+            return True
+
+    def delete(self, key):
+        '''removes key from the store'''
+        self.items.pop(key, None)
+
+
+class FakeAws: # pylint: disable=too-many-instance-attributes
+    '''AWS estate: images, instances per (account, region) with their inventory,
+    queues and published events'''
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, page_size=50, seed=0,
+            throttled_services=('ec2', 'ssm', 'sts')):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.throttled_services = throttled_services
+        self.page_size = page_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+
+        # [{'ImageId', 'Name', 'OwnerId', 'CreationDate', 'Inventory'}]
+        self.images = []
+        # {(account, region): [{'InstanceId', 'PlatformName', 'PlatformVersion',
+        # 'PlatformType', 'Name', 'Inventory'}]}
+        self.instances = {}
+        self.instance_index = {}
+        # {queue url: deque of (message id, body)}
+        self.queues = {}
+        # {detail type: [event entries]}, findings are only counted
+        self.events = {}
+        self.event_counts = Counter()
+        self.event_bytes = Counter()
+        self.next_id = 0
+
+    def client(self, service, region_name=None, account_id=None):
+        '''client factory for helpers.set_client_factory'''
+        scope = (account_id or DEFAULT_ACCOUNT, region_name or DEFAULT_REGION)
+        return SERVICES[service](self, scope)
+
+    def add_image(self, image):
+        '''registers an AMI'''
+        self.images.append(image)
+
+    def add_instance(self, account_id, region, instance):
+        '''registers an instance online in SSM'''
+        self.instances.setdefault((account_id, region), []).append(instance)
+        self.instance_index[instance['InstanceId']] = instance
+
+    def call(self, service, operation):
+        '''counts a call, applies the latency and throttles it'''
+        with self.lock:
+            self.calls[f"{service}:{operation}"] += 1
+            throttled = service in self.throttled_services and \
+                self.random.random() < self.throttle_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            with self.lock:
+                self.calls[f"{service}:{operation}:throttled"] += 1
+            raise ClientError('ThrottlingException', operation)
+
+    def new_id(self, prefix):
+        '''returns a new resource id'''
+        with self.lock:
+            self.next_id += 1
+            # above the ids of fleet.py
+            return f"{prefix}-{(1 << 64) + self.next_id:017x}"
+
+    def page(self, items, token, max_results=None):
+        '''returns (items of the page at token, next token or None)'''
+        start = int(token or 0)
+        end = start + min(self.page_size, max_results or self.page_size)
+        return items[start:end], (str(end) if end < len(items) else None)
+
+
+class FakeClient:
+    '''client bound to an account and region'''
+
+    service = None
+    exceptions = Exceptions
+
+    def __init__(self, aws, scope):
+        self.aws = aws
+        self.account_id, self.region = scope
+
+    def call(self, operation):
+        '''counts the call of operation'''
+        self.aws.call(self.service, operation)
+
+
+class FakeEc2(FakeClient):
+    '''describe_images, run_instances and terminate_instances'''
+
+    service = 'ec2'
+
+    def describe_images(self, Filters):
+        '''returns the images matching the name and owner-id filters'''
+        self.call('DescribeImages')
+        filters = {item['Name']: item['Values'] for item in Filters}
+        images = [image for image in self.aws.images \
+            if any(fnmatch.fnmatch(image['Name'], name) for name in filters.get('name', ['*'])) \
+            and image['OwnerId'] in filters.get('owner-id', [image['OwnerId']])]
+        return {'Images': [{key: value for key, value in image.items() if key != 'Inventory'} \
+            for image in images]}
+
+    def describe_regions(self):
+        '''returns the regions with instances and the region of the client'''
+        self.call('DescribeRegions')
+        regions = {region for _, region in self.aws.instances} | {self.region}
+        return {'Regions': [{'RegionName': region} for region in sorted(regions)]}
+
+    def run_instances(self, ImageId, **kwargs):
+        '''starts a compliant server, online with its inventory gathered right away'''
+        del kwargs
+        self.call('RunInstances')
+        image = next(image for image in self.aws.images if image['ImageId'] == ImageId)
+        instance = {
+            'InstanceId': self.aws.new_id('i'),
+            'PlatformName': image['PlatformName'],
+            'PlatformVersion': image['PlatformVersion'],
+            'PlatformType': 'Linux',
+            'Name': image['Name'],
+            'Inventory': image['Inventory']
+        }
+        self.aws.add_instance(self.account_id, self.region, instance)
+        return {'Instances': [{'InstanceId': instance['InstanceId']}]}
+
+    def terminate_instances(self, InstanceIds):
+        '''removes the instances'''
+        self.call('TerminateInstances')
+        for instance_id in InstanceIds:
+            if (instance := self.aws.instance_index.pop(instance_id, None)) is not None:
+                self.aws.instances[(self.account_id, self.region)].remove(instance)
+
+
+class FakeSsm(FakeClient):
+    '''describe_instance_information, describe_instance_associations_status
+    and list_inventory_entries'''
+
+    service = 'ssm'
+
+    def describe_instance_information(self, Filters=None, NextToken=None, MaxResults=None):
+        '''returns a page of the online instances of the account and region'''
+        self.call('DescribeInstanceInformation')
+        filters = {item['Key']: item['Values'] for item in Filters or []}
+        instances = self.aws.instances.get((self.account_id, self.region), [])
+        if 'InstanceIds' in filters:
+            instances = [instance for instance in instances \
+                if instance['InstanceId'] in filters['InstanceIds']]
+        if 'PlatformTypes' in filters:
+            instances = [instance for instance in instances \
+                if instance['PlatformType'] in filters['PlatformTypes']]
+        page, token = self.aws.page(instances, NextToken, MaxResults)
+        response = {'InstanceInformationList': [{
+            'InstanceId': instance['InstanceId'],
+            'PingStatus': 'Online',
+            'PlatformType': instance['PlatformType'],
+            'PlatformName': instance['PlatformName'],
+            'PlatformVersion': instance['PlatformVersion'],
+            'Name': instance['Name']
+        } for instance in page]}
+        if token:
+            response['NextToken'] = token
+        return response
+
+    def describe_instance_associations_status(self, InstanceId):
+        '''the inventory association of every instance succeeded'''
+        del InstanceId
+        self.call('DescribeInstanceAssociationsStatus')
+        return {'InstanceAssociationStatusInfos': [
+            {'Name': 'AWS-GatherSoftwareInventory', 'Status': 'Success'}]}
+
+    def list_inventory_entries(self, InstanceId, TypeName, NextToken=None):
+        '''returns a page of the AWS:Application inventory of the instance'''
+        self.call('ListInventoryEntries')
+        entries = self.aws.instance_index[InstanceId]['Inventory']
+        page, token = self.aws.page(entries, NextToken)
+        response = {
+            'TypeName': TypeName,
+            'InstanceId': InstanceId,
+            'SchemaVersion': '1.1',
+            'CaptureTime': (datetime.now() - timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'Entries': list(page)
+        }
+        if token:
+            response['NextToken'] = token
+        return response
+
+
+class FakeSts(FakeClient):
+    '''get_caller_identity and assume_role'''
+
+    service = 'sts'
+
+    def get_caller_identity(self):
+        '''returns the account of the client'''
+        self.call('GetCallerIdentity')
+        return {'Account': self.account_id}
+
+    def assume_role(self, RoleArn, RoleSessionName):
+        '''returns dummy credentials'''
+        del RoleArn, RoleSessionName
+        self.call('AssumeRole')
+        return {'Credentials': {'AccessKeyId': 'AKIA', 'SecretAccessKey': 'secret',
+            'SessionToken': 'token'}}
+
+
+class FakeSqs(FakeClient):
+    '''send_message, delays are ignored'''
+
+    service = 'sqs'
+
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds=0):
+        '''queues the message'''
+        del DelaySeconds
+        self.call('SendMessage')
+        message_id = self.aws.new_id('m')
+        with self.aws.lock:
+            self.aws.queues.setdefault(QueueUrl, deque()).append((message_id, MessageBody))
+        return {'MessageId': message_id}
+
+
+class FakeEvents(FakeClient):
+    '''put_events. findings are counted, other events kept for delivery'''
+
+    service = 'events'
+
+    def put_events(self, Entries):
+        '''records the events'''
+        self.call('PutEvents')
+        with self.aws.lock:
+            for entry in Entries:
+                self.aws.event_counts[entry['DetailType']] += 1
+                self.aws.event_bytes[entry['DetailType']] += len(entry['Detail'])
+                if entry['DetailType'] != 'findings':
+                    self.aws.events.setdefault(entry['DetailType'], []).append(entry)
+        return {'FailedEntryCount': 0, 'Entries': [{'EventId': 'e'} for _ in Entries]}
+
+
+SERVICES = {
+    'ec2': FakeEc2,
+    'ssm': FakeSsm,
+    'sts': FakeSts,
+    'sqs': FakeSqs,
+    'events': FakeEvents
+}
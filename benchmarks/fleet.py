@@ -0,0 +1,173 @@
+'''
+fleet.py
+Synthetic fleets for load tests: N instances spread over accounts and regions,
+running the platforms initiate builds baselines for, with dpkg (Ubuntu) and
+rpm (Amazon Linux) inventories. Every platform has a package catalog with a
+few releases per package; AMIs ship the latest releases (older AMIs lag
+behind) and instances are drawn from a pool of inventory profiles that miss
+some updates and carry packages no baseline knows about
+'''
+
+import random
+from datetime import datetime, timedelta
+
+# (platform name, platform version, AMI name pattern as in initiate, owner, package format)
+PLATFORMS = (
+    ('Ubuntu', '22.04', 'ubuntu/images/hvm-ssd/ubuntu-jammy-22.04-amd64-server-{}',
+        '099720109477', 'dpkg'),
+    ('Ubuntu', '20.04', 'ubuntu/images/hvm-ssd/ubuntu-focal-20.04-amd64-server-{}',
+        '099720109477', 'dpkg'),
+    ('Ubuntu', '18.04', 'ubuntu/images/hvm-ssd/ubuntu-bionic-18.04-amd64-server-{}',
+        '099720109477', 'dpkg'),
+    ('Amazon Linux AMI', '2018.03', 'amzn-ami-hvm-2018.03.0.{}-x86_64-gp2',
+        '137112412989', 'rpm'),
+    ('Amazon Linux', '2', 'amzn2-ami-hvm-2.0.{}-x86_64-gp2', '137112412989', 'rpm'),
+)
+# share of the fleet per platform, in the order of PLATFORMS
+PLATFORM_WEIGHTS = (40, 25, 10, 5, 20)
+
+# AMIs per platform, created AMI_INTERVAL_DAYS apart
+AMIS = 4
+AMI_INTERVAL_DAYS = 21
+PACKAGES = 600
+RELEASES = 4
+PROFILES = 64
+
+NAMES = ('accountsservice', 'apparmor', 'apt', 'base-files', 'bash', 'bind9-host', 'bsdutils',
+    'ca-certificates', 'cloud-init', 'coreutils', 'cron', 'curl', 'dbus', 'dpkg', 'e2fsprogs',
+    'gnupg', 'grub-common', 'gzip', 'iproute2', 'kmod', 'less', 'libc-bin', 'libssl3', 'libudev1',
+    'linux-base', 'login', 'logrotate', 'lsb-release', 'nano', 'netplan.io', 'openssh-client',
+    'openssh-server', 'openssl', 'passwd', 'perl-base', 'procps', 'python3', 'rsyslog', 'sed',
+    'snapd', 'sudo', 'systemd', 'tar', 'tzdata', 'ubuntu-keyring', 'util-linux', 'vim', 'wget',
+    'xz-utils', 'zlib1g')
+STEMS = ('gtk', 'xml', 'ssl', 'curl', 'python', 'perl', 'glib', 'krb5', 'ldap', 'nss', 'pam',
+    'sqlite', 'icu', 'gnutls', 'x11', 'cairo', 'pango', 'boost', 'mysql', 'pq')
+
+
+def dpkg_releases(rand, count):
+    '''returns count Debian versions of a package, oldest first. Mixes epochs,
+    tildes, +dfsg and long ubuntu revisions'''
+    major, minor, patch = rand.randint(0, 9), rand.randint(0, 40), rand.randint(0, 20)
+    epoch = rand.choice(('', '', '', '1:', '2:'))
+    suffix = rand.choice(('', '', '+dfsg', '~rc1', '+really2.4'))
+    debian = rand.randint(1, 9)
+    style = rand.choice(('ubuntu', 'build', 'security'))
+    releases = []
+    for release in range(count):
+        if style == 'ubuntu':
+            revision = f"{debian}ubuntu{release + 1}"
+        elif style == 'build':
+            revision = f"{debian}build{release + 1}"
+        else:
+            revision = f"0ubuntu0.22.04.{release + 1}"
+        releases.append(f"{epoch}{major}.{minor}.{patch + release // 2}{suffix}-{revision}")
+    return releases
+
+
+def rpm_releases(rand, count):
+    '''returns count RPM versions of a package, oldest first, as the SSM
+    inventory reports them (without release)'''
+    parts = [rand.randint(0, 9), rand.randint(0, 30), rand.randint(0, 20)]
+    letter = rand.choice(('', '', 'g', 'k'))
+    releases = []
+    for release in range(count):
+        releases.append('.'.join(str(part) for part in parts[:-1]) + \
+            f".{parts[-1] + release}{letter}")
+    return releases
+
+
+def package_names(rand, count):
+    '''returns count package names'''
+    names = list(NAMES)
+    while len(names) < count:
+        names.append(f"lib{rand.choice(STEMS)}{rand.randint(1, 9)}-{len(names)}")
+    return names[:count]
+
+
+def catalog(rand, package_format, count=PACKAGES, releases=RELEASES):
+    '''returns {package: [releases, oldest first]} of a platform'''
+    make_releases = dpkg_releases if package_format == 'dpkg' else rpm_releases
+    return {name: make_releases(rand, releases) for name in package_names(rand, count)}
+
+
+def entry(name, version, package_format):
+    '''returns an AWS:Application inventory entry'''
+    return {
+        'Name': name,
+        'Version': version,
+        'Architecture': 'amd64' if package_format == 'dpkg' else 'x86_64',
+        'PackageId': f"{name}_{version}" if package_format == 'dpkg' else f"{name}-{version}",
+        'Publisher': 'Ubuntu Developers' if package_format == 'dpkg' else 'Amazon Linux'
+    }
+
+
+def ami_inventory(packages, age, package_format):
+    '''returns the inventory of the AMI age releases behind the latest one'''
+    return [entry(name, releases[max(0, len(releases) - 1 - age)], package_format) \
+        for name, releases in packages.items()]
+
+
+def instance_profile(rand, packages, package_format):
+    '''returns the inventory of an instance: most packages of the catalog, some
+    updates missing, and packages of its own'''
+    entries = []
+    for name, releases in packages.items():
+        if rand.random() < 0.1:
+            continue
+        # mostly up to date, with a tail of outdated packages
+        lag = min(len(releases) - 1, int(rand.expovariate(2.5)))
+        entries.append(entry(name, releases[len(releases) - 1 - lag], package_format))
+    for index in range(rand.randint(5, 40)):
+        entries.append(entry(f"local-tool{index}", f"1.{rand.randint(0, 9)}", package_format))
+    return entries
+
+
+class Fleet:
+    '''AMIs and instances of a synthetic estate'''
+
+    def __init__(self, instances, accounts, regions, seed=42):
+        self.accounts = [{'Id': f"{100000000000 + index}", 'Name': f"account-{index}"} \
+            for index in range(accounts)]
+        self.regions = list(regions)
+        self.size = instances
+        self.seed = seed
+
+    def load(self, aws):
+        '''registers the AMIs and instances of the fleet in a FakeAws'''
+        rand = random.Random(self.seed)
+        today = datetime.now()
+        profiles = []
+        for name, version, pattern, owner, package_format in PLATFORMS:
+            packages = catalog(rand, package_format)
+            for age in range(AMIS):
+                created = today - timedelta(days=age * AMI_INTERVAL_DAYS + 1)
+                aws.add_image({
+                    'ImageId': f"ami-{rand.getrandbits(64):017x}",
+                    'Name': pattern.format(created.strftime('%Y%m%d')),
+                    'OwnerId': owner,
+                    'CreationDate': created.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                    'PlatformName': name,
+                    'PlatformVersion': version,
+                    'Inventory': ami_inventory(packages, age, package_format)
+                })
+            profiles.append([instance_profile(rand, packages, package_format) \
+                for _ in range(PROFILES)])
+
+        scopes = [(account['Id'], region) for account in self.accounts for region in self.regions]
+        for index in range(self.size):
+            platform = rand.choices(range(len(PLATFORMS)), PLATFORM_WEIGHTS)[0]
+            name, version = PLATFORMS[platform][:2]
+            account_id, region = scopes[index % len(scopes)]
+            aws.add_instance(account_id, region, {
+                'InstanceId': f"i-{index:017x}",
+                'PlatformName': name,
+                'PlatformVersion': version,
+                'PlatformType': 'Linux',
+                'Name': f"server-{index}",
+                # instances share the inventory lists of their profile
+                'Inventory': rand.choice(profiles[platform])
+            })
+
+    def accounts_file(self):
+        '''returns the accounts.json document initiate reads'''
+        return {'account_detail': self.accounts}
@@ -0,0 +1,191 @@
+'''
+load_test.py
+Drives the real lambda handlers end to end (initiate -> list_instances ->
+validate_instance_compliance) against fake_aws with a synthetic fleet of each
+given size. listInstances events are delivered to list_instances and the
+instances queue is drained in batches of SQS_BATCH records (the event source
+mapping of main.tf), returning failed records to the queue up to
+MAX_RECEIVES times. Reports wall time, API calls and memory per stage, and
+the number of findings, which is below the number of instances when some
+were lost.
+
+    python benchmarks/load_test.py [instances ...] [--latency S] [--throttle-rate R]
+        [--page-size N] [--instances-per-account N] [--tracemalloc]
+'''
+
+import os
+import json
+import time
+import logging
+import argparse
+import resource
+import tempfile
+import tracemalloc
+from collections import Counter, deque
+
+import common # pylint: disable=unused-import
+
+from fake_aws import FakeAws, MemoryStore
+from fleet import Fleet
+
+# configuration is read when the handlers are imported
+QUEUE_URL = 'https://sqs.fake/000000000000/patch_inspect_instances'
+os.environ.update({
+    'QUEUE_URL': QUEUE_URL,
+    'CONTINUATION_QUEUE_URL': '',
+    'PATCH_INSPECT_TABLE_NAME': '',
+    'BUILD_POLL_SECONDS': '0',
+    'METRICS_ENABLED': 'false',
+    'AWS_REGION': 'us-east-1'
+})
+
+# pylint: disable=wrong-import-position
+import initiate
+import list_instances
+import validate_instance_compliance
+from utils import baseline_builder
+from utils.config import REGION_USED
+from utils.helpers import set_client_factory
+from utils.store import set_store
+# pylint: enable=wrong-import-position
+
+SIZES = (1000, 10000, 100000)
+SQS_BATCH = 50
+MAX_RECEIVES = 3
+SCAN_TYPES = ['n-1', 'n-0']
+
+
+class Stage:
+    '''wall time and API calls of a stage of the load test'''
+
+    def __init__(self, name, aws):
+        self.name = name
+        self.aws = aws
+        self.seconds = 0.0
+        self.calls = Counter()
+        self.invocations = 0
+        self.calls_before = Counter()
+        self.start = 0.0
+
+    def __enter__(self):
+        self.calls_before = Counter(self.aws.calls)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds += time.perf_counter() - self.start
+        self.calls.update(Counter(self.aws.calls) - self.calls_before)
+
+
+def drain(aws, stage, dead_letters):
+    '''delivers the queued instance messages to validate_instance_compliance'''
+    queue = aws.queues.get(QUEUE_URL, deque())
+    receives = Counter()
+    while queue:
+        records = []
+        while queue and len(records) < SQS_BATCH:
+            message_id, body = queue.popleft()
+            receives[message_id] += 1
+            records.append({'messageId': message_id, 'body': body})
+        with stage:
+            response = validate_instance_compliance.lambda_handler({'Records': records}, None)
+        stage.invocations += 1
+        failed = {failure['itemIdentifier'] for failure in response['batchItemFailures']}
+        for record in records:
+            if record['messageId'] not in failed:
+                continue
+            if receives[record['messageId']] < MAX_RECEIVES:
+                queue.append((record['messageId'], record['body']))
+            else:
+                dead_letters.append(record['messageId'])
+
+
+def run(size, args):
+    '''runs the handlers over a fleet of size instances, returns the stages'''
+    aws = FakeAws(latency=args.latency, throttle_rate=args.throttle_rate,
+        page_size=args.page_size)
+    fleet = Fleet(size, max(1, -(-size // args.instances_per_account)), REGION_USED)
+    fleet.load(aws)
+    # initiate reads the accounts from its working directory
+    with open('accounts.json', 'w', encoding='utf8') as file:
+        json.dump(fleet.accounts_file(), file)
+    set_client_factory(aws.client)
+    set_store(MemoryStore())
+
+    stages = [Stage(name, aws) for name in ('initiate', 'list_instances',
+        'validate_instance_compliance')]
+    dead_letters = []
+    with stages[0]:
+        initiate.lambda_handler({'SCAN_TYPES': SCAN_TYPES}, None)
+    stages[0].invocations += 1
+    # validation runs while later accounts are listed, as with the event source mapping.
+    # list_instances publishes again the regions it could not finish
+    while events := aws.events.get('listInstances'):
+        event = events.pop(0)
+        with stages[1]:
+            list_instances.lambda_handler({'detail': json.loads(event['Detail'])}, None)
+        stages[1].invocations += 1
+        drain(aws, stages[2], dead_letters)
+
+    findings = aws.event_counts['findings']
+    print(f"{size} instances, {len(fleet.accounts)} accounts x {len(fleet.regions)} regions: \
+{findings} findings ({aws.event_bytes['findings'] / max(findings, 1):.0f} bytes each), \
+{len(dead_letters)} dead letters")
+    return stages
+
+
+def report(stages):
+    '''prints wall time and API calls per stage'''
+    for stage in stages:
+        total = sum(count for call, count in stage.calls.items() if not call.endswith('throttled'))
+        print(f"    {stage.name:<30} {stage.seconds:9.3f} s  {stage.invocations:6} invocations \
+{total:8} API calls")
+        for call, count in sorted(stage.calls.items()):
+            print(f"        {call:<50} {count:8}")
+
+
+def main():
+    '''runs the load test'''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', maxsplit=1)[0])
+    parser.add_argument('sizes', nargs='*', type=int, default=SIZES)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per API call')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+        help='share of API calls failing with ThrottlingException')
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--instances-per-account', type=int, default=2500)
+    parser.add_argument('--tracemalloc', action='store_true',
+        help='report the peak of Python allocations (slower)')
+    parser.add_argument('--verbose', action='store_true', help='keep the handler logs')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.disable(logging.INFO)
+    # the regions are listed one after the other without waiting
+    list_instances.REGION_STAGGER_SECONDS = 0
+    # the compliant servers of fake_aws are online as soon as they are launched
+    baseline_builder.BOOT_SECONDS = 0
+
+    cwd = os.getcwd()
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as workdir:
+            os.chdir(workdir)
+            try:
+                if args.tracemalloc:
+                    tracemalloc.start()
+                stages = run(size, args)
+            finally:
+                os.chdir(cwd)
+        # fleet generation is not part of the handler time
+        elapsed = sum(stage.seconds for stage in stages)
+        print(f"    {'total':<30} {elapsed:9.3f} s  {size / elapsed:9.0f} instances/s")
+        report(stages)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        line = f"    peak RSS {rss:.0f} MB"
+        if args.tracemalloc:
+            line += f", peak Python allocations {tracemalloc.get_traced_memory()[1] / 2**20:.0f} MB"
+            tracemalloc.stop()
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+'''
+replay.py
+Replays traces captured with TRACE_DIR (utils/trace.py): every invocation is
+run again with its event against the recorded responses, in the order the
+invocations were captured. Calls are matched on service, account, region,
+method and parameters, then on the order of the calls of the same method
+when the parameters changed (timestamps, ids of a new run). The last
+response of a call is repeated when the handler calls it more often than
+during the capture (polling). Responses are delayed by their recorded
+latency times --latency-scale, 0 replays without waiting.
+
+The state store starts empty: capture with an empty state table (or
+INVENTORY_CACHE_MAX_AGE=0) so that every inventory was fetched from SSM.
+initiate reads accounts.json from the working directory, replay its traces
+where the accounts.json of the capture is.
+
+    python benchmarks/replay.py TRACE_OR_DIR [...] [--latency-scale 1.0]
+        [--repeat N] [--verbose]
+'''
+
+import os
+import sys
+import copy
+import json
+import time
+import logging
+import argparse
+import threading
+from collections import Counter, defaultdict, deque
+
+import common # pylint: disable=unused-import
+
+from fake_aws import MemoryStore
+
+# configuration is read when the handlers are imported
+os.environ.update({
+    'CONTINUATION_QUEUE_URL': '',
+    'PATCH_INSPECT_TABLE_NAME': '',
+    'BUILD_POLL_SECONDS': '0',
+    'METRICS_ENABLED': 'false',
+    'TRACE_DIR': '',
+    'AWS_REGION': os.environ.get('AWS_REGION', 'us-east-1')
+})
+
+# pylint: disable=wrong-import-position,wrong-import-order
+from botocore.exceptions import ClientError
+
+import initiate
+import list_instances
+import validate_instance_compliance
+from utils import baseline_builder
+from utils.helpers import set_client_factory
+from utils.store import set_store
+from utils.trace import encode, read_trace, redact
+# pylint: enable=wrong-import-position,wrong-import-order
+
+HANDLERS = {module.__name__: module for module in (initiate, list_instances,
+    validate_instance_compliance)}
+
+
+def canonical(params):
+    '''returns the parameters as they are compared with the recorded ones'''
+    return json.dumps(json.loads(encode(redact(params))), sort_keys=True)
+
+
+class ReplayAws:
+    '''recorded responses of one invocation, served in the order of the capture'''
+
+    def __init__(self, calls, latency_scale=1.0):
+        self.latency_scale = latency_scale
+        self.lock = threading.Lock()
+        self.recorded = calls
+        # indexes of the recorded calls per parameters and per method
+        self.exact = defaultdict(deque)
+        self.ordered = defaultdict(deque)
+        self.used = set()
+        self.last = {}
+        for index, call in enumerate(calls):
+            scope = (call['Service'], call['AccountId'], call['Region'], call['Method'])
+            self.exact[scope + (canonical(call['Params']),)].append(index)
+            self.ordered[scope].append(index)
+        self.calls = Counter()
+        self.misses = Counter()
+        self.recorded_latency = sum(call['Latency'] for call in calls)
+
+    def client(self, service, region_name=None, account_id=None):
+        '''client factory for helpers.set_client_factory'''
+        return ReplayClient(self, service, region_name, account_id)
+
+    def take(self, scope, params):
+        '''returns the recorded call answering a call, None when there is none'''
+        key = scope + (canonical(params),)
+        with self.lock:
+            self.calls[scope[-1]] += 1
+            if (call := self.next_call(self.exact.get(key))) is None:
+                call = self.last.get(key) or self.next_call(self.ordered.get(scope)) or \
+                    self.last.get(scope)
+            if call is None:
+                self.misses[scope[-1]] += 1
+            else:
+                self.last[key] = self.last[scope] = call
+            return call
+
+    def next_call(self, queue):
+        '''returns the first recorded call of queue not used yet'''
+        while queue:
+            if (index := queue.popleft()) not in self.used:
+                self.used.add(index)
+                return self.recorded[index]
+        return None
+
+    def call(self, scope, params):
+        '''returns the recorded response of a call, or raises its recorded error'''
+        if (call := self.take(scope, params)) is None:
+            raise ClientError({'Error': {'Code': 'ReplayMissing',
+                'Message': 'no recorded response'}}, scope[-1])
+        if self.latency_scale:
+            time.sleep(call['Latency'] * self.latency_scale)
+        if (call['Status'] or 200) >= 300 or 'Error' in call['Response']:
+            raise ClientError(copy.deepcopy(call['Response']), scope[-1])
+        # handlers change the responses they get, later replays need them intact
+        return copy.deepcopy(call['Response'])
+
+
+class Exceptions: # pylint: disable=too-few-public-methods
+    '''client.exceptions of the replay clients'''
+    ClientError = ClientError
+
+
+class ReplayClient: # pylint: disable=too-few-public-methods
+    '''client answering every method from the recorded calls'''
+
+    exceptions = Exceptions
+
+    def __init__(self, aws, service, region_name, account_id):
+        self.aws = aws
+        self.scope = (service, account_id, region_name)
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        return lambda **params: self.aws.call(self.scope + (method,), params)
+
+
+def trace_files(paths):
+    '''returns the trace files of the given files and directories'''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path)) \
+                if name.endswith('.jsonl.gz'))
+        else:
+            files.append(path)
+    return files
+
+
+def replay(traces, latency_scale):
+    '''replays the invocations, returns [(invocation, replay aws, seconds)]'''
+    set_store(MemoryStore())
+    results = []
+    for invocation, calls in traces:
+        aws = ReplayAws(calls, latency_scale)
+        set_client_factory(aws.client)
+        start = time.perf_counter()
+        try:
+            HANDLERS[invocation['Handler']].lambda_handler(invocation['Event'], None)
+        except Exception as err: # pylint: disable=broad-except
+            print(f"{invocation['Handler']} failed - {err}")
+        results.append((invocation, aws, time.perf_counter() - start))
+    return results
+
+
+def report(results):
+    '''prints wall time, calls and misses per handler'''
+    totals = defaultdict(lambda: {'invocations': 0, 'seconds': 0.0, 'recorded': 0.0,
+        'calls': Counter(), 'misses': Counter()})
+    for invocation, aws, seconds in results:
+        total = totals[invocation['Handler']]
+        total['invocations'] += 1
+        total['seconds'] += seconds
+        total['recorded'] += aws.recorded_latency
+        total['calls'].update(aws.calls)
+        total['misses'].update(aws.misses)
+    for handler, total in totals.items():
+        print(f"    {handler:<30} {total['seconds']:9.3f} s  {total['invocations']:6} invocations \
+{sum(total['calls'].values()):8} API calls  {total['recorded']:9.3f} s recorded API latency")
+        for method, count in sorted(total['calls'].items()):
+            misses = total['misses'][method]
+            print(f"        {method:<50} {count:8}" + (f"  {misses} missing" if misses else ''))
+
+
+def main():
+    '''replays the traces'''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', maxsplit=1)[0])
+    parser.add_argument('traces', nargs='+', help='trace files or directories')
+    parser.add_argument('--latency-scale', type=float, default=1.0,
+        help='factor applied to the recorded latencies, 0 does not wait')
+    parser.add_argument('--repeat', type=int, default=1, help='replays, the fastest is reported')
+    parser.add_argument('--verbose', action='store_true', help='keep the handler logs')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.disable(logging.INFO)
+    # waits of the handlers are part of the recorded latencies
+    list_instances.REGION_STAGGER_SECONDS = 0
+    baseline_builder.BOOT_SECONDS = 0
+
+    traces = sorted((read_trace(path) for path in trace_files(args.traces)),
+        key=lambda trace: trace[0]['CapturedAt'])
+    if unknown := {invocation['Handler'] for invocation, _ in traces} - set(HANDLERS):
+        parser.error(f"traces of unknown handlers {sorted(unknown)}")
+
+    runs = [replay(traces, args.latency_scale) for _ in range(max(1, args.repeat))]
+    best = min(runs, key=lambda results: sum(result[2] for result in results))
+    elapsed = sum(result[2] for result in best)
+    print(f"{len(traces)} invocations replayed in {elapsed:.3f} s")
+    report(best)
+    return 1 if any(aws.misses for _, aws, _ in best) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
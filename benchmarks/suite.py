@@ -0,0 +1,332 @@
+'''
+suite.py
+Micro-benchmarks of the hot paths, with regression thresholds. Every case is
+timed as the best of several runs. --save stores the results as a JSON
+baseline. Later runs compare with it and exit with status 1 when a case is
+slower than its baseline by more than the tolerance (25% by default). Save a
+baseline on the main branch, then run the suite on your branch.
+
+    python benchmarks/suite.py [case ...] [--baseline FILE] [--save]
+        [--tolerance 0.25] [--repeat N] [--list]
+'''
+
+import os
+import sys
+import json
+import random
+import logging
+import argparse
+import platform
+import tempfile
+
+from common import measure
+
+# the handlers would print their metrics after every run
+os.environ['METRICS_ENABLED'] = 'false'
+
+# pylint: disable=wrong-import-order,wrong-import-position
+from bench_arch import restriction_lists, ARCHITECTURES
+from bench_packagefile import write_synthetic_index
+from bench_patch import ed_script
+from fake_aws import FakeAws, MemoryStore
+from fleet import Fleet, dpkg_releases, rpm_releases
+
+from debian._arch_table import DpkgArchTable, CompiledDpkgArchTable
+from debian.debian_support import (NativeVersion,
+    PackageFile,
+    MappedPackageFile,
+    compose_patches,
+    iter_patched_lines,
+    patch_lines,
+    patches_from_ed_script,
+    version_compare)
+
+import validate_instance_compliance
+from utils.compliance import baseline_id
+from utils.helpers import set_client_factory
+from utils.store import set_store
+from utils.wire import encode_packages
+# pylint: enable=wrong-import-order,wrong-import-position
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+TOLERANCE = 0.25
+REPEAT = 5
+DPKG_TABLES = '/usr/share/dpkg'
+
+# versions as Ubuntu and Amazon Linux report them: epochs, tildes, +really,
+# security and backport revisions, rpm versions without release
+VERSIONS = ('1:2.34-0ubuntu3.2', '2.35-0ubuntu3.1', '1:9.18.12-0ubuntu0.22.04.1', '5.1-6ubuntu1',
+    '1.2.4~rc1-2ubuntu0.1', '2:8.2.3995-1ubuntu2.7', '0.9.8-1build1', '3.0.2-0ubuntu1.10',
+    '249.11-0ubuntu3.9', '1:8.9p1-3ubuntu0.1', '2.0.1~git20220101.1-1', '5.15.0-86.96',
+    '20230311ubuntu0.22.04.1', '1.19.2-2ubuntu0.22.04.1+esm1', '7.81.0-1ubuntu1.13',
+    '0.9.13~really0.9.12-1', '1.1.1f-1ubuntu2.19', '3.8.10-0ubuntu1~20.04.8',
+    '1:3.1.0-1~20.04.1', '2.37.2-4ubuntu3', '1:4.8.1-2ubuntu2.1', '2.26', '1.0.2k', '7.61.1',
+    '4.2.46', '2.0.20230119.1', '1.1.1g', '2.17', '5.2.4', '1.8.0.382.b05')
+CORPUS = 20000
+
+
+def version_corpus(rand, count=CORPUS):
+    '''returns count version strings, generated like the fleet inventories'''
+    versions = list(VERSIONS)
+    while len(versions) < count:
+        make_releases = rand.choice((dpkg_releases, dpkg_releases, rpm_releases))
+        versions.extend(make_releases(rand, 4))
+    return versions[:count]
+
+
+def version_pairs(rand, count=CORPUS):
+    '''returns count (compliant, installed) pairs, mostly releases of the same package'''
+    pairs = []
+    while len(pairs) < count:
+        make_releases = rand.choice((dpkg_releases, dpkg_releases, rpm_releases))
+        releases = make_releases(rand, 4)
+        pairs.append((releases[-1], rand.choice(releases)))
+        pairs.append((rand.choice(VERSIONS), rand.choice(VERSIONS)))
+    return pairs[:count]
+
+
+def case_version_compare(workdir):
+    '''version_compare of 20000 version pairs'''
+    del workdir
+    pairs = version_pairs(random.Random(42))
+    return lambda: [version_compare(compliant, installed) for compliant, installed in pairs]
+
+
+def case_native_version_parse(workdir):
+    '''NativeVersion parsing of 20000 version strings'''
+    del workdir
+    versions = version_corpus(random.Random(42))
+    return lambda: [NativeVersion(version) for version in versions]
+
+
+def case_packagefile(workdir):
+    '''PackageFile iteration of a 60000 stanza Packages index'''
+    path = os.path.join(workdir, 'Packages')
+    write_synthetic_index(path)
+
+    def records():
+        with open(path, 'rb') as file:
+            return sum(1 for _ in PackageFile(path, file))
+    return records
+
+
+def case_mapped_packagefile(workdir):
+    '''MappedPackageFile.package_versions of a 60000 stanza Packages index'''
+    path = os.path.join(workdir, 'Packages')
+    if not os.path.exists(path):
+        write_synthetic_index(path)
+
+    def versions():
+        with MappedPackageFile(path) as packages:
+            return packages.package_versions()
+    return versions
+
+
+def patch_chain(lines=100000, chain=50):
+    '''returns (file lines, ed scripts) of a pdiff chain'''
+    rand = random.Random(42)
+    base = [f"Package: pkg{i // 3}\n" if i % 3 == 0 else f"Version: 1.{i}\n" \
+        for i in range(lines)]
+    scripts = []
+    length = len(base)
+    for _ in range(chain):
+        script, length = ed_script(rand, length)
+        scripts.append(script)
+    return base, scripts
+
+
+def case_patch_lines(workdir):
+    '''patch_lines of a 50 pdiff chain on a 100000 line index'''
+    del workdir
+    base, scripts = patch_chain()
+
+    def sequential():
+        lines = list(base)
+        for script in scripts:
+            patch_lines(lines, patches_from_ed_script(script))
+        return lines
+    return sequential
+
+
+def case_compose_patches(workdir):
+    '''compose_patches + iter_patched_lines of a 50 pdiff chain on a 100000 line index'''
+    del workdir
+    base, scripts = patch_chain()
+    return lambda: list(iter_patched_lines(base, compose_patches(
+        [patches_from_ed_script(script) for script in scripts], len(base))))
+
+
+def arch_pairs():
+    '''returns 20000 (architecture, restriction list) pairs'''
+    rand = random.Random(42)
+    lists = restriction_lists(rand)
+    return [(rand.choice(ARCHITECTURES), rand.choice(lists)) for _ in range(CORPUS)]
+
+
+def case_arch_table(workdir):
+    '''DpkgArchTable.architecture_is_concerned of 20000 pairs'''
+    del workdir
+    table = DpkgArchTable.load_arch_table(DPKG_TABLES)
+    pairs = arch_pairs()
+    return lambda: [table.architecture_is_concerned(architecture, restrictions) \
+        for architecture, restrictions in pairs]
+
+
+def case_compiled_arch_table(workdir):
+    '''CompiledDpkgArchTable.architectures_are_concerned of 20000 pairs'''
+    del workdir
+    table = CompiledDpkgArchTable.load_arch_table(DPKG_TABLES, use_cache=False)
+    pairs = arch_pairs()
+    return lambda: table.architectures_are_concerned(pairs)
+
+
+def validate_batch(cached):
+    '''returns a function validating one SQS batch of 50 synthetic instances'''
+    aws = FakeAws()
+    fleet = Fleet(50, 1, ['us-east-1'])
+    fleet.load(aws)
+    baselines = {}
+    for image in aws.images:
+        platform_key = (image['PlatformName'], image['PlatformVersion'])
+        # the second newest AMI of the platform is its n-1 baseline
+        baselines.setdefault(platform_key, []).append(image)
+    records = []
+    for (account_id, region), instances in aws.instances.items():
+        for instance in instances:
+            image = baselines[(instance['PlatformName'], instance['PlatformVersion'])][1]
+            packages = {entry['Name']: entry['Version'] for entry in image['Inventory']}
+            records.append({'messageId': instance['InstanceId'], 'body': json.dumps({
+                'InstanceId': instance['InstanceId'],
+                'PlatformName': instance['PlatformName'],
+                'PlatformVersion': instance['PlatformVersion'],
+                'Name': instance['Name'],
+                'Region': region,
+                'AccountId': account_id,
+                'AccountName': fleet.accounts[0]['Name'],
+                'ScanTime': '2026-01-01 00:00:00',
+                'ScanType': 'n-1',
+                'Baselines': {'n-1': {'ComplaintPackages': encode_packages(packages),
+                    'BaselineId': baseline_id(packages)}}
+            })})
+    set_client_factory(aws.client)
+    store = MemoryStore()
+
+    def batch():
+        # a fresh store evaluates every inventory, a warm one reuses the cached scores
+        set_store(store if cached else MemoryStore())
+        return validate_instance_compliance.lambda_handler({'Records': records}, None)
+    if cached:
+        batch()
+    return batch
+
+
+def case_validate_batch(workdir):
+    '''validate_instance_compliance of a 50 record batch, inventories evaluated'''
+    del workdir
+    return validate_batch(cached=False)
+
+
+def case_validate_batch_cached(workdir):
+    '''validate_instance_compliance of a 50 record batch, scores cached'''
+    del workdir
+    return validate_batch(cached=True)
+
+
+CASES = {
+    'version_compare': case_version_compare,
+    'native_version_parse': case_native_version_parse,
+    'packagefile': case_packagefile,
+    'mapped_packagefile': case_mapped_packagefile,
+    'patch_lines': case_patch_lines,
+    'compose_patches': case_compose_patches,
+    'arch_table': case_arch_table,
+    'compiled_arch_table': case_compiled_arch_table,
+    'validate_batch': case_validate_batch,
+    'validate_batch_cached': case_validate_batch_cached,
+}
+
+
+def load_baseline(path):
+    '''returns {case: seconds} of the baseline file, empty when there is none'''
+    try:
+        with open(path, 'r', encoding='utf8') as file:
+            return json.load(file)['cases']
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(path, results):
+    '''stores the results in the baseline file, keeping the cases not run'''
+    cases = dict(load_baseline(path), **results)
+    with open(path, 'w', encoding='utf8') as file:
+        json.dump({
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cases': cases
+        }, file, indent=2, sort_keys=True)
+        file.write('\n')
+
+
+def run(names, repeat):
+    '''returns {case: best seconds}'''
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in names:
+            try:
+                func = CASES[name](workdir)
+            except OSError as err:
+                print(f"{name:<28} skipped - {err}")
+                continue
+            results[name] = measure(func, repeat=repeat)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''prints the results against the baseline, returns the regressed cases'''
+    regressions = []
+    for name, seconds in results.items():
+        line = f"{name:<28} {seconds * 1000:10.3f} ms"
+        if (previous := baseline.get(name)) is not None:
+            ratio = seconds / previous
+            line += f"  baseline {previous * 1000:10.3f} ms  {ratio:5.2f}x"
+            if ratio > 1 + tolerance:
+                regressions.append(name)
+                line += "  REGRESSION"
+        print(line)
+    return regressions
+
+
+def main():
+    '''runs the suite'''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', maxsplit=1)[0])
+    parser.add_argument('cases', nargs='*', help='cases to run, all by default')
+    parser.add_argument('--baseline', default=BASELINE, help='JSON baseline file')
+    parser.add_argument('--save', action='store_true', help='store the results as baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+        help='slowdown allowed before a case fails, 0.25 is 25%%')
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='runs per case')
+    parser.add_argument('--list', action='store_true', help='list the cases')
+    args = parser.parse_args()
+
+    if args.list:
+        for name, case in CASES.items():
+            print(f"{name:<28} {case.__doc__}")
+        return 0
+    if unknown := [name for name in args.cases if name not in CASES]:
+        parser.error(f"unknown cases {unknown}, see --list")
+
+    logging.disable(logging.INFO)
+    results = run(args.cases or list(CASES), args.repeat)
+    regressions = compare(results, load_baseline(args.baseline), args.tolerance)
+    if args.save:
+        save_baseline(args.baseline, results)
+        print(f"saved {len(results)} cases to {args.baseline}")
+    elif regressions:
+        print(f"{len(regressions)} cases regressed by more than {args.tolerance:.0%}: \
+{' '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,13 +2,53 @@ data "aws_caller_identity" "current" {}
 
 locals {
   role_arn = resource.aws_iam_role.role.arn
+  # concurrent validate_instance_compliance invocations, list_instances paces the queue for it
+  validate_concurrency = 4
 
   env_vars = {
-    SUBNET_ID       = module.network.subnet_id                                                                                           # Subnet Id for compliant server
-    IAM_PROFILE_ARN = "arn:aws:iam::${data.aws_caller_identity.current.account_id}:instance-profile/AmazonSSMRoleForInstancesQuickSetup" # IAM profile ARN for compliant server
-    QUEUE_URL       = aws_sqs_queue.queue.id
-    SG_ID           = module.network.sg_id # Security group ID for compliant server
-    ROLE_NAME       = var.iam_role
+    SUBNET_ID                = module.network.subnet_id                                                                                           # Subnet Id for compliant server
+    IAM_PROFILE_ARN          = "arn:aws:iam::${data.aws_caller_identity.current.account_id}:instance-profile/AmazonSSMRoleForInstancesQuickSetup" # IAM profile ARN for compliant server
+    QUEUE_URL                = aws_sqs_queue.queue.id
+    SG_ID                    = module.network.sg_id # Security group ID for compliant server
+    ROLE_NAME                = var.iam_role
+    PATCH_INSPECT_TABLE_NAME = aws_dynamodb_table.state.name # baselines and cached inventories
+    CONTINUATION_QUEUE_URL   = aws_sqs_queue.continuations.id # initiate runs continued after the deadline
+    VALIDATE_CONCURRENCY     = local.validate_concurrency
+
+    # list_instances resumed with the instances past the longest message delay
+    LIST_CONTINUATION_QUEUE_URL = aws_sqs_queue.list_continuations.id
+  }
+
+  # files of src/ each function loads, listed by benchmarks/bench_imports.py
+  common_files = [
+    "utils/__init__.py",
+    "utils/config.py",
+    "utils/deadline.py",
+    "utils/helpers.py",
+    "utils/logs.py",
+    "utils/memprof.py",
+    "utils/metrics.py",
+    "utils/serialization.py",
+    "utils/trace.py",
+  ]
+  compliance_files = [
+    "utils/compliance.py",
+    "utils/store.py",
+    "utils/wire.py",
+    "debian/__init__.py",
+    "debian/debian_support.py",
+    "debian/deprecation.py",
+  ]
+  source_files = {
+    initiate = concat(["initiate.py"], local.common_files, local.compliance_files, [
+      "utils/baseline_builder.py",
+      # baseline sources, imported when an image uses one
+      "utils/baseline_sources.py",
+      "utils/mirror.py",
+    ], fileexists("src/accounts.json") ? ["accounts.json"] : [])
+    # small account-regions are validated inline by list_instances
+    list_instances               = concat(["list_instances.py", "validate_instance_compliance.py", "utils/sampling.py"], local.common_files, local.compliance_files)
+    validate_instance_compliance = concat(["validate_instance_compliance.py"], local.common_files, local.compliance_files)
   }
 }
 
@@ -56,18 +96,43 @@ module "network" {
 module "initiate" {
   source = "./modules/lambda_function"
 
-  rule_name = "initiate"
-  env_vars  = local.env_vars
-  role_arn  = local.role_arn
+  rule_name    = "initiate"
+  source_files = local.source_files.initiate
+  env_vars     = local.env_vars
+  role_arn     = local.role_arn
 }
 
 module "list_instances" {
   source = "./modules/lambda_function"
 
-  env_vars  = local.env_vars
-  rule_name = "list_instances"
-  rule      = true
-  role_arn  = local.role_arn
+  env_vars     = local.env_vars
+  rule_name    = "list_instances"
+  source_files = local.source_files.list_instances
+  rule         = true
+  role_arn     = local.role_arn
+}
+
+# state table for baselines and cached instance inventories
+
+resource "aws_dynamodb_table" "state" {
+  name         = "${var.project}_state"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "pk"
+
+  attribute {
+    name = "pk"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+
+  tags = {
+    Name    = "${var.project}_state"
+    Service = "dynamodb"
+  }
 }
 
 # create sqs queue for validateInstanceCompliance
@@ -92,18 +157,65 @@ resource "aws_lambda_event_source_mapping" "sqs_lambda_mapping" {
 
   maximum_batching_window_in_seconds = 30
   batch_size                         = 50
+
+  # records not validated before the deadline are returned to the queue
+  function_response_types = ["ReportBatchItemFailures"]
   scaling_config {
 
-    maximum_concurrency = 4
+    maximum_concurrency = local.validate_concurrency
   }
 }
 
+# continuations of initiate runs, checking their compliant servers or resuming after the deadline
+
+resource "aws_sqs_queue" "continuations" {
+  name                      = "patch_inspect_continuations"
+  message_retention_seconds = 86400
+
+  visibility_timeout_seconds = 920
+
+  tags = {
+    Name    = "patch_inspect_continuations"
+    Service = "sqs"
+  }
+}
+
+resource "aws_lambda_event_source_mapping" "continuation_mapping" {
+  event_source_arn = aws_sqs_queue.continuations.arn
+  function_name    = module.initiate.function_arn
+
+  batch_size = 1
+}
+
+# instances list_instances could not give a delivery slot within 15 minutes, resumed once the
+# messages published before are delivered
+
+resource "aws_sqs_queue" "list_continuations" {
+  name                      = "patch_inspect_list_continuations"
+  message_retention_seconds = 86400
+
+  visibility_timeout_seconds = 920
+
+  tags = {
+    Name    = "patch_inspect_list_continuations"
+    Service = "sqs"
+  }
+}
+
+resource "aws_lambda_event_source_mapping" "list_continuation_mapping" {
+  event_source_arn = aws_sqs_queue.list_continuations.arn
+  function_name    = module.list_instances.function_arn
+
+  batch_size = 1
+}
+
 module "validate_instance_compliance" {
   source = "./modules/lambda_function"
 
-  env_vars  = local.env_vars
-  rule_name = "validate_instance_compliance"
-  role_arn  = local.role_arn
+  env_vars     = local.env_vars
+  rule_name    = "validate_instance_compliance"
+  source_files = local.source_files.validate_instance_compliance
+  role_arn     = local.role_arn
 }
 
 # creates log group to publish findings
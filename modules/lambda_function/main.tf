@@ -4,7 +4,16 @@ data "archive_file" "code_zip" {
   type        = "zip"
   output_path = "func/${var.rule_name}.zip"
 
-  source_dir = "src/"
+  # only the files the handler loads, or the whole src/ directory
+  source_dir = length(var.source_files) == 0 ? "src/" : null
+
+  dynamic "source" {
+    for_each = var.source_files
+    content {
+      content  = file("src/${source.value}")
+      filename = source.value
+    }
+  }
 }
 
 
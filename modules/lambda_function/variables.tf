@@ -26,6 +26,12 @@ variable "layers" {
   default = []
 }
 
+variable "source_files" {
+  type = list(string)
+  description = "files of src/ packaged with the function (all of src/ when empty)"
+  default = []
+}
+
 variable "env_vars" {
   type = map
   description = "list of environment variables used in lambda function"
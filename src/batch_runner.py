@@ -0,0 +1,217 @@
+'''
+batch_runner
+runs a whole scan in one process tree instead of the Lambda and SQS fan-out:
+baselines are built by CompliantServer, instances listed by
+PublishInstanceDetails on a thread pool and their inventories compared with
+the baselines by a process pool. Findings are written as JSON lines
+
+    python src/batch_runner.py [--scan-types n-1 ...] [--accounts accounts.json]
+        [--regions REGION ...] [--output findings.jsonl] [--io-workers N] [--workers N]
+        [--sample-size N | --margin-of-error POINTS [--confidence 0.95]]
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import multiprocessing
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from initiate import CompliantServer
+from list_instances import PublishInstanceDetails, account_regions, platform_baselines
+from utils.compliance import assess_instance, evaluate_entries, message_baselines
+from utils.helpers import get_client
+from utils.logs import configure_logging
+from utils.sampling import DEFAULT_CONFIDENCE, Rollup
+from utils.store import get_store
+
+log = configure_logging()
+
+IO_WORKERS = 32
+
+# {(platform name, platform version): {scan type: decoded baseline}} of the scan.
+# Set before the process pool starts, forked workers share it without a copy
+_BASELINES = {}
+
+
+def _init_worker(baselines):
+    '''sets the baselines of a worker started without fork'''
+    global _BASELINES # pylint: disable=global-statement
+    _BASELINES = baselines
+
+
+def _ready():
+    '''no-op run by every worker when the pool starts'''
+    return os.getpid()
+
+
+def score_entries(platform, pairs):
+    '''returns {scan type: score} of the (name, version) pairs of an inventory,
+    run by the workers'''
+    return evaluate_entries([{'Name': name, 'Version': version} for name, version in pairs],
+        _BASELINES[platform])
+
+
+class BatchRunner: # pylint: disable=too-many-instance-attributes
+    '''lists and evaluates the instances of accounts and regions against the
+    baselines of a scan'''
+
+    def __init__(self, compliant_server, output, io_workers=IO_WORKERS, workers=None,
+            sampling=None):
+        self.compliant_server = compliant_server
+        self.sampling = sampling
+        self.platforms = platform_baselines(compliant_server)
+        self.output = output
+        self.io_workers = io_workers
+        self.workers = workers or os.cpu_count()
+        self.store = get_store()
+        self.lock = threading.Lock()
+        self.counts = {'Instances': 0, 'Findings': 0, 'Failures': 0}
+        self.rollup = Rollup()
+        self.pool = None
+        self.file = None
+
+    def run(self, accounts, regions):
+        '''evaluates every instance, returns the counts of the run'''
+        global _BASELINES # pylint: disable=global-statement
+        # baselines are decoded once, not once per instance as in the messages
+        _BASELINES = {platform: message_baselines(shared) \
+            for platform, shared in self.platforms.items()}
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context, initargs = multiprocessing.get_context('fork'), ()
+        else:
+            context, initargs = None, (_BASELINES,)
+
+        with ProcessPoolExecutor(self.workers, mp_context=context, initializer=_init_worker \
+                    if initargs else None, initargs=initargs) as self.pool, \
+                open(self.output, 'w', encoding='utf8') as self.file:
+            # workers are forked before any I/O thread runs, forking a process
+            # while other threads hold locks can deadlock the child
+            for future in [self.pool.submit(_ready) for _ in range(self.workers)]:
+                future.result()
+
+            with ThreadPoolExecutor(self.io_workers) as io_pool:
+                listings = [io_pool.submit(self.list_region, account, region) \
+                    for account in accounts \
+                    for region in regions or account_regions(account['Id'], self.store)]
+                assessments = []
+                for listing in as_completed(listings):
+                    ssm, bodies = listing.result()
+                    assessments.extend(io_pool.submit(self.assess, body, ssm) for body in bodies)
+                for assessment in as_completed(assessments):
+                    assessment.result()
+        return self.counts
+
+    def list_region(self, account, region):
+        '''returns (SSM client, message bodies) of the instances of an account and
+        region running a platform of the scan'''
+        app = PublishInstanceDetails(account['Id'], account['Name'], region,
+            self.compliant_server, None, sampling=self.sampling)
+        try:
+            listed = app.list_all_ec2_instances(app.ssm)
+        except app.ssm.exceptions.ClientError as err:
+            log.error(f"Could not list the instances of account {account['Id']} in region \
+                {region} - {err}")
+            return app.ssm, []
+        instances = [instance for instance in listed \
+            if (instance['PlatformName'], instance['PlatformVersion']) in self.platforms]
+        samples = {}
+        if self.sampling and instances:
+            instances, samples = app.sample(instances, self.platforms)
+        bodies = []
+        for instance in instances:
+            platform = (instance['PlatformName'], instance['PlatformVersion'])
+            shared = {key: value for key, value in self.platforms[platform].items() \
+                if key != 'Baselines'}
+            if platform in samples:
+                shared['Sample'] = samples[platform]
+            bodies.append(dict(instance, **shared, Region=region, AccountId=account['Id'],
+                AccountName=account['Name']))
+        log.info(f"{len(bodies)} instances to evaluate in account {account['Id']} \
+            and region {region}")
+        with self.lock:
+            self.counts['Instances'] += len(bodies)
+        return app.ssm, bodies
+
+    def evaluate(self, platform, entries, baselines):
+        '''evaluate_entries of assess_instance, run by a worker process'''
+        del baselines
+        return self.pool.submit(score_entries, platform,
+            [(entry['Name'], entry['Version']) for entry in entries]).result()
+
+    def assess(self, body, ssm):
+        '''evaluates one instance and writes its findings'''
+        platform = (body['PlatformName'], body['PlatformVersion'])
+        try:
+            finding = assess_instance(body, ssm, self.store, baselines=_BASELINES[platform],
+                evaluate=partial(self.evaluate, platform))
+        except Exception as err: # pylint: disable=broad-except
+            log.error(f"Could not evaluate instance {body['InstanceId']} - {err}")
+            with self.lock:
+                self.counts['Failures'] += 1
+            return
+        line = json.dumps(finding, default=str)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.counts['Findings'] += 1
+            self.rollup.add(finding)
+
+
+def main():
+    '''runs a scan'''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', maxsplit=1)[0])
+    parser.add_argument('--scan-types', nargs='+', default=['n-1'],
+        help='baselines to compare with, the first one is the CompliancePercentage')
+    parser.add_argument('--accounts', default='accounts.json', help='accounts.json of initiate')
+    parser.add_argument('--regions', nargs='+',
+        help='regions listed in every account, the regions enabled in each one by default')
+    parser.add_argument('--output', default='findings.jsonl', help='JSON lines findings file')
+    parser.add_argument('--io-workers', type=int, default=IO_WORKERS,
+        help='threads listing instances and fetching inventories')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+        help='processes comparing inventories with the baselines')
+    sample = parser.add_mutually_exclusive_group()
+    sample.add_argument('--sample-size', type=int,
+        help='instances evaluated per account, region and platform')
+    sample.add_argument('--margin-of-error', type=float,
+        help='sample sized for this margin of the compliance percentage, in points')
+    parser.add_argument('--confidence', type=float, default=DEFAULT_CONFIDENCE,
+        help='confidence level of --margin-of-error and of the estimates')
+    args = parser.parse_args()
+
+    sampling = None
+    if args.sample_size:
+        sampling = {'Size': args.sample_size}
+    elif args.margin_of_error:
+        sampling = {'MarginOfError': args.margin_of_error, 'Confidence': args.confidence}
+
+    with open(args.accounts, 'r', encoding='utf8') as file:
+        accounts = json.load(file)['account_detail']
+
+    start = time.perf_counter()
+    app = CompliantServer(os.environ.get('SG_ID', ''), os.environ.get('SUBNET_ID', ''),
+        os.environ.get('IAM_PROFILE_ARN', ''), args.scan_types, sampling=sampling)
+    app.build_baselines(get_client('ec2'), get_client('ssm'))
+    if not app.instance_details:
+        log.error("No complaint details captured. Exiting...")
+        return 1
+    log.info(f"Baselines built in {time.perf_counter() - start:.0f} seconds")
+
+    runner = BatchRunner(app.instance_details, args.output, args.io_workers, args.workers,
+        sampling)
+    counts = runner.run(accounts, args.regions)
+    log.info(f"{counts['Findings']} findings of {counts['Instances']} instances written to \
+        {args.output} in {time.perf_counter() - start:.0f} seconds, {counts['Failures']} failed")
+    for estimate in runner.rollup.estimates(confidence=args.confidence).values():
+        log.info(f"Estimated compliance {estimate['Estimate']}% ({estimate['Low']}% - \
+            {estimate['High']}% at {args.confidence:.0%} confidence) from \
+            {estimate['Sampled']} of {estimate['Population']} instances\
+            {', unbounded: strata with a single score' if estimate['Unbounded'] else ''}")
+    return 1 if counts['Failures'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
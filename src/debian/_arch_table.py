@@ -24,9 +24,12 @@ other people.  Copyright years imported from the sources.
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 import os
+import zlib
+import marshal
+import tempfile
 
 try:
-    from typing import Iterable, Optional, IO, List, Dict, Union
+    from typing import Iterable, Optional, IO, List, Dict, Tuple, Union
     from os import PathLike
 except ImportError:
     pass
@@ -93,6 +96,14 @@ class DpkgArchTable:
           directory must contain the architecture data files from dpkg (such as "tupletable" and
           "cputable")
         """
+        tupletable_path, cputable_path, triplet_compat = cls._table_paths(path)
+        with open(tupletable_path, encoding='utf-8') as tuple_fd,\
+                open(cputable_path, encoding='utf-8') as cpu_fd:
+            return cls._from_file(tuple_fd, cpu_fd, triplet_compat=triplet_compat)
+
+    @staticmethod
+    def _table_paths(path):
+        # type: (Union[str, PathLike[str]]) -> Tuple[str, str, bool]
         tupletable_path = os.path.join(path, 'tupletable')
         cputable_path = os.path.join(path, 'cputable')
         triplet_compat = False
@@ -101,10 +112,7 @@ class DpkgArchTable:
             if os.path.join(triplettable_path):
                 triplet_compat = True
                 tupletable_path = triplettable_path
-
-        with open(tupletable_path, encoding='utf-8') as tuple_fd,\
-                open(cputable_path, encoding='utf-8') as cpu_fd:
-            return cls._from_file(tuple_fd, cpu_fd, triplet_compat=triplet_compat)
+        return tupletable_path, cputable_path, triplet_compat
 
     @classmethod
     def _from_file(cls, tuple_table_fd, cpu_table_fd, triplet_compat=False):
@@ -128,7 +136,7 @@ class DpkgArchTable:
                     )
             else:
                 arch2tuple[dpkg_arch] = QuadTupleDpkgArchitecture(*dpkg_tuple.split('-', 3))
-        return DpkgArchTable(arch2tuple)
+        return cls(arch2tuple)
 
     def _dpkg_wildcard_to_tuple(self, arch):
         # type: (str) -> QuadTupleDpkgArchitecture
@@ -403,3 +411,339 @@ class DpkgArchTable:
         else:
             # _dpkg_wildcard_to_tuple falls back to concrete architectures so this can be False
             return dpkg_arch.is_wildcard
+
+
+# Bump when the layout of the cached compiled table changes
+_COMPILED_FORMAT = 1
+
+
+class CompiledDpkgArchTable(DpkgArchTable):
+    """DpkgArchTable compiled to integer architecture IDs and wildcard bitsets
+
+    Every distinct architecture tuple gets an integer ID and every wildcard or architecture used
+    as alias or restriction is resolved once to the bitset (a Python int) of the IDs it matches,
+    so a match is a shift and a mask instead of a tuple comparison.  The bitsets are built from
+    one bitset per (tuple position, name) pair: a wildcard matches the tuples that have its name
+    at every position where it is not 'any'.  The results are the same as the ones of
+    DpkgArchTable, including the compatibility quirks and the exceptions raised.
+
+    load_arch_table keeps the compiled table in a marshal file (in the temporary directory by
+    default) keyed by the size and modification time of the dpkg tables, so later loads skip
+    parsing the tables and expanding the <cpu> rows.
+    """
+
+    def __init__(self, arch2tuple, compiled=None):
+        # type: (Optional[Dict[str, QuadTupleDpkgArchitecture]], Optional[tuple]) -> None
+        # arch2tuple is None when the table is loaded from its compiled form; the compiled
+        # table never needs it.
+        super().__init__(arch2tuple)  # type: ignore
+        if compiled is None:
+            compiled = self._compile(arch2tuple)  # type: ignore
+        self._arch_ids, self._tuples, self._part_bits = compiled
+        self._all_bits = (1 << len(self._tuples)) - 1
+        self._restriction_bits_cache = {}  # type: Dict[str, int]
+
+    @staticmethod
+    def _compile(arch2tuple):
+        # type: (Dict[str, QuadTupleDpkgArchitecture]) -> tuple
+        tuple_ids = {}  # type: Dict[Tuple[str, ...], int]
+        arch_ids = {}  # type: Dict[str, int]
+        for dpkg_arch, dpkg_tuple in arch2tuple.items():
+            arch_ids[dpkg_arch] = tuple_ids.setdefault(tuple(dpkg_tuple), len(tuple_ids))
+
+        part_bits = [{}, {}, {}, {}]  # type: List[Dict[str, int]]
+        for dpkg_tuple, arch_id in tuple_ids.items():
+            for position, part in enumerate(dpkg_tuple):
+                part_bits[position][part] = part_bits[position].get(part, 0) | 1 << arch_id
+        return arch_ids, list(tuple_ids), part_bits
+
+    @classmethod
+    def load_arch_table(cls, path='/usr/share/dpkg', cache_dir=None, use_cache=True):
+        # type: (Union[str, PathLike[str]], Optional[str], bool) -> CompiledDpkgArchTable
+        """Load the Dpkg Architecture Table and compile it
+
+        >>> arch_table = CompiledDpkgArchTable.load_arch_table()
+        >>> arch_table.matches_architecture("amd64", "linux-any")
+        True
+
+        :param path: Choose a different directory for loading the architecture data (see
+          DpkgArchTable.load_arch_table)
+        :param cache_dir: Directory of the cached compiled table; defaults to the temporary
+          directory.  The file is rewritten whenever the dpkg tables change.
+        :param use_cache: Set to False to neither read nor write the cached compiled table.
+        """
+        if not use_cache:
+            return super().load_arch_table(path)  # type: ignore
+
+        tupletable_path, cputable_path, triplet_compat = cls._table_paths(path)
+        stats = [os.stat(tupletable_path), os.stat(cputable_path)]
+        key = (_COMPILED_FORMAT, os.path.abspath(tupletable_path), triplet_compat) \
+            + tuple((stat.st_size, stat.st_mtime_ns) for stat in stats)
+        if cache_dir is None:
+            cache_dir = tempfile.gettempdir()
+        cache_path = os.path.join(cache_dir, 'python-debian-arch-table-%08x.marshal'
+                                  % zlib.crc32(repr(key[1:3]).encode('utf-8')))
+
+        try:
+            with open(cache_path, 'rb') as fd:
+                cached = marshal.loads(fd.read())
+            if isinstance(cached, tuple) and len(cached) == 4 and cached[0] == key:
+                return cls(None, cached[1:])
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+
+        table = super().load_arch_table(path)  # type: ignore
+        table._save_compiled(cache_path, key)  # pylint: disable=protected-access
+        return table
+
+    def _save_compiled(self, cache_path, key):
+        # type: (str, tuple) -> None
+        data = marshal.dumps((key, self._arch_ids, self._tuples, self._part_bits))
+        # The cache is only an optimization; a read-only or full disk must not break loading
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path) or '.',
+                                             prefix='.python-debian-arch-table-')
+            try:
+                with os.fdopen(fd, 'wb') as temp_fd:
+                    temp_fd.write(data)
+                os.replace(temp_path, cache_path)
+            except OSError:
+                os.unlink(temp_path)
+                raise
+        except OSError:
+            pass
+
+    def _arch_id(self, architecture):
+        # type: (str) -> int
+        if architecture.startswith("linux-"):
+            architecture = architecture[6:]
+        return self._arch_ids[architecture]
+
+    def _dpkg_arch_to_tuple(self, dpkg_arch):
+        # type: (str) -> QuadTupleDpkgArchitecture
+        return QuadTupleDpkgArchitecture(*self._tuples[self._arch_id(dpkg_arch)])
+
+    def _restriction_bits(self, restriction):
+        # type: (str) -> int
+        try:
+            return self._restriction_bits_cache[restriction]
+        except KeyError:
+            pass
+        # Raises KeyError for unknown architectures exactly like DpkgArchTable
+        dpkg_wildcard = self._dpkg_wildcard_to_tuple(restriction)
+        bits = self._all_bits
+        for position, part in enumerate(dpkg_wildcard):
+            if part != 'any':
+                bits &= self._part_bits[position].get(part, 0)
+        self._restriction_bits_cache[restriction] = bits
+        return bits
+
+    def matches_architecture(self, architecture, alias):
+        # type: (str, str) -> bool
+        """Determine if a dpkg architecture matches another architecture or a wildcard [debarch_is]
+
+        See DpkgArchTable.matches_architecture.
+
+        >>> arch_table = CompiledDpkgArchTable.load_arch_table()
+        >>> arch_table.matches_architecture("armhf", "any-arm")
+        True
+        >>> arch_table.matches_architecture("i386", "kfreebsd-i386")
+        False
+        """
+        if alias in ('any', architecture):
+            return True
+        try:
+            arch_id = self._arch_id(architecture)
+            bits = self._restriction_bits(alias)
+        except KeyError:
+            return False
+        return bool(bits >> arch_id & 1)
+
+    def architecture_equals(self, arch1, arch2):
+        # type: (str, str) -> bool
+        """Determine whether two dpkg architecture are exactly the same [debarch_eq]
+
+        See DpkgArchTable.architecture_equals.
+
+        >>> arch_table = CompiledDpkgArchTable.load_arch_table()
+        >>> arch_table.architecture_equals("linux-amd64", "amd64")
+        True
+        """
+        if arch1 == arch2:
+            return True
+        try:
+            return self._arch_id(arch1) == self._arch_id(arch2)
+        except KeyError:
+            return False
+
+    def matches_architectures(self, pairs):
+        # type: (Iterable[Tuple[str, str]]) -> List[bool]
+        """Batch version of matches_architecture for (architecture, alias) pairs
+
+        >>> arch_table = CompiledDpkgArchTable.load_arch_table()
+        >>> arch_table.matches_architectures([("amd64", "linux-any"), ("i386", "amd64")])
+        [True, False]
+        """
+        return [self.matches_architecture(architecture, alias) for architecture, alias in pairs]
+
+    def _compile_restrictions(self, architecture_restrictions):
+        # type: (Iterable[str]) -> Tuple[List[Tuple[bool, Optional[int], str]], bool, bool]
+        # Returns ([(negative, bitset or None when unknown, restriction)], mixed, negative seen)
+        entries = []
+        positive_match_seen = False
+        negative_match_seen = False
+        for arch_restriction in architecture_restrictions:
+            if arch_restriction == '':
+                continue
+            if arch_restriction[0] == '!':
+                negative_match_seen = True
+            else:
+                positive_match_seen = True
+            arch_restriction = arch_restriction.lower()
+            negative = arch_restriction[0] == '!'
+            if negative:
+                arch_restriction = arch_restriction[1:]
+            try:
+                bits = self._restriction_bits(arch_restriction)  # type: Optional[int]
+            except KeyError:
+                # Only raised if the restriction is reached, as in DpkgArchTable
+                bits = None
+            entries.append((negative, bits, arch_restriction))
+        return entries, positive_match_seen and negative_match_seen, negative_match_seen
+
+    @staticmethod
+    def _is_concerned(arch_id, compiled, allow_mixing_positive_and_negative):
+        # type: (int, Tuple[List[Tuple[bool, Optional[int], str]], bool, bool], bool) -> bool
+        entries, mixed, negative_match_seen = compiled
+        verdict = None  # type: Optional[bool]
+        for negative, bits, arch_restriction in entries:
+            if bits is None:
+                raise KeyError(arch_restriction)
+            if bits >> arch_id & 1:
+                verdict = not negative
+                if allow_mixing_positive_and_negative:
+                    return verdict
+                break
+        if not allow_mixing_positive_and_negative and mixed:
+            raise ValueError("architecture_restrictions contained mixed positive and negative"
+                             "restrictions (and allow_mixing_positive_and_negative was not True)")
+        if verdict is None:
+            verdict = negative_match_seen
+        return verdict
+
+    def _concerned_bits(self, compiled, allow_mixing_positive_and_negative):
+        # type: (Tuple[List[Tuple[bool, Optional[int], str]], bool, bool], bool) -> Optional[int]
+        # The bitset of all concerned architectures, or None when the answer depends on the
+        # architecture in a way that raises (unknown restrictions, forbidden mixing)
+        entries, mixed, negative_match_seen = compiled
+        if mixed and not allow_mixing_positive_and_negative:
+            return None
+        decided = 0
+        concerned = 0
+        for negative, bits, _ in entries:
+            if bits is None:
+                return None
+            if not negative:
+                concerned |= bits & ~decided
+            decided |= bits
+        if negative_match_seen:
+            concerned |= ~decided & self._all_bits
+        return concerned
+
+    def architecture_is_concerned(self, architecture, architecture_restrictions,
+                                  allow_mixing_positive_and_negative=False,
+                                  ):
+        # type: (str, Iterable[str], bool) -> bool
+        """Determine if a dpkg architecture is part of a list of restrictions [debarch_is_concerned]
+
+        See DpkgArchTable.architecture_is_concerned.
+
+        >>> arch_table = CompiledDpkgArchTable.load_arch_table()
+        >>> arch_table.architecture_is_concerned("linux-amd64", ["amd64", "i386"])
+        True
+        >>> arch_table.architecture_is_concerned("amd64", ["!amd64", "!i386"])
+        False
+        >>> arch_table.architecture_is_concerned("linux-amd64", ["!linux-amd64", "linux-any"],
+        ...                                      allow_mixing_positive_and_negative=True)
+        False
+        """
+        verdict = None  # type: Optional[bool]
+        positive_match_seen = False
+        negative_match_seen = False
+        bits_cache = self._restriction_bits_cache
+
+        try:
+            arch_id = self._arch_id(architecture)
+        except KeyError:
+            return False
+
+        # Same loop as DpkgArchTable.architecture_is_concerned, with a bit test as the match
+        for arch_restriction in architecture_restrictions:
+            if arch_restriction == '':
+                continue
+            if arch_restriction[0] == '!':
+                negative_match_seen = True
+            else:
+                positive_match_seen = True
+            if verdict is not None:
+                continue
+
+            arch_restriction = arch_restriction.lower()
+            verdict_if_matched = True
+            if arch_restriction[0] == '!':
+                verdict_if_matched = False
+                arch_restriction = arch_restriction[1:]
+            bits = bits_cache.get(arch_restriction)
+            if bits is None:
+                bits = self._restriction_bits(arch_restriction)
+            if bits >> arch_id & 1:
+                verdict = verdict_if_matched
+                if allow_mixing_positive_and_negative:
+                    return verdict
+
+        if not allow_mixing_positive_and_negative and positive_match_seen and negative_match_seen:
+            raise ValueError("architecture_restrictions contained mixed positive and negative"
+                             "restrictions (and allow_mixing_positive_and_negative was not True)")
+        if verdict is None:
+            verdict = negative_match_seen
+        return verdict
+
+    def architectures_are_concerned(self, pairs, allow_mixing_positive_and_negative=False):
+        # type: (Iterable[Tuple[str, Iterable[str]]], bool) -> List[bool]
+        """Batch version of architecture_is_concerned for (architecture, restrictions) pairs
+
+        Every distinct restriction list is compiled once to the bitset of the architectures it
+        accepts, so each pair costs a lookup.  Like architecture_is_concerned, this raises
+        ValueError or KeyError for the first pair that would raise them.
+
+        >>> arch_table = CompiledDpkgArchTable.load_arch_table()
+        >>> arch_table.architectures_are_concerned([("amd64", ["linux-any"]),
+        ...                                         ("amd64", ["!amd64"]),
+        ...                                         ("all", ["amd64"])])
+        [True, False, False]
+        """
+        arch_id_cache = {}  # type: Dict[str, Optional[int]]
+        compiled_cache = {}  # type: Dict[Tuple[str, ...], tuple]
+        results = []
+        for architecture, architecture_restrictions in pairs:
+            try:
+                arch_id = arch_id_cache[architecture]
+            except KeyError:
+                arch_id = arch_id_cache[architecture] = self._arch_ids.get(
+                    architecture[6:] if architecture.startswith("linux-") else architecture)
+            if arch_id is None:
+                results.append(False)
+                continue
+            restrictions = tuple(architecture_restrictions)
+            try:
+                compiled, concerned = compiled_cache[restrictions]
+            except KeyError:
+                compiled = self._compile_restrictions(restrictions)
+                concerned = self._concerned_bits(compiled, allow_mixing_positive_and_negative)
+                compiled_cache[restrictions] = compiled, concerned
+            if concerned is None:
+                results.append(self._is_concerned(arch_id, compiled,
+                                                  allow_mixing_positive_and_negative))
+            else:
+                results.append(bool(concerned >> arch_id & 1))
+        return results
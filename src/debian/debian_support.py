@@ -28,6 +28,7 @@ try:
         AnyStr,
         BinaryIO,
         Dict,
+        FrozenSet,
         Iterable,
         Iterator,
         Generator,
@@ -47,17 +48,51 @@ except ImportError:
 
 from debian.deprecation import function_deprecated_by
 
-try:
-    import apt_pkg
-    try:
-        apt_pkg.init()
-        _have_apt_pkg = True
-    except apt_pkg.Error:
-        # If dpkg (e.g., tupledata) is missing, we can import apt_pkg but .init()
-        # will raise an exception
-        _have_apt_pkg = False
-except ImportError:
-    _have_apt_pkg = False
+# apt_pkg is imported and initialized the first time a Version is needed, as
+# this is slow and most users of the module never compare versions.
+# None until then.
+_have_apt_pkg = None    # type: Optional[bool]
+
+
+def _load_apt_pkg():
+    # type: () -> bool
+    """Imports apt_pkg on first use, returns whether it is available"""
+    # pylint: disable=global-statement,import-outside-toplevel
+    global _have_apt_pkg, apt_pkg
+    if _have_apt_pkg is None:
+        try:
+            import apt_pkg
+            try:
+                apt_pkg.init()
+                _have_apt_pkg = True
+            except apt_pkg.Error:
+                # If dpkg (e.g., tupledata) is missing, we can import apt_pkg but .init()
+                # will raise an exception
+                _have_apt_pkg = False
+        except ImportError:
+            _have_apt_pkg = False
+    return _have_apt_pkg
+
+
+class _LazyPattern:
+    """Class attribute holding a regular expression compiled on first use"""
+
+    def __init__(self, pattern, flags=0):
+        # type: (AnyStr, int) -> None
+        self.pattern = pattern
+        self.flags = flags
+        self.name = None    # type: Optional[str]
+
+    def __set_name__(self, owner, name):
+        # type: (type, str) -> None
+        self.name = name
+
+    def __get__(self, instance, owner):
+        # type: (Any, type) -> Pattern
+        compiled = re.compile(self.pattern, self.flags)
+        # Replace the descriptor, later lookups find the compiled pattern
+        setattr(owner, self.name, compiled)    # type: ignore
+        return compiled
 
 # Use the built-in _sha extension instead of hashlib to avoid a dependency on
 # OpenSSL, which is incompatible with the GPL.
@@ -89,10 +124,16 @@ except ImportError:
             " incompatibilities")
 
 
-# Re-exports
-import debian._arch_table
-
-DpkgArchTable = debian._arch_table.DpkgArchTable
+def __getattr__(name):
+    # type: (str) -> Any
+    # Re-exports and the Version class are resolved on first use, so importing
+    # the module does not import apt_pkg and the architecture tables
+    if name == 'Version':
+        return _get_version_class()
+    if name in ('DpkgArchTable', 'CompiledDpkgArchTable'):
+        import debian._arch_table    # pylint: disable=import-outside-toplevel
+        return getattr(debian._arch_table, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 
 class ParseError(Exception):
@@ -281,7 +322,7 @@ class AptPkgVersion(BaseVersion):
 
     def __init__(self, version):
         # type: (Optional[Union[str, BaseVersion]]) -> None
-        if not _have_apt_pkg:
+        if not _load_apt_pkg():
             raise NotImplementedError("apt_pkg not available; install the "
                                       "python-apt package")
         super(AptPkgVersion, self).__init__(version)
@@ -388,18 +429,22 @@ class NativeVersion(BaseVersion):
         return 0
 
 
-if _have_apt_pkg:
-    class Version(AptPkgVersion):
-        pass
-else:
-    class Version(NativeVersion):      # type: ignore
-        pass
+def _get_version_class():
+    # type: () -> type
+    """Returns Version, defined on first use on top of apt_pkg when it is available"""
+    # pylint: disable=global-variable-undefined
+    global Version
+    if 'Version' not in globals():
+        base = AptPkgVersion if _load_apt_pkg() else NativeVersion
+        Version = type('Version', (base,), {'__module__': __name__, '__qualname__': 'Version'})
+    return Version
 
 
 def version_compare(a, b):
     # type: (Any, Any) -> int
-    va = Version(a)
-    vb = Version(b)
+    version_class = _get_version_class()
+    va = version_class(a)
+    vb = version_class(b)
     if va < vb:
         return -1
     if va > vb:
@@ -413,8 +458,8 @@ class PackageFile:
     Objects of this class can be used to read Debian's Source and
     Packages files."""
 
-    re_field = re.compile(r'^([A-Za-z][A-Za-z0-9-_]+):(?:\s*(.*?))?\s*$')
-    re_continuation = re.compile(r'^\s+(?:\.|(\S.*?)\s*)$')
+    re_field = _LazyPattern(r'^([A-Za-z][A-Za-z0-9-_]+):(?:\s*(.*?))?\s*$')
+    re_continuation = _LazyPattern(r'^\s+(?:\.|(\S.*?)\s*)$')
 
     def __init__(self,
                  name,              # type: str
@@ -489,6 +534,292 @@ class PackageFile:
     raiseSyntaxError = function_deprecated_by(raise_syntax_error)
 
 
+# Bytes accepted in field names by PackageFile.re_field ("9-_" is a range)
+_field_name_bytes = frozenset(
+    b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+    + bytes(range(ord('9'), ord('_') + 1)))
+# ASCII bytes matched by \s
+_whitespace_bytes = frozenset(b' \t\n\r\x0b\x0c')
+
+
+class MappedPackageFile:
+    """A Debian package file parsed from a bytes buffer.
+
+    This is a faster alternative to PackageFile for large Packages and
+    Sources indices.  The file is memory-mapped, stanzas are split on
+    blank lines and only the requested fields are decoded.  It yields the
+    same records as PackageFile and raises ParseError with the same line
+    numbers.
+
+    >>> pkgs = MappedPackageFile('Packages', data=b'Package: a\\nVersion: 1\\n')
+    >>> list(pkgs)
+    [[('Package', 'a'), ('Version', '1')]]
+    >>> pkgs.package_versions()
+    {'a': '1'}
+    """
+
+    re_name = _LazyPattern(rb'[A-Za-z][A-Za-z0-9-_]+\Z')
+    # field lines in the common form: letters, digits and "-" in the name,
+    # no field name character after the colon
+    _simple_field = rb'[A-Za-z][A-Za-z0-9-]+:(?![-0-9:;<=>?@A-Z\[\\\]^_a-z])'
+    re_simple_field = _LazyPattern(_simple_field)
+    # finds the newline in front of the first line that is not a simple
+    # field, a continuation line with text or a single empty line followed
+    # by a field
+    re_unusual_line = _LazyPattern(
+        rb'\n(?!\Z|[ \t][ \t\r\x0b\x0c]*\S|%s|\n(?:\Z|%s))'
+        % (_simple_field, _simple_field))
+
+    def __init__(self,
+                 name,              # type: str
+                 file_obj=None,     # type: Optional[BinaryIO]
+                 encoding="utf-8",  # type: str
+                 data=None,         # type: Optional[bytes]
+                 ):
+        # type: (...) -> None
+        """Creates a new package file object.
+
+        name - the name of the file the data comes from
+        file_obj - an alternate data source; the default is to open and
+                  memory-map the file with the indicated name.
+        data - a bytes-like object holding the file contents
+        """
+        self.name = name
+        self.encoding = encoding
+        self.lineno = 0
+        self._mmap = None
+        if data is None:
+            if file_obj is None:
+                with open(name, 'rb') as fh:
+                    data = self._map(fh)
+            else:
+                data = self._map(file_obj)
+        self.data = data
+
+    def _map(self, fh):
+        # type: (Any) -> Any
+        # pylint: disable=import-outside-toplevel
+        import mmap
+        try:
+            self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._mmap
+        except (AttributeError, ValueError, OSError):
+            # empty files, pipes and in-memory files cannot be mapped
+            data = fh.read()
+        if isinstance(data, bytes):
+            return data
+        return data.encode(self.encoding)
+
+    def close(self):
+        # type: () -> None
+        """Releases the memory-mapped file."""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self):
+        # type: () -> MappedPackageFile
+        return self
+
+    def __exit__(self, *args):
+        # type: (Any) -> None
+        self.close()
+
+    def __iter__(self):
+        # type: () -> Iterator[List[Tuple[str, str]]]
+        return self.iter_records()
+
+    def iter_records(self, fields=None):
+        # type: (Optional[Iterable[str]]) -> Iterator[List[Tuple[str, str]]]
+        """Yields the stanzas as lists of (field, contents) tuples.
+
+        fields - if given, only these fields are decoded and returned.
+                 The whole file is still checked for syntax errors.
+        """
+        wanted = None if fields is None \
+            else frozenset(f.encode('ascii') for f in fields)
+        buf = self.data
+        size = len(buf)
+        pos = 0
+        lineno = 0
+        # stanzas before the first unusual line are split on empty lines,
+        # from there on the file is parsed line by line
+        if size and not self.re_simple_field.match(buf):
+            unusual = -1
+        elif (match := self.re_unusual_line.search(buf)) is not None:
+            unusual = match.start()
+        else:
+            unusual = size
+        while pos < size:
+            end = buf.find(b'\n\n', pos)
+            end = size if end < 0 else end + 2
+            if end <= unusual:
+                stanza = buf[pos:end]
+                yield self._split_record(stanza, wanted)
+                lineno += stanza.count(b'\n')
+                self.lineno = lineno
+            else:
+                for record in self._iter_lines(pos, end, lineno, wanted):
+                    yield record
+                lineno = self.lineno
+                if (match := self.re_unusual_line.search(buf, end - 2)) is not None:
+                    unusual = match.start()
+                else:
+                    unusual = size
+            pos = end
+
+    def _split_record(self, stanza, wanted):
+        # type: (bytes, Optional[FrozenSet[bytes]]) -> List[Tuple[str, str]]
+        """Returns the fields of a stanza in the common form."""
+        if wanted is None:
+            return self._split_lines(stanza)
+        colon = stanza.find(b':')
+        starts = [0] if stanza[:colon] in wanted else []
+        for name in wanted:
+            start = 0
+            while (start := stanza.find(b'\n' + name + b':', start) + 1) > 0:
+                starts.append(start)
+        starts.sort()
+        record = []
+        for start in starts:
+            colon = stanza.find(b':', start)
+            name = stanza[start:colon].decode('ascii')
+            eol = stanza.find(b'\n', colon)
+            if eol < 0:
+                eol = len(stanza)
+            parts = [stanza[colon + 1:eol].decode(self.encoding).strip()]
+            # continuation lines
+            while stanza[eol + 1:eol + 2] in (b' ', b'\t'):
+                start = eol + 1
+                eol = stanza.find(b'\n', start)
+                if eol < 0:
+                    eol = len(stanza)
+                line = stanza[start:eol]
+                if line.lstrip() == b'.':
+                    parts.append('')
+                else:
+                    parts.append(line.decode(self.encoding).strip())
+            record.append((name, "\n".join(parts)))
+        return record
+
+    def _split_lines(self, stanza):
+        # type: (bytes) -> List[Tuple[str, str]]
+        """Returns all fields of a stanza in the common form."""
+        record = []     # type: List[Tuple[str, str]]
+        parts = []      # type: List[str]
+        for line in stanza.split(b'\n'):
+            if not line:
+                continue
+            if line[0] in (32, 9):
+                if line.lstrip() == b'.':
+                    parts.append('')
+                else:
+                    parts.append(line.decode(self.encoding).strip())
+                continue
+            if parts:
+                record[-1] = (record[-1][0], "\n".join([record[-1][1]] + parts))
+                parts = []
+            (name, contents) = line.split(b':', 1)
+            record.append((name.decode('ascii'), contents.decode(self.encoding).strip()))
+        if parts:
+            record[-1] = (record[-1][0], "\n".join([record[-1][1]] + parts))
+        return record
+
+    def _iter_lines(self, pos, size, lineno, wanted):
+        # type: (int, int, int, Optional[FrozenSet[bytes]]) -> Iterator[List[Tuple[str, str]]]
+        """Parses buf[pos:size] line by line, with the PackageFile rules."""
+        buf = self.data
+        encoding = self.encoding
+        name_bytes = _field_name_bytes
+        record = []     # type: List[Tuple[str, str]]
+        in_record = False
+        # lines of the current field: None outside of a field, False if
+        # the field is not wanted
+        parts = None    # type: Any
+        field = ''
+
+        while pos < size:
+            eol = buf.find(b'\n', pos, size)
+            if eol < 0:
+                eol = next_pos = size
+            else:
+                next_pos = eol + 1
+            lineno += 1
+            self.lineno = lineno
+            first = buf[pos] if pos < eol else 10
+
+            if first in _whitespace_bytes:
+                line = buf[pos:eol]
+                if not line.strip(b' \t') and eol < size:
+                    # blank line: end of record
+                    if parts:
+                        record.append((field, "\n".join(parts)))
+                    parts = None
+                    if not in_record:
+                        self.raise_syntax_error('expected package record')
+                    yield record
+                    record = []
+                    in_record = False
+                    pos = next_pos
+                    continue
+                if parts is not None and line.strip():
+                    # continuation line
+                    if parts is not False:
+                        if line.lstrip() == b'.':
+                            parts.append('')
+                        else:
+                            parts.append(line.decode(encoding).strip())
+                    pos = next_pos
+                    continue
+                self.raise_syntax_error("expected package field")
+
+            if parts:
+                record.append((field, "\n".join(parts)))
+            colon = buf.find(b':', pos, eol)
+            name = buf[pos:colon]
+            if colon < 0 or (colon + 1 < eol and buf[colon + 1] in name_bytes) \
+                    or not self.re_name.match(name):
+                # unusual field line, leave it to the PackageFile regex
+                match = PackageFile.re_field.match(buf[pos:next_pos].decode(encoding))
+                if not match:
+                    self.raise_syntax_error("expected package field")
+                (field, contents) = match.groups()
+                contents = contents or ''
+                name = field.encode(encoding)
+                colon = -1
+
+            in_record = True
+            if wanted is None or name in wanted:
+                if colon >= 0:
+                    field = name.decode('ascii')
+                    contents = buf[colon + 1:eol].decode(encoding).strip()
+                parts = [contents]
+            else:
+                parts = False
+            pos = next_pos
+
+        if parts:
+            record.append((field, "\n".join(parts)))
+        if in_record:
+            yield record
+
+    def package_versions(self):
+        # type: () -> Dict[str, str]
+        """Returns the {Package: Version} projection of the file."""
+        versions = {}
+        for record in self.iter_records(('Package', 'Version')):
+            fields = dict(record)
+            if 'Package' in fields and 'Version' in fields:
+                versions[fields['Package']] = fields['Version']
+        return versions
+
+    def raise_syntax_error(self, msg, lineno=None):
+        # type: (str, Optional[int]) -> NoReturn
+        if lineno is None:
+            lineno = self.lineno
+        raise ParseError(self.name, lineno, msg)
+
+
 class PseudoEnum:
     """A base class for types which resemble enumeration types."""
     def __init__(self,
@@ -591,12 +922,17 @@ def list_releases():
 
 listReleases = function_deprecated_by(list_releases)
 
-_release_list = list_releases()
+# Built by the first intern_release call
+_release_list = None    # type: Optional[Dict[str, Release]]
+_list_releases = list_releases
 
 
 def intern_release(name, releases=None):
     # type: (str, Optional[Any]) -> Any
+    global _release_list    # pylint: disable=global-statement
     if releases is None:
+        if _release_list is None:
+            _release_list = _list_releases()
         releases = _release_list
     return releases.get(name)
 
@@ -633,9 +969,11 @@ def read_lines_sha1(lines):
 readLinesSHA1 = function_deprecated_by(read_lines_sha1)
 
 
-_patch_re_raw = r'^(\d+)(?:,(\d+))?([acd])$'
+_patch_re_raw = r'^(\d+|\$)(?:,(\d+|\$))?([acd])$'
 _patch_re = re.compile(_patch_re_raw)  # type: Pattern[str]
 _patch_re_b = re.compile(_patch_re_raw.encode('UTF-8'))   # type: Pattern[bytes]
+# slice bound past the last line of any file, for the "$" address
+_past_end = 1 << 62
 
 
 def patches_from_ed_script(
@@ -652,7 +990,8 @@ def patches_from_ed_script(
     - list of line replacements
 
     This is enough to model arbitrary additions, deletions and
-    replacements.
+    replacements.  The "$" address (the last line) starts a slice at -1
+    and ends it past the end of the file.
     """
 
     i = iter(source)
@@ -668,25 +1007,22 @@ def patches_from_ed_script(
             raise ValueError("invalid patch command: %r" % line)
 
         (first_, last_, cmd) = match.groups()
-        first = int(first_)
-        last = None if last_ is None else int(last_)
+        dollar = first_ in ('$', b'$')
+        first = -1 if dollar else int(first_) - 1
+        if last_ is None:
+            last = _past_end if dollar else first + 1
+        else:
+            last = _past_end if last_ in ('$', b'$') else int(last_)
 
         # using ord() makes this work for str and bytes objects
         if ord(cmd) == 100: # cmd == d
-            first = first - 1
-            if last is None:
-                last = first + 1
             yield (first, last, [])
             continue
 
         if ord(cmd) == 97: # cmd == a
-            if last is not None:
+            if last_ is not None:
                 raise ValueError("invalid patch argument: %r" % line)
-            last = first
-        else:                           # cmd == c
-            first = first - 1
-            if last is None:
-                last = first + 1
+            first = last = _past_end if dollar else first + 1
 
         lines = []
         for c in i:
@@ -713,6 +1049,138 @@ def patch_lines(
 patchLines = function_deprecated_by(patch_lines)
 
 
+def compose_patches(
+        patches,      # type: Iterable[Iterable[Tuple[int, int, List[AnyStr]]]]
+        size,         # type: int
+    ):
+    # type: (...) -> List[Tuple[int, int, List[AnyStr]]]
+    """Folds a sequence of patches into one edit list.
+
+    patches - patch streams (e.g. from patches_from_ed_script), in the
+              order patch_lines would apply them
+    size - number of lines of the file the patches apply to
+
+    Returns ascending, non-overlapping (first, last, lines) edits of the
+    original file.  iter_patched_lines applies them in a single pass with
+    the same result as applying every patch with patch_lines.
+
+    The patched file is kept as a list of pieces: (start, end) ranges of
+    original lines or lists of new lines.  Hunks in descending order (as
+    written by diff -e) all refer to the same version of the file and are
+    applied together in one pass over the pieces.
+    """
+    pieces = [(0, size)] if size > 0 else []   # type: List[Any]
+    lengths = [size] if size > 0 else []       # type: List[int]
+    length = size
+    for patch in patches:
+        run = []     # type: List[Tuple[int, int, List[AnyStr]]]
+        for (first, last, lines) in patch:
+            # the slice bounds of lines[first:last] = ...
+            first = min(max(first + length if first < 0 else first, 0), length)
+            last = max(min(max(last + length if last < 0 else last, 0), length), first)
+            if run and last > run[-1][0]:
+                pieces, lengths = _edit_pieces(pieces, lengths, run[::-1])
+                run = []
+            run.append((first, last, lines))
+            length += len(lines) - (last - first)
+        if run:
+            pieces, lengths = _edit_pieces(pieces, lengths, run[::-1])
+
+    edits = []
+    cursor = 0
+    pending = []    # type: List[AnyStr]
+    for piece in pieces:
+        if isinstance(piece, tuple):
+            if piece[0] > cursor or pending:
+                edits.append((cursor, piece[0], pending))
+                pending = []
+            cursor = piece[1]
+        else:
+            pending.extend(piece)
+    if cursor < size or pending:
+        edits.append((cursor, size, pending))
+    return edits
+
+
+def _edit_pieces(
+        pieces,       # type: List[Any]
+        lengths,      # type: List[int]
+        edits,        # type: List[Tuple[int, int, List[AnyStr]]]
+    ):
+    # type: (...) -> Tuple[List[Any], List[int]]
+    """Returns the pieces and their lengths with ascending edits of one
+    version applied.  Unchanged pieces are copied in slices."""
+    # pylint: disable=import-outside-toplevel
+    from bisect import bisect_right
+    from itertools import accumulate
+
+    starts = list(accumulate(lengths, initial=0))
+    count = len(pieces)
+    out = []            # type: List[Any]
+    out_lengths = []    # type: List[int]
+    # everything in front of line offset of piece index has been copied
+    index = 0
+    offset = 0
+    for (first, last, lines) in edits:
+        piece = bisect_right(starts, first) - 1
+        if piece > index:
+            if offset:
+                out.append(_piece_slice(pieces[index], offset, None))
+                out_lengths.append(lengths[index] - offset)
+                index += 1
+                offset = 0
+            out.extend(pieces[index:piece])
+            out_lengths.extend(lengths[index:piece])
+            index = piece
+        if piece < count and first - starts[piece] > offset:
+            out.append(_piece_slice(pieces[piece], offset, first - starts[piece]))
+            out_lengths.append(first - starts[piece] - offset)
+        if lines:
+            out.append(list(lines))
+            out_lengths.append(len(lines))
+        index = bisect_right(starts, last) - 1
+        offset = last - starts[index] if index < count else 0
+    if index < count:
+        if offset:
+            out.append(_piece_slice(pieces[index], offset, None))
+            out_lengths.append(lengths[index] - offset)
+            index += 1
+        out.extend(pieces[index:])
+        out_lengths.extend(lengths[index:])
+    return out, out_lengths
+
+
+def _piece_slice(piece, start, end):
+    # type: (Any, int, Optional[int]) -> Any
+    if isinstance(piece, tuple):
+        lines = range(*piece)[start:end]
+        return (lines.start, lines.stop)
+    return piece[start:end]
+
+
+def iter_patched_lines(
+        source,       # type: Iterable[AnyStr]
+        edits,        # type: Iterable[Tuple[int, int, List[AnyStr]]]
+    ):
+    # type: (...) -> Iterator[AnyStr]
+    """Yields the lines of source with edits from compose_patches applied.
+
+    The source is read once, e.g. line by line from a file.
+    """
+    # pylint: disable=import-outside-toplevel
+    from itertools import islice
+
+    it = iter(source)
+    lineno = 0
+    for (first, last, lines) in edits:
+        yield from islice(it, first - lineno)
+        for _ in islice(it, last - first):
+            pass
+        yield from lines
+        lineno = last
+    yield from it
+
+
 def replace_file(lines, local, encoding="UTF-8"):
     # type: (List[str], str, str) -> None
     local_new = local + '.new'
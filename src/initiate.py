@@ -7,43 +7,100 @@ invokes list_instances to validate compliance of all servers against compliant S
 import os
 import json
 import time
-import logging
+import uuid
 from datetime import datetime
 
-from threading import Thread
-
 from utils.helpers import ( get_client,
-    check_instance_status,
-    get_instance_inventory,
-    terminate_instance,
     publish_event,
-    check_association_status)
-
-default_log_args = {
-    "level": logging.INFO,
-    "format": "%(asctime)s [%(levelname)s] %(filename)s-%(lineno)d %(message)s",
-    "datefmt": "%Y-%m-%d %H:%M:%S",
-    "force": True,
-}
-
-logging.basicConfig(**default_log_args)
-log = logging.getLogger()
+    publish_sqs_message)
+from utils.baseline_builder import BaselineBuilder
+from utils.compliance import baseline_id, baseline_key, diff_baselines
+from utils.config import BUILD_POLL_SECONDS, CONTINUATION_QUEUE_URL
+from utils.deadline import TimeBudget
+from utils.logs import Message, Payload, configure_logging
+from utils.metrics import emit_metrics, timed
+from utils.store import get_store
+from utils.wire import decode_packages, encode_packages
+
+log = configure_logging()
+
+# seconds a run checkpoint is kept for its continuation
+CHECKPOINT_TTL = 86400
+
+# baseline_source selects how baselines are built, see utils.baseline_sources.
+# "instance" boots the AMI, "manifest" reads the package manifest of the AMI,
+# "packages-index" reads the index_suites of a mirror
+IMAGE_DETAILS = [
+    {
+        "image_name": "ubuntu/images/hvm-ssd/ubuntu-jammy-22.04-amd64-server*",
+        "image_owner": "099720109477",
+        "baseline_source": "instance",
+        "platform_name": "Ubuntu",
+        "platform_version": "22.04",
+        "index_suites": ["jammy-updates", "jammy-security"]
+    },
+    {
+        "image_name": "ubuntu/images/hvm-ssd/ubuntu-focal-20.04-amd64-server*",
+        "image_owner": "099720109477",
+        "baseline_source": "instance",
+        "platform_name": "Ubuntu",
+        "platform_version": "20.04",
+        "index_suites": ["focal-updates", "focal-security"]
+    },
+    {
+        "image_name": "ubuntu/images/hvm-ssd/ubuntu-bionic-18.04-amd64-server*",
+        "image_owner": "099720109477",
+        "baseline_source": "instance",
+        "platform_name": "Ubuntu",
+        "platform_version": "18.04",
+        "index_suites": ["bionic-updates", "bionic-security"]
+    },
+    {
+        "image_name": "amzn-ami-hvm-2018.03*",
+        "image_owner": "137112412989",
+        "baseline_source": "instance",
+        "platform_name": "Amazon Linux AMI",
+        "platform_version": "2018.03"
+    },
+    {
+        "image_name": "amzn2-ami-hvm-2.0*",
+        "image_owner": "137112412989",
+        "baseline_source": "instance",
+        "platform_name": "Amazon Linux",
+        "platform_version": "2"
+    }
+]
 
 
+@emit_metrics
 def lambda_handler(event, context):
     '''Initializing lambda handler'''
-    del context
-    log.info(f"Event - {json.dumps(event, default=str)}")
+    log.info(Message("Event - {}", Payload(event)))
 
     # gather details to create a server
     sg_id = os.environ.get('SG_ID','')
     subnet_id = os.environ.get('SUBNET_ID', '')
     iam_profile_arn = os.environ.get('IAM_PROFILE_ARN', '')
 
-    scan_type = event.get('SCAN_TYPE','n-1')
-
-    app = CompliantServer(sg_id, subnet_id, iam_profile_arn, scan_type)
-    app.run()
+    # runs are only split over several invocations when they can be continued
+    budget = TimeBudget(context if CONTINUATION_QUEUE_URL else None)
+
+    if 'Records' in event:
+        # continuations of runs that ran out of time, from CONTINUATION_QUEUE_URL
+        for record in event['Records']:
+            app = CompliantServer.resume(json.loads(record['body']),
+                sg_id, subnet_id, iam_profile_arn, budget)
+            if app is not None:
+                app.run()
+    else:
+        # baselines to build in this run, the first one is reported as CompliancePercentage
+        scan_types = event.get('SCAN_TYPES', [event.get('SCAN_TYPE','n-1')])
+        # only a stratified sample of the instances is validated, see utils.sampling
+        sampling = event.get('SAMPLING')
+
+        app = CompliantServer(sg_id, subnet_id, iam_profile_arn, scan_types, budget,
+            sampling=sampling)
+        app.run()
 
     return {
         'statusCode' : 200,
@@ -51,165 +108,276 @@ def lambda_handler(event, context):
     }
 
 
-class CompliantServer():
+class CompliantServer(): # pylint: disable=too-many-instance-attributes
     '''Creates compliant server based on the AMI configuration and
     fetches the inventory for said server'''
 
-    def __init__(self, sg_id, subnet_id, iam_profile_arn, scan_type):
+    def __init__(self, sg_id, subnet_id, iam_profile_arn, scan_types, budget=None, *,
+            sampling=None):
         self.sg_id = sg_id
         self.subnet_id = subnet_id
         self.iam_profile_arn = iam_profile_arn
 
-        self.scan_type = scan_type
+        self.scan_types = scan_types
+        self.sampling = sampling
         self.scan_time = datetime.now()
         self.instance_details = {}
 
+        self.budget = budget or TimeBudget()
+        # progress of a run split over several invocations. None means everything is pending
+        self.run_id = uuid.uuid4().hex
+        self.step = 0
+        self.pending = {'Images': None, 'Accounts': None, 'Builds': {}}
+        # {image name: scan types} not built before the deadline
+        self.unfinished = {}
+
+    @classmethod
+    def resume(cls, message, sg_id, subnet_id, iam_profile_arn, budget):
+        '''returns the run checkpointed for a continuation message, or None when
+        the message was already handled'''
+        state = get_store().get(f"initiate-run#{message['RunId']}")
+        if state is None or state['Step'] != message['Step']:
+            log.info(f"Run {message['RunId']} step {message['Step']} was already continued")
+            return None
+
+        app = cls(sg_id, subnet_id, iam_profile_arn, state['ScanTypes'], budget,
+            sampling=state.get('Sampling'))
+        app.run_id = message['RunId']
+        app.step = state['Step']
+        app.scan_time = state['ScanTime']
+        app.instance_details = state['InstanceDetails']
+        app.pending = {'Images': state['PendingImages'], 'Accounts': state['PendingAccounts'],
+            'Builds': state.get('Builds', {})}
+        log.info(f"Continuing run {app.run_id} step {app.step} - \
+            {len(state['PendingImages'] or IMAGE_DETAILS)} images, \
+            {len(app.pending['Builds'])} compliant servers, \
+            {'all' if state['PendingAccounts'] is None else len(state['PendingAccounts'])} \
+            accounts")
+        return app
+
+    @timed('checkpoint')
+    def checkpoint(self, pending_images, pending_accounts, builds=None, delay=0):
+        '''stores the progress of the run and queues its continuation in delay seconds'''
+        self.step += 1
+        get_store().put(f"initiate-run#{self.run_id}", {
+            'Step': self.step,
+            'ScanTypes': self.scan_types,
+            'Sampling': self.sampling,
+            'ScanTime': self.scan_time,
+            'InstanceDetails': self.instance_details,
+            'PendingImages': pending_images,
+            'PendingAccounts': pending_accounts,
+            'Builds': builds or {}
+        }, ttl=CHECKPOINT_TTL)
+        publish_sqs_message(get_client('sqs'), CONTINUATION_QUEUE_URL,
+            {'RunId': self.run_id, 'Step': self.step}, delay)
+        log.info(f"Run {self.run_id} continues in step {self.step} in {delay} seconds with \
+            {len(pending_images)} images, {len(builds or {})} compliant servers and \
+            {'all' if pending_accounts is None else len(pending_accounts)} accounts")
+
     def run(self):
         '''orchestrate the application'''
-        thread_list = []
         # ami_ids = []
         ec2 = get_client('ec2')
         ssm = get_client('ssm')
         events = get_client('events')
 
-        image_details = [
-            {
-                "image_name": "ubuntu/images/hvm-ssd/ubuntu-jammy-22.04-amd64-server*",
-                "image_owner": "099720109477"
-            },
-            {
-                "image_name": "ubuntu/images/hvm-ssd/ubuntu-focal-20.04-amd64-server*",
-                "image_owner": "099720109477"
-            },
-            {
-                "image_name": "ubuntu/images/hvm-ssd/ubuntu-bionic-18.04-amd64-server*",
-                "image_owner": "099720109477"
-            },
-            {
-                "image_name": "amzn-ami-hvm-2018.03*",
-                "image_owner": "137112412989"
-            },
-            {
-                "image_name": "amzn2-ami-hvm-2.0*",
-                "image_owner": "137112412989"
-            }
-        ]
-
-        for image in image_details:
-            image_id = self.get_second_latest_ami(ec2, image['image_name'], image['image_owner'])
-            log.info(f"Ami Id for {image['image_name']} - {image_id}")
-            # ami_ids.append(image_id)
-            # for ami_id in ami_ids:
-            thread = Thread(target=self.get_compliant_inventory, args=(image_id, ec2, ssm, ))
-            thread.start()
-            thread_list.append(thread)
-
-        for thread in thread_list:
-            thread.join()
+        # with a continuation queue the compliant servers are checked again by a later
+        # invocation instead of waiting for them in this one
+        if not self.build_baselines(ec2, ssm, wait=not CONTINUATION_QUEUE_URL):
+            return
 
         if not self.instance_details:
             log.info("No complaint details captured. Exiting...")
+        elif not self.publish_accounts(events):
             return
 
+        if self.step:
+            # the run is complete, its checkpoint is no longer needed
+            get_store().delete(f"initiate-run#{self.run_id}")
+
+    def build_baselines(self, ec2, ssm, wait=True):
+        '''builds the baselines of the pending images into instance_details.
+        Without wait, or when the budget runs out, the run is checkpointed
+        and False is returned'''
+        builder = BaselineBuilder(ec2, ssm, self.pending['Builds'])
+        instance_options = {
+            'sg_id': self.sg_id,
+            'subnet_id': self.subnet_id,
+            'iam_profile_arn': self.iam_profile_arn
+        }
+
+        if (pending := self.pending['Images']) is None:
+            pending = {image['image_name']: self.scan_types for image in IMAGE_DETAILS}
+
+        for image in IMAGE_DETAILS:
+            if not (scan_types := pending.get(image['image_name'])):
+                continue
+            if image.get('baseline_source', 'instance') != 'instance' \
+                    and self.get_source_baseline(ec2, image):
+                continue
+            if not self.budget.allows():
+                self.unfinished[image['image_name']] = scan_types
+                continue
+            for image_id, ami_scan_types in self.get_scan_types_per_ami(ec2, image).items():
+                if ami_scan_types := [scan_type for scan_type in ami_scan_types \
+                        if scan_type in scan_types]:
+                    builder.launch(image, image_id, ami_scan_types, instance_options)
+
+        while not builder.advance(self.budget) and wait:
+            log.info(f"{builder.pending()} compliant servers are not captured yet. \
+                Sleeping for {BUILD_POLL_SECONDS} seconds")
+            time.sleep(BUILD_POLL_SECONDS)
+
+        for instance_id, build in builder.pop_captured():
+            for scan_type in build['ScanTypes']:
+                self.instance_details[f"{instance_id}#{scan_type}"] = dict(build['Detail'],
+                    ComplaintPackages=decode_packages(build['ComplaintPackages']),
+                    ScanType=scan_type)
+
+        store = get_store()
         for instance in self.instance_details.values():
-            instance['ScanType'] = self.scan_type
-            instance['ScanTime'] = self.scan_time
-
+            # baselines of earlier steps are already complete
+            if 'BaselineId' not in instance:
+                instance['ScanTypes'] = self.scan_types
+                instance['ScanTime'] = self.scan_time
+                # identifies the scan in every event, message and finding, duplicate
+                # deliveries of its work are skipped
+                instance['ScanId'] = self.run_id
+                self.add_baseline_diff(instance, store)
+
+        if self.unfinished or builder.pending():
+            self.checkpoint(self.unfinished, self.pending['Accounts'], builder.builds,
+                BUILD_POLL_SECONDS if builder.pending() else 0)
+            return False
+        return True
+
+    def publish_accounts(self, events):
+        '''sends the baselines to list_instances for every pending account.
+        Returns False when the run was checkpointed before all were sent'''
         with open('accounts.json', 'r', encoding='utf8') as file:
             account_list = json.loads(file.read())
 
-        for account in account_list['account_detail']:
-            entries = []
-            compliant_event ={
-                'instance_details' : self.instance_details,
-                'account_details' : account
+        accounts = [account for account in account_list['account_detail'] \
+            if self.pending['Accounts'] is None or account['Id'] in self.pending['Accounts']]
+        for index, account in enumerate(accounts):
+            if not self.budget.allows():
+                self.checkpoint({}, [account['Id'] for account in accounts[index:]])
+                return False
+
+            with self.budget.unit():
+                self.publish_account(account, events)
+        return True
+
+    @timed('publish_accounts')
+    def publish_account(self, account, events):
+        '''sends the baselines to list_instances for one account'''
+        entries = []
+        compliant_event ={
+            'instance_details' : self.instance_details,
+            'account_details' : account
+        }
+        if self.sampling:
+            compliant_event['sampling'] = self.sampling
+
+        entry = {
+            'Time': datetime.now(),
+            'Source': 'patchInspect',
+            'Detail': json.dumps(compliant_event, default=str),
+            'DetailType': 'listInstances',
+            'EventBusName': 'default'
+        }
+        entries.append(entry)
+
+        publish_event(entries, events)
+        log.info(f"Published instance details for account - {account['Name']}")
+
+    @timed('baseline_diff')
+    def add_baseline_diff(self, instance, store):
+        '''compares the captured baseline with the previous baseline of the platform
+        so that cached inventories only need the changed packages re-evaluated'''
+        key = baseline_key(instance['PlatformName'], instance['PlatformVersion'],
+            instance['ScanType'])
+        packages = instance['ComplaintPackages']
+        instance['BaselineId'] = baseline_id(packages)
+        # baselines travel compact encoded in events, messages and the store
+        instance['ComplaintPackages'] = encode_packages(packages)
+
+        previous = store.get(key)
+        if previous is not None and previous['BaselineId'] != instance['BaselineId']:
+            instance['PreviousBaselineId'] = previous['BaselineId']
+            instance['BaselineDiff'] = diff_baselines(
+                decode_packages(previous['ComplaintPackages']), packages)
+            log.info(f"{len(instance['BaselineDiff'])} packages changed for \
+                {instance['PlatformName']} {instance['PlatformVersion']} since \
+                baseline {previous['BaselineId']}")
+
+        store.put(key, {
+            'BaselineId': instance['BaselineId'],
+            'ComplaintPackages': instance['ComplaintPackages']
+        })
+
+    @timed('source_baseline')
+    def get_source_baseline(self, ec2, image):
+        '''builds the baseline of every scan type from the baseline source of the image
+        instead of a compliant server. Returns False when the source has no baseline'''
+        try:
+            baselines = self.get_source_packages(ec2, image)
+        except (OSError, ValueError) as err:
+            log.error(f"No {image['baseline_source']} baseline for {image['image_name']}, \
+                using a compliant server - {err}")
+            return False
+
+        source_id = ':'.join([image['baseline_source'], image['platform_name'],
+            image['platform_version']])
+        for scan_type, (ami_id, complaint_packages) in baselines.items():
+            detail = {
+                'PlatformName': image['platform_name'],
+                'PlatformVersion': image['platform_version'],
+                'BaselineSource': image['baseline_source'],
+                # package sources only describe Linux distributions
+                'PlatformType': 'Linux',
+                'ComplaintPackages': complaint_packages,
+                'ScanType': scan_type
             }
-
-            entry = {
-                'Time': datetime.now(),
-                'Source': 'patchInspect',
-                'Detail': json.dumps(compliant_event, default=str),
-                'DetailType': 'listInstances',
-                'EventBusName': 'default'
-            }
-            entries.append(entry)
-
-            publish_event(entries, events)
-            log.info(f"Published instance details for account - {account['Name']}")
-
-
-    def get_compliant_inventory(self, ami_id, ec2, ssm):
-        '''creates compliant server and returns once SSM is up'''
-        instance_detail = self.create_compliant_instance(ami_id, ec2, ssm)
-        log.info("Created the compliant server with the specified AMI. \
-            Sleeping for 5 seconds before fetching inventory...")
-        time.sleep(5)
-
-        complaint_inventory = get_instance_inventory(instance_detail['InstanceId'], ssm)
-
-        complaint_packages = {}
-        for app_entry in complaint_inventory['Entries']:
-            app_name = app_entry['Name']
-            complaint_packages[app_name] = app_entry['Version']
-
-        terminate_instance(instance_detail['InstanceId'], ec2)
-        instance_detail['ComplaintPackages'] = complaint_packages
-
-        # put_dynamo_db_item(PATCH_INSPECT_TABLE_NAME, complaint_inventory, dynamodb)
-        # log.info(f"Created an item for compliant server in table {PATCH_INSPECT_TABLE_NAME}.")
-
-        self.instance_details[instance_detail['InstanceId']] = instance_detail
-
-    def create_compliant_instance(self, ami_id, ec2, ssm):
-        '''creates a EC2 instance using n-1 AMI of the OS'''
-
-        response = ec2.run_instances(
-            ImageId=ami_id,
-            InstanceType='t2.micro',
-            MaxCount=1,
-            MinCount=1,
-            Monitoring={
-                'Enabled': False
-            },
-            SecurityGroupIds=[
-                self.sg_id,
-            ],
-            SubnetId=self.subnet_id,
-            IamInstanceProfile={
-                'Arn': self.iam_profile_arn
-            },
-            TagSpecifications=[
-                {
-                    'ResourceType': 'instance',
-                    'Tags': [
-                        {
-                            'Key': 'Name',
-                            'Value': 'patchInspect-compliant-server'
-                        }
-                    ]
-                }
-            ],
-            MetadataOptions= {
-                'HttpTokens': 'required'
-            }
-        )
-
-        instance_id = response['Instances'][0]['InstanceId']
-        log.info(f"Created EC2 Instance {instance_id}. \
-        Sleeping for 30 seconds before checking SSM status")
-
-        # waiting for 30 to boot up the server
-        time.sleep(30)
-        while True:
-            if (status := check_instance_status(instance_id, ssm)) is None:
-                log.info("Instance Ping Status in SSM is not 'Online'. Sleeping for 30 seconds")
-                time.sleep(30)
-                continue
-            if check_association_status(instance_id, ssm):
-                return status
-
-    def get_second_latest_ami(self, ec2, image_name, image_owner):
-        '''returns desired AMI Id for the specified image configurations'''
+            if ami_id:
+                detail['ImageId'] = ami_id
+            self.instance_details[f"{source_id}#{scan_type}"] = detail
+        return True
+
+    def get_source_packages(self, ec2, image):
+        '''returns {scan type: (AMI Id or None, compliant packages)} read from the
+        baseline source of the image'''
+        # package index parsing and mirror updates are only loaded for images using them
+        # pylint: disable-next=import-outside-toplevel
+        from utils.baseline_sources import get_baseline_source
+        source = get_baseline_source(image['baseline_source'], get_store())
+        if source.per_ami:
+            amis = self.get_desired_amis(ec2, image['image_name'], image['image_owner'])
+        else:
+            amis = dict.fromkeys(self.scan_types)
+
+        packages = {}
+        baselines = {}
+        for scan_type, ami in amis.items():
+            if (ami_id := ami['ImageId'] if ami else None) not in packages:
+                packages[ami_id] = source.get_baseline(image, ami)
+            baselines[scan_type] = (ami_id, packages[ami_id])
+        return baselines
+
+    def get_scan_types_per_ami(self, ec2, image):
+        '''returns {AMI Id: scan types}. Scan types resolving to the same AMI
+        share one compliant server'''
+        scan_types_per_ami = {}
+        desired_amis = self.get_desired_amis(ec2, image['image_name'], image['image_owner'])
+        for scan_type, ami in desired_amis.items():
+            log.info(f"Ami Id for {image['image_name']} ({scan_type}) - {ami['ImageId']}")
+            scan_types_per_ami.setdefault(ami['ImageId'], []).append(scan_type)
+        return scan_types_per_ami
+
+    @timed('describe_images')
+    def get_desired_amis(self, ec2, image_name, image_owner):
+        '''returns {scan type: AMI} for the specified image configurations'''
         response = ec2.describe_images(
             Filters=[
                 {
@@ -259,7 +427,6 @@ class CompliantServer():
 
         today = datetime.now()
 
-        desired = int(self.scan_type[-1])
         days_list = []
 
         for image in response['Images']:
@@ -267,11 +434,14 @@ class CompliantServer():
             days_list.append(diff)
             image['diff'] = diff
 
-        desired_image = ""
-
         days_list.sort()
-        for image in response['Images']:
-            if image['diff'] == days_list[desired]:
-                desired_image = image['ImageId']
-                break
-        return desired_image
+        desired_amis = {}
+        for scan_type in self.scan_types:
+            desired = int(scan_type[-1])
+            desired_image = {'ImageId': ""}
+            for image in response['Images']:
+                if image['diff'] == days_list[desired]:
+                    desired_image = image
+                    break
+            desired_amis[scan_type] = desired_image
+        return desired_amis
@@ -5,81 +5,347 @@ gathers list of all instances in a account across all regions
 
 import json
 import time
-import logging
+import random
+from collections import Counter
+from datetime import datetime
 
-from threading import Thread
+from threading import Lock, Thread
 # from concurrent.futures import ThreadPoolExecutor
-from botocore.exceptions import ClientError
 
-from utils.config import QUEUE_URL, REGION_USED
+from utils.config import (DENIED_REGION_TTL, EMPTY_REGION_TTL, INLINE_THRESHOLD,
+    INVENTORY_PAGES_PER_INSTANCE, LIST_CONTINUATION_QUEUE_URL, PACING_HEADROOM, QUEUE_URL,
+    REGION_CACHE_TTL, REGION_USED, SCAN_REGIONS, SSM_INVENTORY_RATE, VALIDATE_CONCURRENCY,
+    VALIDATE_INSTANCE_SECONDS)
+from utils.deadline import DeadlineExceeded, TimeBudget
 from utils.helpers import (publish_sqs_message,
+    publish_event,
     get_client)
+from utils.logs import Message, Payload, configure_logging
+from utils.metrics import emit_metrics, stage, timed
+from utils.sampling import draw
+from utils.serialization import BASELINE_FIELDS, PayloadTemplate, PayloadTooLarge
+from utils.store import acquire, complete, get_store, release, scan_key
 
-default_log_args = {
-    "level": logging.INFO,
-    "format": "%(asctime)s [%(levelname)s] %(filename)s-%(lineno)d %(message)s",
-    "datefmt": "%Y-%m-%d %H:%M:%S",
-    "force": True,
-}
+log = configure_logging()
 
-logging.basicConfig(**default_log_args)
-log = logging.getLogger()
+# time needed to list and publish the instances of a region
+REGION_SECONDS = 60
+# seconds between starting two regions, spreading the assume role and SSM calls
+REGION_STAGGER_SECONDS = 2
+# longest DelaySeconds SQS accepts
+MAX_DELAY_SECONDS = 900
+# largest page of describe_instance_information
+PAGE_SIZE = 50
+# error codes of throttled calls, retried with backoff up to LIST_ATTEMPTS times.
+# Other errors (access denied, region not enabled, ...) are not retried
+THROTTLE_CODES = {'ThrottlingException', 'Throttling', 'TooManyRequestsException',
+    'RequestLimitExceeded'}
+LIST_ATTEMPTS = 5
+# error codes of regions the role cannot list, remembered for DENIED_REGION_TTL
+DENIED_CODES = {'AccessDenied', 'AccessDeniedException', 'UnauthorizedOperation',
+    'OptInRequired', 'UnrecognizedClientException', 'InvalidClientTokenId', 'AuthFailure'}
+# longest backoff between two attempts, in seconds
+MAX_BACKOFF_SECONDS = 20
+# invocations a region can be handed to before it is given up
+MAX_CONTINUATIONS = 3
 
 
+@emit_metrics
 def lambda_handler(event, context):
     '''initialize lambda function'''
-    del context
-    log.info(f"Event - {json.dumps(event, default=str)}")
+    log.info(Message("Event - {}", Payload(event)))
 
-    account_details =    event.get('detail').get('account_details')
-    compliant_server = event.get('detail').get('instance_details')
+    # instances deferred past the longest message delay, from LIST_CONTINUATION_QUEUE_URL
+    if 'Records' in event:
+        details = [json.loads(record['body']) for record in event['Records']]
+    else:
+        details = [event.get('detail')]
+    budget = TimeBudget(context)
 
-    if len(event['detail']) < 1:
-        return {
-            'statusCode': 500,
-            'message': 'No Compliant Instance available'
-        }
+    for detail in details:
+        if len(detail) < 1:
+            return {
+                'statusCode': 500,
+                'message': 'No Compliant Instance available'
+            }
 
-    app = ListInstances(account_details = account_details, compliant_server = compliant_server)
-    app.run()
+        account_details = detail.get('account_details')
+        compliant_server = detail.get('instance_details')
+        # set when an earlier invocation ran out of time before all regions were listed
+        regions = detail.get('regions')
+        # set when only a sample of the instances is validated, see utils.sampling
+        sampling = detail.get('sampling')
+        # invocations that already ran out of time for these regions
+        continuations = detail.get('continuations', 0)
+        # {region: first instance id} of regions whose first instances were published
+        resume_from = detail.get('resume_from')
+
+        app = ListInstances(account_details = account_details,
+            compliant_server = compliant_server, regions = regions, budget = budget,
+            sampling = sampling, continuations = continuations, resume_from = resume_from)
+        app.run()
 
     return {
             'statusCode': 500,
             'message': 'Successfully initiated PatchInspect'
         }
 
+class Pacer:
+    '''assigns instance messages delivery slots so that the validation stage gets
+    a smooth load below the SSM inventory limit of every account-region and the
+    rate its concurrent invocations consume messages. Rates are in instances per second'''
+
+    def __init__(self, region_rate=None, total_rate=None):
+        # every instance takes INVENTORY_PAGES_PER_INSTANCE inventory requests
+        self.region_rate = region_rate or \
+            SSM_INVENTORY_RATE / INVENTORY_PAGES_PER_INSTANCE * PACING_HEADROOM
+        self.total_rate = total_rate or \
+            VALIDATE_CONCURRENCY / VALIDATE_INSTANCE_SECONDS * PACING_HEADROOM
+        self.lock = Lock()
+        self.start = time.monotonic()
+        # next free slot of every (account, region) and messages delivered in every
+        # second, in seconds since start
+        self.next_slots = {}
+        self.load = Counter()
+
+    def delay(self, account_id, region):
+        '''returns the DelaySeconds of the next message of an account-region, None when
+        its slot is past MAX_DELAY_SECONDS'''
+        with self.lock:
+            now = time.monotonic() - self.start
+            slot = max(now, self.next_slots.get((account_id, region), now))
+            # seconds taken by the other regions are skipped
+            while self.load[int(slot)] >= self.total_rate:
+                slot = int(slot) + 1
+            if slot - now > MAX_DELAY_SECONDS:
+                return None
+            self.load[int(slot)] += 1
+            self.next_slots[(account_id, region)] = slot + 1 / self.region_rate
+        return int(slot - now)
+
+
 class ListInstances():
     '''Loops over regions to create threads for listing instances in an account'''
-    def __init__(self, account_details, compliant_server):
+    def __init__(self, account_details, compliant_server, regions=None, budget=None,
+            sampling=None, *, continuations=0, resume_from=None):
         self.account_details = account_details
         self.compliant_server = compliant_server
+        # discovered by run when not given
+        self.regions = regions
+        self.budget = budget or TimeBudget()
+        self.sampling = sampling
+        self.continuations = continuations
+        self.resume_from = resume_from or {}
         self.instance_details = []
+        # delivery slots are shared by the regions listed in parallel
+        self.pacer = Pacer()
 
     def run(self):
         '''orchestrator function for ListInstances'''
         sqs = get_client('sqs')
+        store = get_store()
         thread_list = []
+        apps = []
+        unfinished = []
+        deferred = {}
+        account_id = self.account_details['Id']
+        account_name = self.account_details['Name']
+        skipped = []
 
-        for region in REGION_USED:
-            account_id = self.account_details['Id']
-            account_name = self.account_details['Name']
+        for region in self.regions or account_regions(account_id, store):
+            if not self.budget.allows(REGION_SECONDS):
+                unfinished.append(region)
+                continue
+            if (record := store.get(skipped_region_key(account_id, region))) is not None:
+                skipped.append(f"{region} ({record['State']})")
+                continue
+            # retried events list a region once, checked before any call to the account
+            if not acquire(store, self.region_key(region)):
+                continue
 
             app = PublishInstanceDetails(account_id, account_name, region, \
-                self.compliant_server, sqs)
+                self.compliant_server, sqs, budget=self.budget, sampling=self.sampling,
+                pacer=self.pacer, resume_from=self.resume_from.get(region))
             thread = Thread(target=app.run)
             thread.start()
             thread_list.append(thread)
-            time.sleep(2)
-        time.sleep(30)
+            apps.append(app)
+            if self.budget.allows(REGION_STAGGER_SECONDS + REGION_SECONDS):
+                time.sleep(REGION_STAGGER_SECONDS)
         for thread in thread_list:
             thread.join()
 
-class PublishInstanceDetails:
+        if skipped:
+            log.info(f"Skipped {len(skipped)} regions of account {account_id} recently found \
+                empty or denied - {skipped}")
+        for app in apps:
+            # regions are probed again once their record expires
+            if app.error is not None:
+                log.error(f"Could not list the instances of account {account_id} in region \
+                    {app.region}, skipping it - {app.error}")
+                if (code := error_code(app.error)) in DENIED_CODES:
+                    store.put(skipped_region_key(account_id, app.region),
+                        {'State': 'Denied', 'Error': code}, ttl=DENIED_REGION_TTL)
+            elif app.finished and not app.instance_details:
+                store.put(skipped_region_key(account_id, app.region),
+                    {'State': 'Empty', 'ListedAt': time.time()}, ttl=EMPTY_REGION_TTL)
+            if app.finished:
+                complete(store, self.region_key(app.region))
+            else:
+                # released for the invocation continuing the region
+                release(store, self.region_key(app.region))
+                unfinished.append(app.region)
+            if app.deferred_from is not None:
+                deferred[app.region] = app.deferred_from
+        if unfinished:
+            self.publish_remaining(unfinished)
+        if deferred:
+            self.publish_deferred(deferred)
+
+    def region_key(self, region):
+        '''returns the idempotency key of listing a region, None before scan ids.
+        Every part of a region resumed from an instance has its own key'''
+        if not (scan_id := next(iter(self.compliant_server.values()), {}).get('ScanId')):
+            return None
+        return scan_key(scan_id, self.account_details['Id'], region,
+            *filter(None, [self.resume_from.get(region)]))
+
+    def continuation(self, regions, continuations):
+        '''returns the event detail continuing the listing of regions'''
+        compliant_event = {
+            'instance_details' : self.compliant_server,
+            'account_details' : self.account_details,
+            'regions' : regions,
+            'continuations' : continuations
+        }
+        if self.sampling:
+            compliant_event['sampling'] = self.sampling
+        return compliant_event
+
+    def publish_remaining(self, regions):
+        '''hands the regions not listed before the deadline, or still throttled, to a
+        new invocation,
+        unless they were already handed over MAX_CONTINUATIONS times'''
+        if self.continuations >= MAX_CONTINUATIONS:
+            log.error(f"Giving up {len(regions)} regions of account {self.account_details['Id']} \
+                after {self.continuations} continuations - {regions}")
+            return
+        compliant_event = self.continuation(regions, self.continuations + 1)
+        # regions resumed from an instance are continued from it
+        if resume_from := {region: self.resume_from[region] for region in regions \
+                if region in self.resume_from}:
+            compliant_event['resume_from'] = resume_from
+        entry = {
+            'Time': datetime.now(),
+            'Source': 'patchInspect',
+            'Detail': json.dumps(compliant_event, default=str),
+            'DetailType': 'listInstances',
+            'EventBusName': 'default'
+        }
+        publish_event([entry], get_client('events'))
+        log.info(f"Out of time or throttled, {len(regions)} regions of account \
+            {self.account_details['Id']} continue in a new invocation - {regions}")
+
+    def publish_deferred(self, resume_from):
+        '''hands the instances that did not get a delivery slot within MAX_DELAY_SECONDS
+        to an invocation starting when the messages published before are delivered.
+        resume_from is {region: first instance id not published}'''
+        if not LIST_CONTINUATION_QUEUE_URL:
+            log.error(f"No LIST_CONTINUATION_QUEUE_URL to defer the instances of \
+                {len(resume_from)} regions of account {self.account_details['Id']}, \
+                they are not validated - {resume_from}")
+            return
+        compliant_event = dict(self.continuation(list(resume_from), self.continuations),
+            resume_from=resume_from)
+        publish_sqs_message(get_client('sqs'), LIST_CONTINUATION_QUEUE_URL, compliant_event,
+            MAX_DELAY_SECONDS)
+        log.info(f"{len(resume_from)} regions of account {self.account_details['Id']} \
+            have more instances than delivery slots, they continue in {MAX_DELAY_SECONDS} \
+            seconds - {resume_from}")
+
+def error_code(err):
+    '''returns the error code of a ClientError'''
+    return getattr(err, 'response', {}).get('Error', {}).get('Code')
+
+
+def skipped_region_key(account_id, region):
+    '''returns the store key recording an account-region not listed for a while:
+    without managed instances of the scanned platforms, or denied'''
+    return f"skipped-region#{account_id}#{region}"
+
+
+@timed('describe_regions')
+def account_regions(account_id, store):
+    '''returns the regions to list in an account: SCAN_REGIONS, otherwise the
+    regions enabled in the account, cached for REGION_CACHE_TTL'''
+    if SCAN_REGIONS:
+        return SCAN_REGIONS
+    if (regions := store.get(f"regions#{account_id}")) is not None:
+        return regions
+    ec2 = get_client('ec2', None, account_id)
+    try:
+        # only the regions enabled in the account are returned
+        response = ec2.describe_regions()
+    except ec2.exceptions.ClientError as err:
+        log.error(f"Could not discover the regions of account {account_id}, \
+            listing {REGION_USED} - {err}")
+        return REGION_USED
+    regions = sorted(region['RegionName'] for region in response['Regions'])
+    store.put(f"regions#{account_id}", regions, ttl=REGION_CACHE_TTL)
+    return regions
+
+
+def platform_types(compliant_server):
+    '''returns the platform types of the baselines, None when a baseline does not
+    tell its type'''
+    types = {compliant_instance.get('PlatformType') \
+        for compliant_instance in compliant_server.values()}
+    return None if None in types else sorted(types)
+
+
+def platform_baselines(compliant_server):
+    '''returns {(platform name, platform version): shared message fields}
+    with the baselines of every scan type built for the platform'''
+    platforms = {}
+    for compliant_instance in compliant_server.values():
+        platform = (compliant_instance['PlatformName'],
+            compliant_instance['PlatformVersion'])
+        shared = platforms.setdefault(platform, {
+            'ScanTypes': compliant_instance.get('ScanTypes', [compliant_instance['ScanType']]),
+            'ScanTime': compliant_instance['ScanTime'],
+            'ScanId': compliant_instance.get('ScanId'),
+            'Baselines': {}
+        })
+        baseline = {field: compliant_instance[field] \
+            for field in BASELINE_FIELDS if field in compliant_instance}
+        shared['Baselines'][compliant_instance['ScanType']] = baseline
+
+    for shared in platforms.values():
+        scan_types = shared.pop('ScanTypes')
+        shared['Baselines'] = {scan_type: shared['Baselines'][scan_type] \
+            for scan_type in scan_types if scan_type in shared['Baselines']}
+        shared['ScanType'] = next(iter(shared['Baselines']))
+    return platforms
+
+class PublishInstanceDetails: # pylint: disable=too-many-instance-attributes
     ''' list servers for given account and region. Filters out desired servers and publishes them'''
-    def __init__(self, account_id, account_name, region, compliant_server, sqs):
+    def __init__(self, account_id, account_name, region, compliant_server, sqs, *, budget=None,
+            sampling=None, pacer=None, resume_from=None):
         self.account_id = account_id
         self.account_name = account_name
         self.region = region
+        self.budget = budget or TimeBudget()
+        self.sampling = sampling
+        self.pacer = pacer or Pacer()
+        # False until the instances of the region are published
+        self.finished = False
+        # ClientError that prevented listing the region, which is then finished
+        self.error = None
+        # instances are published from this instance id, earlier ones were published
+        # by a previous invocation
+        self.resume_from = resume_from
+        # first instance id without a delivery slot, handed to a later invocation
+        self.deferred_from = None
 
         self.ssm = get_client('ssm', region, account_id)
         self.sqs = sqs
@@ -89,45 +355,49 @@ class PublishInstanceDetails:
 
     def run(self):
         '''orchestrator function for PublishInstanceDetails'''
-        self.instance_details = self.list_all_ec2_instances(self.ssm)
-        if len(self.instance_details) == 0:
+        try:
+            with stage('describe_instances'):
+                self.instance_details = self.list_all_ec2_instances(self.ssm)
+        except DeadlineExceeded as err:
+            log.info(f"No time left to list the instances of {self.region} - {err}")
+            return
+        except self.ssm.exceptions.ClientError as err:
+            # still throttled after LIST_ATTEMPTS, a later invocation retries the region
+            if error_code(err) not in THROTTLE_CODES:
+                self.error = err
+                self.finished = True
             return
-        self.publish_relevant_platforms(self.sqs, self.region, self.account_id, self.account_name)
-        return
+        if len(self.instance_details) > 0:
+            try:
+                self.publish_relevant_platforms(self.sqs, self.region, self.account_id,
+                    self.account_name)
+            except PayloadTooLarge as err:
+                # the baselines do not fit a message, listing again would not help
+                self.error = err
+        self.finished = True
 
     def list_all_ec2_instances(self, ssm):
-        '''list all ec2 instances that have SSM status is online'''
-        try:
-            instances_list = []
-            response = ssm.describe_instance_information(
-                Filters=[
-                    {
-                        'Key': 'PingStatus',
-                        'Values': [
-                            'Online'
-                        ]
-                    }
+        '''list all ec2 instances that have SSM status is online, of the platform
+        types of the baselines'''
+        filters = [
+            {
+                'Key': 'PingStatus',
+                'Values': [
+                    'Online'
                 ]
-            )
-            instances_list.extend(response['InstanceInformationList'])
+            }
+        ]
+        # e.g. Windows instances are left out by SSM instead of after listing them
+        if types := platform_types(self.compliant_server):
+            filters.append({'Key': 'PlatformTypes', 'Values': types})
+        instances_list = []
+        response = self.describe_page(ssm, Filters=filters, MaxResults=PAGE_SIZE)
+        instances_list.extend(response['InstanceInformationList'])
 
-            while 'NextToken' in response:
-                response = ssm.describe_instance_information(
-                    Filters=[
-                        {
-                            'Key': 'PingStatus',
-                            'Values': [
-                                'Online'
-                            ]
-                        }
-                    ],
-                    NextToken = response['NextToken']
-                )
-                instances_list.extend(response['InstanceInformationList'])
-        except ClientError as err:
-            time.sleep(5)
-            log.info(f"Error: {err}")
-            return self.list_all_ec2_instances(ssm)
+        while 'NextToken' in response:
+            response = self.describe_page(ssm, Filters=filters, MaxResults=PAGE_SIZE,
+                NextToken=response['NextToken'])
+            instances_list.extend(response['InstanceInformationList'])
 
         instance_details = []
         for instance in instances_list:
@@ -142,24 +412,107 @@ class PublishInstanceDetails:
 
         return instance_details
 
+    def describe_page(self, ssm, **kwargs):
+        '''returns a page of describe_instance_information. Throttled calls are
+        retried with a jittered exponential backoff, other errors are raised'''
+        for attempt in range(1, LIST_ATTEMPTS + 1):
+            try:
+                return ssm.describe_instance_information(**kwargs)
+            except ssm.exceptions.ClientError as err:
+                if error_code(err) not in THROTTLE_CODES or attempt == LIST_ATTEMPTS:
+                    raise
+                delay = random.uniform(0, min(MAX_BACKOFF_SECONDS, 2 ** attempt))
+                log.info(f"Throttled listing {self.region}, retrying in {delay:.1f} seconds \
+                    - {err}")
+                with stage('throttle_backoff'):
+                    self.budget.sleep(delay)
+        return None
+
+    @timed('publish_instances')
     def publish_relevant_platforms(self, sqs, region, account_id, account_name):
-        '''compare platform details and publish instance details and compliant packages'''
-        count = 0
-        for compliant_instance in self.compliant_server.values():
-            for instance in self.instance_details:
-
-                if instance['PlatformName'] == compliant_instance['PlatformName'] and \
-                    instance['PlatformVersion'] == compliant_instance['PlatformVersion']:
-
-                    instance['Region'] = region
-                    instance['AccountId'] = account_id
-                    instance['AccountName'] = account_name
-                    instance['ComplaintPackages'] = compliant_instance['ComplaintPackages']
-                    instance['ScanType'] = compliant_instance['ScanType']
-                    instance['ScanTime'] = compliant_instance['ScanTime']
-
-                    publish_sqs_message(sqs, QUEUE_URL, instance)
-                    count += 1
-
-        log.info(f"{count} instance details were published to SQS \
-            for account {account_id} and region {region}")
+        '''compare platform details and publish instance details with the compliant packages
+        of every baseline built for the platform'''
+        platforms = platform_baselines(self.compliant_server)
+        # in a stable order, a later invocation resumes from an instance id
+        instances = sorted((instance for instance in self.instance_details \
+            if (instance['PlatformName'], instance['PlatformVersion']) in platforms),
+            key=lambda instance: instance['InstanceId'])
+        samples = {}
+        if self.sampling and instances:
+            instances, samples = self.sample(instances, platforms)
+            instances.sort(key=lambda instance: instance['InstanceId'])
+        if self.resume_from:
+            instances = [instance for instance in instances \
+                if instance['InstanceId'] >= self.resume_from]
+
+        # baselines and account fields are encoded once per platform
+        templates = {}
+        bodies = []
+        instance_ids = {}
+        for instance in instances:
+            if (platform := (instance['PlatformName'], instance['PlatformVersion'])) \
+                    not in templates:
+                shared = dict(platforms[platform], Region=region, AccountId=account_id,
+                    AccountName=account_name)
+                if platform in samples:
+                    shared['Sample'] = samples[platform]
+                templates[platform] = PayloadTemplate(shared)
+            bodies.append(templates[platform].render(instance))
+            instance_ids[bodies[-1]] = instance['InstanceId']
+
+        # a few instances are validated right away instead of waiting for the
+        # message delays and the batching window of the queue
+        validated = 0
+        if bodies and len(bodies) <= INLINE_THRESHOLD:
+            validated = len(bodies)
+            bodies = self.validate_inline(bodies)
+            validated -= len(bodies)
+
+        published = 0
+        for body in bodies:
+            if (delay := self.pacer.delay(account_id, region)) is None:
+                self.deferred_from = instance_ids[body]
+                break
+            publish_sqs_message(sqs, QUEUE_URL, body, delay)
+            published += 1
+
+        log.info(f"{validated} instances were validated inline and {published} instance \
+            details were published to SQS for account {account_id} and region {region}, \
+            {len(bodies) - published} are deferred")
+
+    def sample(self, instances, platforms):
+        '''returns the stratified sample of the instances of the region and the
+        population and size of the sample of every platform'''
+        # the same scan draws the same sample when the region is listed again
+        scan_time = next(iter(platforms.values()))['ScanTime']
+        sampled, samples = draw(instances, self.sampling,
+            f"{scan_time}#{self.account_id}#{self.region}")
+        log.info(f"Sampled {len(sampled)} of {len(instances)} instances in account \
+            {self.account_id} and region {self.region}")
+        return sampled, samples
+
+    def validate_inline(self, bodies):
+        '''validates instances with the code of validate_instance_compliance, findings
+        are published the same way. Returns the bodies left to queue: those that
+        failed or did not fit in the time left'''
+        # the comparison code is only loaded by account-regions validated inline
+        # pylint: disable-next=import-outside-toplevel
+        from validate_instance_compliance import validate_record
+
+        events = get_client('events')
+        store = get_store()
+        clients = {(self.account_id, self.region): self.ssm}
+        templates = {}
+        remaining = []
+        for body in bodies:
+            if not self.budget.allows():
+                remaining.append(body)
+                continue
+            try:
+                with self.budget.unit():
+                    validate_record(json.loads(body), clients, events, store, templates)
+            except Exception as err: # pylint: disable=broad-except
+                log.error(f"Could not validate an instance of {self.region} inline, \
+                    queueing it - {err}")
+                remaining.append(body)
+        return remaining
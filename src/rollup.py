@@ -0,0 +1,60 @@
+'''
+rollup
+estimates the compliance of a scan from its findings: the batch_runner output
+or findings events exported as JSON lines (with their 'detail'). Findings
+of a sampled scan are weighted by the population of their stratum and the
+estimates come with confidence intervals, a census has none. Intervals of
+groups with strata of a single score out of several instances are not
+measured but assumed, they are reported as unbounded
+
+    python src/rollup.py FINDINGS [...] [--by fleet|account|region|platform|account-region]
+        [--scan-type n-1] [--confidence 0.95]
+'''
+
+import sys
+import json
+import argparse
+
+from utils.sampling import DEFAULT_CONFIDENCE, GROUPINGS, Rollup
+
+
+def read_findings(paths):
+    '''yields the findings records of JSON lines files'''
+    for path in paths:
+        with open(path, 'r', encoding='utf8') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                finding = json.loads(line)
+                if 'detail' in finding:
+                    finding = finding['detail']
+                yield json.loads(finding) if isinstance(finding, str) else finding
+
+
+def main():
+    '''prints the estimates of the findings'''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', maxsplit=1)[0])
+    parser.add_argument('findings', nargs='+', help='JSON lines files of findings')
+    parser.add_argument('--by', default='fleet', choices=GROUPINGS,
+        help='grouping of the estimates')
+    parser.add_argument('--scan-type', default=None,
+        help='score of the findings to estimate, CompliancePercentage by default')
+    parser.add_argument('--confidence', type=float, default=DEFAULT_CONFIDENCE)
+    args = parser.parse_args()
+
+    rollup = Rollup(args.scan_type or 'CompliancePercentage')
+    for finding in read_findings(args.findings):
+        rollup.add(finding)
+    if not rollup.strata:
+        parser.error('no findings with the score')
+
+    for group, estimate in rollup.estimates(args.by, args.confidence).items():
+        print(f"{' '.join(group):<40} {estimate['Estimate']:6.2f}%  \
+[{estimate['Low']:6.2f}% - {estimate['High']:6.2f}%]  \
+{estimate['Sampled']:7} of {estimate['Population']:7} instances\
+{'  unbounded, strata with a single score' if estimate['Unbounded'] else ''}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+'''
+baseline_builder.py
+Compliant servers built as a state machine instead of waiting for them:
+launched -> online -> inventoried -> captured -> terminated. Every call of
+advance moves each server as far as it can go right now and returns, so
+initiate can persist the builds and come back later instead of sleeping
+while EC2 boots the server and SSM gathers its inventory
+'''
+
+import time
+import logging
+
+from utils.helpers import (association_succeeded,
+    check_instance_status,
+    get_instance_inventory,
+    terminate_instance)
+from utils.metrics import timed
+from utils.wire import encode_packages
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+LAUNCHED = 'launched'
+ONLINE = 'online'
+INVENTORIED = 'inventoried'
+CAPTURED = 'captured'
+TERMINATED = 'terminated'
+
+# seconds after launch before SSM is asked about a compliant server
+BOOT_SECONDS = 30
+# a compliant server not captured after this many seconds is terminated without baseline
+BUILD_TIMEOUT = 1800
+
+
+class BaselineBuilder:
+    '''advances the builds of compliant servers. builds is {instance id: build}, a
+    JSON document persisted by the caller between invocations'''
+
+    def __init__(self, ec2, ssm, builds=None):
+        self.ec2 = ec2
+        self.ssm = ssm
+        self.builds = {} if builds is None else builds
+
+    @timed('launch_compliant_servers')
+    def launch(self, image, ami_id, scan_types, instance_options):
+        '''starts a compliant server of the AMI, building the baseline of scan_types'''
+        response = self.ec2.run_instances(
+            ImageId=ami_id,
+            InstanceType='t2.micro',
+            MaxCount=1,
+            MinCount=1,
+            Monitoring={
+                'Enabled': False
+            },
+            SecurityGroupIds=[
+                instance_options['sg_id'],
+            ],
+            SubnetId=instance_options['subnet_id'],
+            IamInstanceProfile={
+                'Arn': instance_options['iam_profile_arn']
+            },
+            TagSpecifications=[
+                {
+                    'ResourceType': 'instance',
+                    'Tags': [
+                        {
+                            'Key': 'Name',
+                            'Value': 'patchInspect-compliant-server'
+                        }
+                    ]
+                }
+            ],
+            MetadataOptions= {
+                'HttpTokens': 'required'
+            }
+        )
+
+        instance_id = response['Instances'][0]['InstanceId']
+        self.builds[instance_id] = {
+            'State': LAUNCHED,
+            'ImageName': image['image_name'],
+            'ImageId': ami_id,
+            'ScanTypes': scan_types,
+            'LaunchedAt': time.time()
+        }
+        log.info(f"Created EC2 Instance {instance_id} for {image['image_name']} {scan_types}")
+        return instance_id
+
+    @timed('advance_compliant_servers')
+    def advance(self, budget):
+        '''advances every build as far as it goes without waiting, while the budget
+        allows. Returns True when every build is terminated'''
+        for instance_id, build in self.builds.items():
+            while build['State'] != TERMINATED and budget.allows():
+                with budget.unit():
+                    if not self.step(instance_id, build):
+                        break
+        return all(build['State'] == TERMINATED for build in self.builds.values())
+
+    def step(self, instance_id, build):
+        '''moves the build to its next state. Returns False when it has to wait'''
+        state = build['State']
+        try:
+            if state != CAPTURED and time.time() - build['LaunchedAt'] > BUILD_TIMEOUT:
+                log.error(f"Compliant server {instance_id} was not {CAPTURED} within \
+                    {BUILD_TIMEOUT} seconds, no baseline for {build['ImageName']} \
+                    {build['ScanTypes']}")
+                state = CAPTURED
+            elif state == LAUNCHED:
+                if time.time() - build['LaunchedAt'] < BOOT_SECONDS or \
+                        (status := check_instance_status(instance_id, self.ssm)) is None:
+                    return False
+                build['Detail'] = status
+                state = ONLINE
+            elif state == ONLINE:
+                if not association_succeeded(instance_id, self.ssm):
+                    return False
+                state = INVENTORIED
+            elif state == INVENTORIED:
+                inventory = get_instance_inventory(instance_id, self.ssm)
+                build['ComplaintPackages'] = encode_packages({entry['Name']: entry['Version'] \
+                    for entry in inventory['Entries']})
+                state = CAPTURED
+            elif state == CAPTURED:
+                terminate_instance(instance_id, self.ec2)
+                state = TERMINATED
+        except self.ec2.exceptions.ClientError as err:
+            # the build stays in its state and is retried on the next advance
+            log.error(f"Could not advance compliant server {instance_id} from {state} - {err}")
+            return False
+
+        log.info(f"Compliant server {instance_id} is {state}")
+        build['State'] = state
+        return True
+
+    def pending(self):
+        '''returns the number of builds not terminated yet'''
+        return sum(build['State'] != TERMINATED for build in self.builds.values())
+
+    def pop_captured(self):
+        '''removes the terminated builds, returns [(instance id, build)] of those
+        with a baseline'''
+        terminated = [instance_id for instance_id, build in self.builds.items() \
+            if build['State'] == TERMINATED]
+        captured = []
+        for instance_id in terminated:
+            if 'ComplaintPackages' in (build := self.builds.pop(instance_id)):
+                captured.append((instance_id, build))
+        return captured
@@ -0,0 +1,188 @@
+'''
+baseline_sources.py
+Compliant package baselines ({package: version}) built without launching a
+compliant server. initiate selects the source of every image with the
+"baseline_source" key of its configuration; "instance" (the default) boots
+the AMI and reads its SSM inventory
+'''
+
+import io
+import os
+import re
+import gzip
+import hashlib
+import logging
+
+from debian.debian_support import MappedPackageFile, version_compare
+
+from utils.config import MANIFEST_DIR, PACKAGE_MIRROR_DIR, PACKAGE_MIRROR_URL
+from utils.mirror import sync_indices
+from utils.wire import decode_packages, encode_packages
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+# seconds a baseline built from package indices is kept in the store
+INDEX_BASELINE_TTL = 7 * 86400
+
+# universe and multiverse baselines outgrow the 256 KB of an event or message,
+# images can list them in index_components
+DEFAULT_COMPONENTS = ('main', 'restricted')
+DEFAULT_ARCHITECTURE = 'amd64'
+
+# "name-[epoch:]version-release.arch" lines of Amazon Linux package lists
+_nevra_re = re.compile(r'^(?P<name>.+)-(?:\d+:)?(?P<version>[^-:]+)-(?P<release>[^-]+)\.[^.-]+$')
+
+
+def file_digest(path):
+    '''returns the sha256 of a file, read in chunks'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while chunk := file.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def max_versions(pairs, packages):
+    '''merges (package, version) pairs into packages, keeping the highest
+    version of every package'''
+    for name, version in pairs:
+        if (current := packages.get(name)) is None or version_compare(current, version) < 0:
+            packages[name] = version
+    return packages
+
+
+def read_index(path):
+    '''yields the (package, version) pairs of a Packages index, plain or gzip compressed'''
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as file:
+            index = MappedPackageFile(path, data=file.read())
+    else:
+        index = MappedPackageFile(path)
+    with index:
+        for record in index.iter_records(('Package', 'Version')):
+            fields = dict(record)
+            if 'Package' in fields and 'Version' in fields:
+                yield fields['Package'], fields['Version']
+
+
+def manifest_packages(lines):
+    '''yields the (package, version) pairs of package manifest lines.
+    Ubuntu manifests list "package[:arch]<TAB>version" (snaps are skipped),
+    Amazon Linux lists one "name-version-release.arch" package per line'''
+    for line in lines:
+        if not (fields := line.split()) or fields[0].startswith(('#', 'snap:')):
+            continue
+        if len(fields) > 1:
+            yield fields[0].split(':', 1)[0], fields[1]
+        elif (nevra := _nevra_re.match(fields[0])) is not None:
+            # SSM inventory reports rpm versions without epoch and release
+            yield nevra.group('name'), nevra.group('version')
+
+
+class PackageIndexSource:
+    '''baseline of the highest version of every package published in the
+    Packages indices of the image suites (e.g. jammy-updates, jammy-security),
+    read from a local mirror. Baselines are cached in the store by index hash'''
+
+    name = 'packages-index'
+    # the baseline does not depend on the AMI of the scan type
+    per_ami = False
+
+    def __init__(self, store, mirror_dir=PACKAGE_MIRROR_DIR, mirror_url=PACKAGE_MIRROR_URL):
+        self.store = store
+        self.mirror_dir = mirror_dir
+        self.mirror_url = mirror_url
+
+    def index_paths(self, image):
+        '''returns the Packages index of every suite and component of the image,
+        updated from PACKAGE_MIRROR_URL first when it is set'''
+        architecture = image.get('index_architecture', DEFAULT_ARCHITECTURE)
+        indices = [f"dists/{suite}/{component}/binary-{architecture}/Packages" \
+            for suite in image['index_suites'] \
+            for component in image.get('index_components', DEFAULT_COMPONENTS)]
+        if self.mirror_url:
+            sync_indices(self.mirror_url, self.mirror_dir, indices)
+
+        paths = []
+        for index in indices:
+            for name in (index, index + '.gz'):
+                if os.path.exists(path := os.path.join(self.mirror_dir, name)):
+                    paths.append(path)
+                    break
+        return paths
+
+    def get_baseline(self, image, ami=None):
+        '''returns {package: version} for the image'''
+        del ami
+        if not (paths := self.index_paths(image)):
+            raise FileNotFoundError(
+                f"no Packages index of {image['index_suites']} in {self.mirror_dir}")
+
+        digest = hashlib.sha256()
+        for path in paths:
+            name = os.path.relpath(path, self.mirror_dir)
+            digest.update(f"{name} {file_digest(path)}\n".encode('utf8'))
+        key = f"baseline-index#{digest.hexdigest()}"
+        if (cached := self.store.get(key)) is not None:
+            log.info(f"Using cached baseline of {len(paths)} indices for {image['image_name']}")
+            return decode_packages(cached['ComplaintPackages'])
+
+        packages = {}
+        for path in paths:
+            max_versions(read_index(path), packages)
+        log.info(f"Built baseline of {len(packages)} packages from {len(paths)} indices \
+            for {image['image_name']}")
+        self.store.put(key, {'ComplaintPackages': encode_packages(packages)},
+            ttl=INDEX_BASELINE_TTL)
+        return packages
+
+
+class ManifestSource:
+    '''baseline read from the package manifest published with the AMI, e.g. the
+    ".manifest" file of an Ubuntu cloud image. Manifests are looked up as
+    "<image id>.manifest" or "<image name>.manifest" in MANIFEST_DIR, then in the
+    store under "manifest#<file name>"'''
+
+    name = 'manifest'
+    per_ami = True
+
+    def __init__(self, store, manifest_dir=MANIFEST_DIR):
+        self.store = store
+        self.manifest_dir = manifest_dir
+
+    def open_manifest(self, ami):
+        '''returns the manifest of the AMI as a file object'''
+        names = [f"{ami['ImageId']}.manifest"]
+        if ami.get('Name'):
+            names.append(f"{os.path.basename(ami['Name'])}.manifest")
+        for name in names:
+            if os.path.exists(path := os.path.join(self.manifest_dir, name)):
+                return open(path, 'r', encoding='utf8')
+        for name in names:
+            if (text := self.store.get(f"manifest#{name}")) is not None:
+                return io.StringIO(text)
+        raise FileNotFoundError(f"no manifest for {ami['ImageId']} in {self.manifest_dir}")
+
+    def get_baseline(self, image, ami):
+        '''returns {package: version} for the AMI of the image'''
+        with self.open_manifest(ami) as lines:
+            packages = dict(manifest_packages(lines))
+        if not packages:
+            raise ValueError(f"empty manifest for {ami['ImageId']}")
+        log.info(f"Read {len(packages)} packages from the manifest of {ami['ImageId']} \
+            for {image['image_name']}")
+        return packages
+
+
+BASELINE_SOURCES = {
+    PackageIndexSource.name: PackageIndexSource,
+    ManifestSource.name: ManifestSource
+}
+
+
+def get_baseline_source(name, store):
+    '''returns the baseline provider registered as name'''
+    if name not in BASELINE_SOURCES:
+        raise ValueError(f"unknown baseline source {name}")
+    return BASELINE_SOURCES[name](store)
@@ -0,0 +1,208 @@
+'''
+compliance.py
+Compares instance inventories with compliant package baselines.
+Keeps a cache of evaluated inventories so that a baseline change only
+re-evaluates the packages that moved between baselines
+'''
+
+import json
+import time
+import hashlib
+import logging
+
+from debian.debian_support import version_compare as vc
+
+from utils.config import INVENTORY_CACHE_MAX_AGE
+from utils.helpers import get_instance_inventory, sanitize_iventory
+from utils.logs import SAMPLED, Message
+from utils.metrics import stage
+from utils.serialization import BASELINE_FIELDS
+from utils.wire import decode_packages, decode_pairs, encode_inventory
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+INVENTORY_TYPE = "AWS:Application"
+
+
+def baseline_id(complaint_packages):
+    '''returns a short fingerprint of a compliant package map'''
+    data = json.dumps(complaint_packages, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf8')).hexdigest()[:16]
+
+
+def baseline_key(platform_name, platform_version, scan_type):
+    '''returns the store key of the latest baseline for a platform'''
+    return f"baseline#{platform_name}#{platform_version}#{scan_type}"
+
+
+def inventory_key(account_id, region, instance_id):
+    '''returns the store key of the cached inventory of an instance'''
+    return f"inventory#{account_id}#{region}#{instance_id}"
+
+
+def diff_baselines(previous, current):
+    '''returns {package: [previous version, current version]} for every package
+    added, removed or changed between two baselines. Missing versions are None'''
+    diff = {}
+    for name, version in current.items():
+        if previous.get(name) != version:
+            diff[name] = [previous.get(name), version]
+    for name, version in previous.items():
+        if name not in current:
+            diff[name] = [version, None]
+    return diff
+
+
+def package_state(compliant_version, version):
+    '''returns (counted, compliant) for an installed package version.
+    A package only counts when the baseline has a version for it'''
+    if compliant_version is None:
+        return False, False
+    # compliant package version in lower or same
+    return True, vc(compliant_version, version) <= 0
+
+
+def compliance_percentage(count_packages, total_packages):
+    '''returns the integer compliance percentage'''
+    if count_packages == 0:
+        return 0
+    return int(round(count_packages*100/total_packages, 2))
+
+
+def message_baselines(body):
+    '''returns {scan type: baseline} carried by a message. Messages published
+    before multi-baseline scans carry a single baseline at the top level'''
+    if 'Baselines' in body:
+        baselines = body['Baselines']
+    else:
+        baselines = {body.get('ScanType', '-'): \
+            {field: body[field] for field in BASELINE_FIELDS if field in body}}
+    return {scan_type: \
+        dict(baseline, ComplaintPackages=decode_packages(baseline['ComplaintPackages'])) \
+        for scan_type, baseline in baselines.items()}
+
+
+def evaluate_entries(entries, baselines):
+    '''compares inventory entries with the compliant versions of every baseline
+    in a single pass. Returns {scan type: score}'''
+    scores = {scan_type: {
+        'BaselineId': baseline.get('BaselineId'),
+        'Compliant': 0,
+        'Total': 0
+    } for scan_type, baseline in baselines.items()}
+
+    for entry in entries:
+        name = entry['Name']
+        version = entry['Version']
+        results = {}
+        for scan_type, baseline in baselines.items():
+            if (compliant_version := baseline['ComplaintPackages'].get(name)) is None:
+                continue
+            # baselines of consecutive AMIs mostly share versions, compare once
+            if compliant_version not in results:
+                results[compliant_version] = package_state(compliant_version, version)[1]
+            scores[scan_type]['Total'] += 1
+            scores[scan_type]['Compliant'] += results[compliant_version]
+    return scores
+
+
+def rescore(inventory, score, baseline_diff):
+    '''returns the cached score updated for the packages changed in baseline_diff.
+    Only inventory entries of changed packages are compared again'''
+    count_packages = score['Compliant']
+    total_packages = score['Total']
+    for name, version in inventory:
+        if name not in baseline_diff:
+            continue
+        previous_version, current_version = baseline_diff[name]
+        counted, compliant = package_state(previous_version, version)
+        total_packages -= counted
+        count_packages -= compliant
+        counted, compliant = package_state(current_version, version)
+        total_packages += counted
+        count_packages += compliant
+    return {'Compliant': count_packages, 'Total': total_packages}
+
+
+def cached_score(cached, scan_type, baseline, scan_id=None):
+    '''returns the cached score of a baseline, re-evaluating the packages changed
+    since the cached baseline. None when the cache cannot be used.
+    A score of the same baseline is only reused by the scan that computed it
+    (redeliveries), later scans fetch the inventory again'''
+    if (score := cached['Scores'].get(scan_type)) is None or 'BaselineId' not in baseline:
+        return None
+    if score['BaselineId'] == baseline['BaselineId']:
+        return score if scan_id and cached.get('ScanId') == scan_id else None
+    if score['BaselineId'] == baseline.get('PreviousBaselineId') and 'BaselineDiff' in baseline:
+        score = rescore(decode_pairs(cached['Inventory']), score, baseline['BaselineDiff'])
+        log.info(Message("Re-evaluated {} changed packages against the {} baseline",
+            len(baseline['BaselineDiff']), scan_type), extra=SAMPLED)
+        score['BaselineId'] = baseline['BaselineId']
+        return score
+    return None
+
+
+def load_cached_inventory(store, body):
+    '''returns the cached inventory of the instance if it is recent enough'''
+    if store is None:
+        return None
+    cached = store.get(inventory_key(body['AccountId'], body['Region'], body['InstanceId']))
+    if cached is None or time.time() - cached['CachedAt'] > INVENTORY_CACHE_MAX_AGE:
+        return None
+    return cached
+
+
+def assess_instance(body, ssm, store=None, baselines=None, evaluate=evaluate_entries):
+    '''returns the findings record for the instance described by an SQS message body,
+    with a compliance score for every baseline carried by the message. baselines
+    decoded once for many instances can be passed instead, and evaluate replaces
+    evaluate_entries (e.g. to run it in another process)'''
+    if baselines is None:
+        baselines = message_baselines(body)
+    scores = None
+    if (cached := load_cached_inventory(store, body)) is not None:
+        with stage('evaluate_cached'):
+            scores = {scan_type: cached_score(cached, scan_type, baseline, body.get('ScanId'))
+                for scan_type, baseline in baselines.items()}
+        if None in scores.values():
+            scores = None
+
+    if scores is not None:
+        instance_inventory = {
+            'TypeName': INVENTORY_TYPE,
+            'InstanceId': body['InstanceId'],
+            'EvaluationMode': 'incremental'
+        }
+        inventory = cached['Inventory']
+        cached_at = cached['CachedAt']
+    else:
+        instance_inventory = get_instance_inventory(body['InstanceId'], ssm)
+        # Compare packages versions with compliant versions
+        with stage('evaluate'):
+            scores = evaluate(instance_inventory['Entries'], baselines)
+        instance_inventory['EvaluationMode'] = 'full'
+        inventory = encode_inventory([(entry['Name'], entry['Version']) \
+            for entry in instance_inventory['Entries']])
+        cached_at = time.time()
+
+    instance_inventory['Scores'] = {scan_type: \
+        compliance_percentage(score['Compliant'], score['Total']) \
+        for scan_type, score in scores.items()}
+    instance_inventory['CompliancePercentage'] = \
+        instance_inventory['Scores'].get(body.get('ScanType'), 0)
+
+    # keep the scores of baselines this message did not ask for, while they were
+    # computed on the same inventory
+    if cached is not None and cached['Inventory'] == inventory:
+        scores = dict(cached['Scores'], **scores)
+    if store is not None and (instance_inventory['EvaluationMode'] == 'full' or \
+            cached['Scores'] != scores or cached.get('ScanId') != body.get('ScanId')):
+        store.put(inventory_key(body['AccountId'], body['Region'], body['InstanceId']), {
+            'Inventory': inventory,
+            'Scores': scores,
+            'CachedAt': cached_at,
+            'ScanId': body.get('ScanId')
+        }, ttl=max(1, int(cached_at + INVENTORY_CACHE_MAX_AGE - time.time())))
+
+    return sanitize_iventory(instance_inventory, body)
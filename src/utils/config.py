@@ -11,3 +11,99 @@ PATCH_INSPECT_S3_BUCKET = os.environ.get('PATCH_INSPECT_S3_BUCKET', '')
 PATCH_INSPECT_TABLE_NAME = os.environ.get('PATCH_INSPECT_TABLE_NAME', '')
 
 REGION_USED = ['ap-south-1', 'ap-southeast-1', 'us-east-1','us-east-2']
+# regions listed in every account, e.g. "us-east-1,eu-west-1". Unset: the regions enabled
+# in each account are discovered, REGION_USED when they cannot be
+SCAN_REGIONS = [region.strip() for region in os.environ.get('SCAN_REGIONS', '').split(',') \
+    if region.strip()]
+# seconds the enabled regions of an account are cached
+REGION_CACHE_TTL = int(os.environ.get('REGION_CACHE_TTL', '86400'))
+# seconds an account-region without managed instances of the scanned platforms is
+# skipped before it is listed again, about the interval between two scans
+EMPTY_REGION_TTL = int(os.environ.get('EMPTY_REGION_TTL', '86400'))
+# seconds an account-region whose listing was denied (e.g. by a region-deny SCP or
+# a region not opted in) is skipped before it is listed again
+DENIED_REGION_TTL = int(os.environ.get('DENIED_REGION_TTL', '604800'))
+
+# local directory used for state when no DynamoDB table is configured
+STATE_DIR = os.environ.get('STATE_DIR', '/tmp/patch_inspect')
+
+# local mirror (dists/<suite>/<component>/binary-<arch>/Packages) read by the
+# packages-index baseline source
+PACKAGE_MIRROR_DIR = os.environ.get('PACKAGE_MIRROR_DIR', os.path.join(STATE_DIR, 'mirror'))
+# archive the mirror indices are updated from with pdiffs before use, e.g.
+# http://archive.ubuntu.com/ubuntu (unset: the mirror is maintained elsewhere)
+PACKAGE_MIRROR_URL = os.environ.get('PACKAGE_MIRROR_URL', '')
+# concurrent pdiff patch downloads per index
+PDIFF_WORKERS = int(os.environ.get('PDIFF_WORKERS', '8'))
+# seconds a request to PACKAGE_MIRROR_URL may block, images fall back to a compliant server
+MIRROR_TIMEOUT_SECONDS = float(os.environ.get('MIRROR_TIMEOUT_SECONDS', '30'))
+
+# AMI package manifests (<image id or name>.manifest) read by the manifest baseline source
+MANIFEST_DIR = os.environ.get('MANIFEST_DIR', os.path.join(STATE_DIR, 'manifests'))
+
+# seconds between two scheduled scans (weekly by default)
+SCAN_INTERVAL_SECONDS = int(os.environ.get('SCAN_INTERVAL_SECONDS', '604800'))
+# seconds a cached instance inventory can be reused for incremental re-evaluation.
+# The scan interval and a day of slack by default, so that the next scheduled scan
+# re-evaluates the packages of a new baseline against the inventory of the last one
+INVENTORY_CACHE_MAX_AGE = int(os.environ.get('INVENTORY_CACHE_MAX_AGE',
+    str(SCAN_INTERVAL_SECONDS + 86400)))
+
+# logging of events and per-instance lines
+# LOG_FULL_PAYLOADS=true logs complete payloads and disables sampling (debugging)
+LOG_FULL_PAYLOADS = os.environ.get('LOG_FULL_PAYLOADS', 'false').lower() == 'true'
+LOG_MAX_PAYLOAD_CHARS = int(os.environ.get('LOG_MAX_PAYLOAD_CHARS', '2048'))
+# fraction of per-instance lines kept per level, e.g. "INFO=0.1,DEBUG=0"
+LOG_SAMPLE_RATES = {level.strip().upper(): float(rate) for level, rate in \
+    (item.split('=') for item in os.environ.get('LOG_SAMPLE_RATES', '').split(',') if item)}
+
+# encode package maps in events, messages and the state store with utils.wire
+COMPACT_WIRE_FORMAT = os.environ.get('COMPACT_WIRE_FORMAT', 'true').lower() == 'true'
+
+# seconds kept at the end of an invocation to checkpoint and re-enqueue unfinished work
+DEADLINE_RESERVE = int(os.environ.get('DEADLINE_RESERVE', '30'))
+# queue resuming initiate runs that ran out of time (unset: runs are never split)
+CONTINUATION_QUEUE_URL = os.environ.get('CONTINUATION_QUEUE_URL', '')
+# queue resuming list_instances with the instances past the longest message delay
+LIST_CONTINUATION_QUEUE_URL = os.environ.get('LIST_CONTINUATION_QUEUE_URL', '')
+# seconds between two checks of the compliant servers initiate is building
+BUILD_POLL_SECONDS = int(os.environ.get('BUILD_POLL_SECONDS', '60'))
+
+# API call and stage metrics printed as CloudWatch Embedded Metric Format lines
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'PatchInspect')
+
+# tracemalloc and RSS profile of every invocation, logged when it ends (slows the handlers)
+MEMORY_PROFILE = os.environ.get('MEMORY_PROFILE', 'false').lower() == 'true'
+# allocation sites and queue records listed in the memory profile
+MEMORY_PROFILE_TOP = int(os.environ.get('MEMORY_PROFILE_TOP', '10'))
+MEMORY_SAMPLE_SECONDS = float(os.environ.get('MEMORY_SAMPLE_SECONDS', '0.05'))
+
+# directory receiving a trace of the AWS API calls of every invocation (unset: no capture)
+TRACE_DIR = os.environ.get('TRACE_DIR', '')
+# keys whose values are replaced in the traces, e.g. "Name,IPAddress,AccountName"
+TRACE_REDACT = {'AccessKeyId', 'SecretAccessKey', 'SessionToken'} | \
+    {key.strip() for key in os.environ.get('TRACE_REDACT', '').split(',') if key.strip()}
+
+# account-regions with at most this many instances to validate are validated by
+# list_instances itself instead of through the instances queue (0: always queue)
+INLINE_THRESHOLD = int(os.environ.get('INLINE_THRESHOLD', '10'))
+
+# instance messages are delivered at a pace the validation stage sustains without throttling:
+# SSM inventory requests per second an account-region allows
+SSM_INVENTORY_RATE = float(os.environ.get('SSM_INVENTORY_RATE', '5'))
+# ListInventoryEntries pages validating an instance takes, about 12 for an Ubuntu server
+INVENTORY_PAGES_PER_INSTANCE = float(os.environ.get('INVENTORY_PAGES_PER_INSTANCE', '12'))
+# concurrent validate_instance_compliance invocations (maximum_concurrency of the queue)
+# and the seconds each spends per instance
+VALIDATE_CONCURRENCY = int(os.environ.get('VALIDATE_CONCURRENCY', '4'))
+VALIDATE_INSTANCE_SECONDS = float(os.environ.get('VALIDATE_INSTANCE_SECONDS', '0.5'))
+# fraction of those rates used, keeping the load just below the limits
+PACING_HEADROOM = float(os.environ.get('PACING_HEADROOM', '0.8'))
+
+# duplicate deliveries of the same work of a scan (listing an account-region, validating
+# an instance) are skipped: seconds the completed work is remembered
+SCAN_CLAIM_TTL = int(os.environ.get('SCAN_CLAIM_TTL', '86400'))
+# seconds before the claim of a delivery that never completed can be taken again,
+# at least the function timeout
+CLAIM_LEASE_SECONDS = int(os.environ.get('CLAIM_LEASE_SECONDS', '900'))
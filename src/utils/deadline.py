@@ -0,0 +1,55 @@
+'''
+deadline.py
+Time budget of a lambda invocation. Handlers only start a unit of work (an
+image, a region, a record) while there is time left to finish it, so that
+they can checkpoint and hand the unfinished units to a new invocation
+instead of being stopped at the timeout and retried from scratch
+'''
+
+import math
+import time
+from contextlib import contextmanager
+
+from utils.config import DEADLINE_RESERVE
+
+
+class DeadlineExceeded(Exception):
+    '''raised by TimeBudget.sleep when the budget ends before the sleep does'''
+
+
+class TimeBudget:
+    '''remaining time of an invocation, read from the lambda context.
+    The last DEADLINE_RESERVE seconds are kept for checkpointing.
+    Without a context (local runs) the budget never ends'''
+
+    def __init__(self, context=None, reserve=DEADLINE_RESERVE):
+        self.context = context
+        self.reserve = reserve
+        # duration of the longest unit timed so far, the estimate for the next one
+        self.longest = 0.0
+
+    def remaining(self):
+        '''returns the seconds left before the reserve'''
+        if self.context is None:
+            return math.inf
+        return self.context.get_remaining_time_in_millis() / 1000 - self.reserve
+
+    def allows(self, seconds=0):
+        '''returns True when a unit of work taking seconds, or as long as the
+        longest unit so far, can still finish'''
+        return self.remaining() > max(seconds, self.longest)
+
+    @contextmanager
+    def unit(self):
+        '''times a unit of work'''
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.longest = max(self.longest, time.monotonic() - start)
+
+    def sleep(self, seconds):
+        '''sleeps for seconds, raises DeadlineExceeded when the budget ends first'''
+        if self.remaining() < seconds:
+            raise DeadlineExceeded(f"cannot wait {seconds}s, {self.remaining():.0f}s left")
+        time.sleep(seconds)
@@ -10,14 +10,18 @@ import uuid
 import logging
 from random import randrange
 
-import boto3
-from botocore.exceptions import ClientError
-
 from utils.config import ROLE_NAME
+from utils.logs import SAMPLED
+from utils.metrics import instrument, stage, timed
+from utils.serialization import EVENTS_MAX_BYTES, MESSAGE_MAX_BYTES, check_size
+from utils.trace import capture
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 
+# creates the clients returned by get_client instead of boto3, see set_client_factory
+_CLIENT_FACTORY = None
+
 def check_instance_status(instance_id, ssm):
     '''return True when the instance in available'''
     response = ssm.describe_instance_information(
@@ -49,26 +53,18 @@ def check_instance_status(instance_id, ssm):
     return instance_details
 
 
-def check_association_status(instance_id, ssm):
-    '''check association status for gather software inventory status'''
-    while True:
-
-        response = ssm.describe_instance_associations_status(
-            InstanceId=instance_id
-        )
-        # log.info(f"describe_instance_associations_status - {json.dumps(response, default=str)}")
-        for association in response['InstanceAssociationStatusInfos']:
-            if association['Name'] == "AWS-GatherSoftwareInventory" and \
-                 association['Status'] == "Success":
-                return True
-
-        log.info("Association status is not 'Success' for AWS-GatherSoftwareInventory. \
-             Sleeping for 30 seconds")
-        time.sleep(30)
-        continue
+def association_succeeded(instance_id, ssm):
+    '''return True when the gather software inventory association succeeded'''
+    response = ssm.describe_instance_associations_status(
+        InstanceId=instance_id
+    )
+    # log.info(f"describe_instance_associations_status - {json.dumps(response, default=str)}")
+    return any(association['Name'] == "AWS-GatherSoftwareInventory" and \
+        association['Status'] == "Success" \
+        for association in response['InstanceAssociationStatusInfos'])
 
-    return True
 
+@timed('inventory')
 def get_instance_inventory(instance_id, ssm):
     '''return instance inventory information from ssm'''
     inventory = []
@@ -88,11 +84,12 @@ def get_instance_inventory(instance_id, ssm):
                 NextToken=response['NextToken']
             )
             inventory['Entries'].extend(response['Entries'])
-    except ClientError as err:
+    except ssm.exceptions.ClientError as err:
         if err.response['Error']['Code'] == "ThrottlingException":
             sleep_sec = randrange(10)
             log.error(f'Error fetching inventory. Sleeping for {sleep_sec} seconds.')
-            time.sleep(sleep_sec)
+            with stage('throttle_backoff'):
+                time.sleep(sleep_sec)
             return get_instance_inventory(instance_id, ssm)
 
     return inventory
@@ -106,6 +103,10 @@ def sanitize_iventory(instance_inventory, body):
     instance_inventory['PlatformVersion'] = body.get('PlatformVersion','-')
     instance_inventory['ScanType'] = body.get('ScanType','-')
     instance_inventory['ScanTime'] = body.get('ScanTime','-')
+    instance_inventory['ScanId'] = body.get('ScanId','-')
+    if 'Sample' in body:
+        # population and sample size of the stratum, for the rollup estimates
+        instance_inventory['Sample'] = body['Sample']
 
     if 'NextToken' in instance_inventory:
         del instance_inventory['NextToken']
@@ -130,26 +131,31 @@ def terminate_instance(instance_id, ec2):
     )
 
 
-def publish_sqs_message(sqs, queue_url, data):
-    '''publish given message to patch compliance SQS queue'''
+def publish_sqs_message(sqs, queue_url, data, delay=None):
+    '''publish given message to patch compliance SQS queue.
+    data is a dict or an already serialized JSON document.
+    Delivery is delayed by delay seconds, not delayed by default'''
 
+    body = data if isinstance(data, str) else json.dumps(data, default=str)
+    check_size(body, MESSAGE_MAX_BYTES, 'SQS message')
     sqs.send_message(
         QueueUrl=queue_url,
-        MessageBody=json.dumps(data, default=str),
-        DelaySeconds=randrange(30)
+        MessageBody=body,
+        DelaySeconds=delay or 0
     )
 
 
 def publish_event(entry, events=None):
     '''publish event to evenrbridge'''
 
+    check_size(json.dumps(entry, default=str), EVENTS_MAX_BYTES, 'EventBridge PutEvents request')
     response = events.put_events(
         Entries= entry
     )
-    log.info("event published on eventbridge ")
+    log.info("event published on eventbridge ", extra=SAMPLED)
 
     if response['FailedEntryCount'] < 1:
-        log.info('put_events - success')
+        log.info('put_events - success', extra=SAMPLED)
     else:
         log.info(f'put_events - error - {response}')
 
@@ -158,10 +164,19 @@ def get_client(service, region_name=None, account_id = None):
     '''
     creates service client for given service, region and account
     '''
+    if _CLIENT_FACTORY is not None:
+        return instrument(_CLIENT_FACTORY(service, region_name, account_id),
+            account_id, region_name)
     session  = _get_session(region_name, account_id)
-    client = session.client(service)
+    client = capture(session.client(service), account_id, region_name)
+
+    return instrument(client, account_id, region_name)
 
-    return client
+def set_client_factory(factory):
+    '''replaces boto3 in get_client with factory(service, region name, account id),
+    e.g. with in-memory fakes for load tests. None restores boto3'''
+    global _CLIENT_FACTORY # pylint: disable=global-statement
+    _CLIENT_FACTORY = factory
 
 def get_resource(service, region_name=None, account_id = None):
     '''
@@ -174,14 +189,22 @@ def get_resource(service, region_name=None, account_id = None):
     return resource
 
 
+def _boto3():
+    '''imports boto3 on first use. It is most of the import time of the
+    functions, and code that only reads or transforms data does not need it'''
+    import boto3  # pylint: disable=import-outside-toplevel
+    return boto3
+
+
 def _get_current_account_region():
     '''return default account and region'''
-    client = boto3.client('sts')
+    client = instrument(_boto3().client('sts'))
     account_id = client.get_caller_identity()['Account']
     region = os.environ['AWS_REGION']
 
     return account_id, region
 
+@timed('assume_role')
 def _get_session(region_name=None, account_id = None):
     '''
     creates boto3 session for specified account and region
@@ -193,7 +216,7 @@ def _get_session(region_name=None, account_id = None):
     if account_id is None:
         account_id = default_account
 
-    role_client = boto3.client('sts')
+    role_client = instrument(_boto3().client('sts'))
     role_arn_val = 'arn:aws:iam::' + \
         account_id + ':role/' + ROLE_NAME
 
@@ -201,7 +224,7 @@ def _get_session(region_name=None, account_id = None):
         RoleArn=role_arn_val,
         RoleSessionName=f"security-automation-{uuid.uuid4()}")
 
-    session = boto3.Session(
+    session = _boto3().Session(
         aws_access_key_id=response['Credentials']['AccessKeyId'],
         aws_secret_access_key=response['Credentials']['SecretAccessKey'],
         aws_session_token=response['Credentials']['SessionToken'],
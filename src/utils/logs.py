@@ -0,0 +1,106 @@
+'''
+logs.py
+Logging setup shared by the lambda handlers.
+Messages are formatted only when a record is emitted, large payloads are
+summarized and per-instance lines can be sampled per level
+'''
+
+import json
+import random
+import logging
+
+from utils.config import LOG_FULL_PAYLOADS, LOG_MAX_PAYLOAD_CHARS, LOG_SAMPLE_RATES
+
+default_log_args = {
+    "level": logging.INFO,
+    "format": "%(asctime)s [%(levelname)s] %(filename)s-%(lineno)d %(message)s",
+    "datefmt": "%Y-%m-%d %H:%M:%S",
+    "force": True,
+}
+
+# pass as extra= for lines logged once per instance, record or message
+SAMPLED = {'sampled': True}
+
+# payload keys replaced by their size when summarizing
+SUMMARIZED_KEYS = ('ComplaintPackages', 'BaselineDiff', 'Entries', 'Inventory')
+MAX_LIST_ITEMS = 5
+MAX_STRING_CHARS = 256
+
+
+class Message:
+    '''log message formatted with str.format when the record is emitted'''
+
+    def __init__(self, fmt, *args, **kwargs):
+        self.fmt = fmt
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return self.fmt.format(*self.args, **self.kwargs)
+
+
+class Payload:
+    '''JSON dump of an event or message, summarized and truncated unless
+    LOG_FULL_PAYLOADS is set. Encoding happens when the record is emitted'''
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        if LOG_FULL_PAYLOADS:
+            return json.dumps(self.data, default=str)
+        text = json.dumps(summarize(self.data), default=str)
+        if len(text) > LOG_MAX_PAYLOAD_CHARS:
+            text = f"{text[:LOG_MAX_PAYLOAD_CHARS]}... ({len(text)} chars)"
+        return text
+
+
+def summarize(data):
+    '''returns a copy of data with package maps replaced by their size and
+    long lists and strings cut short'''
+    if isinstance(data, dict):
+        summary = {}
+        for key, value in data.items():
+            if key in SUMMARIZED_KEYS and isinstance(value, (dict, list)):
+                summary[key] = f"<{len(value)} items>"
+            else:
+                summary[key] = summarize(value)
+        return summary
+    if isinstance(data, list):
+        summary = [summarize(value) for value in data[:MAX_LIST_ITEMS]]
+        if len(data) > MAX_LIST_ITEMS:
+            summary.append(f"<{len(data) - MAX_LIST_ITEMS} more>")
+        return summary
+    if isinstance(data, str) and len(data) > MAX_STRING_CHARS:
+        if data[:1] in {'{', '['}:
+            # SQS bodies and event details are JSON documents themselves
+            try:
+                return summarize(json.loads(data))
+            except ValueError:
+                pass
+        return f"{data[:MAX_STRING_CHARS]}... ({len(data)} chars)"
+    return data
+
+
+class SamplingFilter(logging.Filter):
+    '''keeps only a fraction of the records logged with extra=SAMPLED,
+    using the rate configured for the record level'''
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if LOG_FULL_PAYLOADS or not getattr(record, 'sampled', False):
+            return True
+        rate = self.rates.get(record.levelname, 1.0)
+        return rate >= 1 or random.random() < rate
+
+
+def configure_logging():
+    '''configures the root logger for a lambda handler and returns it'''
+    logging.basicConfig(**default_log_args)
+    log = logging.getLogger()
+    for handler in log.handlers:
+        handler.addFilter(SamplingFilter(LOG_SAMPLE_RATES))
+    return log
@@ -0,0 +1,203 @@
+'''
+memprof.py
+Opt-in memory profiling of the lambda handlers (MEMORY_PROFILE=true). Python
+allocations are traced with tracemalloc and the RSS of the process is sampled
+by a background thread while an invocation runs. The peak of every stage
+timed by utils.metrics, the allocation delta of every queue record and the
+largest allocation sites are logged as one compact report when the
+invocation ends
+'''
+
+import os
+import json
+import logging
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+from utils.config import MEMORY_PROFILE, MEMORY_PROFILE_TOP, MEMORY_SAMPLE_SECONDS
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+KIB = 1024
+# growth of the live memory over the last snapshot before taking another one
+SNAPSHOT_GROWTH = 1.1
+
+
+class Frame:
+    '''stage or record being profiled'''
+
+    def __init__(self, name, traced):
+        self.name = name
+        self.start = traced
+        self.peak = traced
+        self.rss = 0
+
+
+class Profile:
+    '''allocations of one invocation'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.frames = []
+        # {stage: {'Count', 'Peak', 'Rss'}}
+        self.stages = {}
+        # [(record id, peak delta, delta)]
+        self.records = []
+        self.rss = {'Start': _rss()}
+        self.rss['Peak'] = self.rss['Start']
+        # snapshot and live memory at the stage exit with the most live memory
+        self.largest = 0
+        self.snapshot = None
+
+    def sample(self):
+        '''samples the RSS until the invocation ends'''
+        while not self.done.wait(MEMORY_SAMPLE_SECONDS):
+            rss = _rss()
+            with self.lock:
+                self.rss['Peak'] = max(self.rss['Peak'], rss)
+                for frame in self.frames:
+                    frame.rss = max(frame.rss, rss)
+
+    def enter(self, name):
+        '''starts a frame. The tracemalloc peak is reset, the peak so far
+        is kept by the enclosing frame'''
+        traced, peak = tracemalloc.get_traced_memory()
+        with self.lock:
+            if self.frames:
+                self.frames[-1].peak = max(self.frames[-1].peak, peak)
+            tracemalloc.reset_peak()
+            frame = Frame(name, traced)
+            self.frames.append(frame)
+        return frame
+
+    def leave(self, frame):
+        '''ends a frame, returns (peak delta, delta) of its allocations'''
+        traced, peak = tracemalloc.get_traced_memory()
+        rss = _rss()
+        with self.lock:
+            frame.peak = max(frame.peak, peak)
+            frame.rss = max(frame.rss, rss)
+            self.rss['Peak'] = max(self.rss['Peak'], rss)
+            self.frames.remove(frame)
+            if self.frames:
+                self.frames[-1].peak = max(self.frames[-1].peak, frame.peak)
+                self.frames[-1].rss = max(self.frames[-1].rss, frame.rss)
+            if traced > self.largest * SNAPSHOT_GROWTH:
+                self.largest = traced
+                self.snapshot = tracemalloc.take_snapshot()
+        return frame.peak - frame.start, traced - frame.start
+
+    def add_stage(self, frame, peak_delta):
+        '''adds the peak of a stage to its totals'''
+        totals = self.stages.setdefault(frame.name, {'Count': 0, 'Peak': 0, 'Rss': 0})
+        totals['Count'] += 1
+        totals['Peak'] = max(totals['Peak'], peak_delta)
+        totals['Rss'] = max(totals['Rss'], frame.rss)
+
+    def report(self, function_name, root):
+        '''returns the report of the invocation, sizes in KiB'''
+        traced, _ = tracemalloc.get_traced_memory()
+        records = sorted(self.records, key=lambda record: record[1], reverse=True)
+        sites = []
+        if self.snapshot is not None:
+            snapshot = self.snapshot.filter_traces([tracemalloc.Filter(False, __file__)])
+            for stat in snapshot.statistics('lineno')[:MEMORY_PROFILE_TOP]:
+                frame = stat.traceback[0]
+                sites.append([f"{os.path.basename(frame.filename)}:{frame.lineno}",
+                    stat.size // KIB, stat.count])
+        return {
+            'Function': function_name,
+            'Traced': {'Peak': (root.peak - root.start) // KIB,
+                'End': (traced - root.start) // KIB},
+            'Rss': {'Start': self.rss['Start'] // KIB, 'Peak': self.rss['Peak'] // KIB,
+                'End': _rss() // KIB},
+            'Stages': {name: {'Count': totals['Count'], 'Peak': totals['Peak'] // KIB,
+                'Rss': totals['Rss'] // KIB} for name, totals in sorted(self.stages.items())},
+            'Records': {
+                'Count': len(records),
+                'Delta': sum(record[2] for record in records) // KIB,
+                'Top': [[record_id, peak // KIB, delta // KIB] \
+                    for record_id, peak, delta in records[:MEMORY_PROFILE_TOP]]
+            },
+            'Sites': sites
+        }
+
+
+# profile of the running invocation, None when not profiling
+_PROFILE = None
+
+
+def _rss():
+    '''returns the resident set size of the process in bytes, 0 when unknown'''
+    try:
+        with open('/proc/self/statm', 'r', encoding='utf8') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _active():
+    '''returns the profile when the calling thread runs the profiled invocation.
+    Stages of worker threads share the tracemalloc peak and are not profiled'''
+    if _PROFILE is None or threading.current_thread() is not threading.main_thread():
+        return None
+    return _PROFILE
+
+
+def enter_stage(name):
+    '''starts profiling a stage of utils.metrics, returns its frame or None'''
+    if (profile := _active()) is None:
+        return None
+    return profile.enter(name)
+
+
+def leave_stage(frame):
+    '''ends the profiling of a stage started by enter_stage'''
+    if frame is not None and (profile := _active()) is not None:
+        peak_delta, _ = profile.leave(frame)
+        with profile.lock:
+            profile.add_stage(frame, peak_delta)
+
+
+@contextmanager
+def record(record_id):
+    '''profiles the allocations of one queue record'''
+    if (profile := _active()) is None:
+        yield
+        return
+    frame = profile.enter(record_id)
+    try:
+        yield
+    finally:
+        peak_delta, delta = profile.leave(frame)
+        with profile.lock:
+            profile.records.append((record_id, peak_delta, delta))
+
+
+@contextmanager
+def invocation(function_name):
+    '''profiles an invocation when MEMORY_PROFILE is set and logs its report'''
+    global _PROFILE # pylint: disable=global-statement
+    if not MEMORY_PROFILE or _PROFILE is not None:
+        yield
+        return
+    if started := not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _PROFILE = Profile()
+    root = _PROFILE.enter('invocation')
+    sampler = threading.Thread(target=_PROFILE.sample, daemon=True)
+    sampler.start()
+    try:
+        yield
+    finally:
+        profile, _PROFILE = _PROFILE, None
+        profile.done.set()
+        sampler.join()
+        profile.leave(root)
+        report = profile.report(function_name, root)
+        if started:
+            tracemalloc.stop()
+        log.info(f"Memory profile {json.dumps(report, separators=(',', ':'))}")
@@ -0,0 +1,197 @@
+'''
+metrics.py
+Per-invocation accounting of the lambda handlers: AWS API calls counted by
+botocore event hooks on the clients of helpers.get_client (calls, retries,
+throttles, errors, bytes and latency per service, operation, account and
+region) and named stage timers. The totals are printed once per invocation
+as CloudWatch Embedded Metric Format lines, CloudWatch Logs turns them into
+metrics without any API call
+'''
+
+import json
+import time
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+from utils import memprof, trace
+from utils.config import METRICS_ENABLED, METRICS_NAMESPACE
+
+# error codes counted as throttles
+THROTTLE_CODES = {'Throttling', 'ThrottlingException', 'ThrottledException',
+    'RequestLimitExceeded', 'TooManyRequestsException', 'RequestThrottled',
+    'RequestThrottledException', 'SlowDown'}
+
+API_METRICS = (('Calls', 'Count'), ('Retries', 'Count'), ('Throttles', 'Count'),
+    ('Errors', 'Count'), ('RequestBytes', 'Bytes'), ('ResponseBytes', 'Bytes'),
+    ('Latency', 'Milliseconds'), ('MaxLatency', 'Milliseconds'))
+STAGE_METRICS = (('Duration', 'Milliseconds'), ('Count', 'Count'))
+
+_lock = threading.Lock()
+# {(service, operation, account id, region): {metric: value}}
+_api = {}
+# {stage: {metric: value}}
+_stages = {}
+
+
+def _add(table, key, values, maximum=None):
+    '''adds values to the totals of key'''
+    with _lock:
+        totals = table.setdefault(key, {})
+        for name, value in values.items():
+            totals[name] = totals.get(name, 0) + value
+        for name, value in (maximum or {}).items():
+            totals[name] = max(totals.get(name, 0), value)
+
+
+def _body_size(body):
+    '''returns the size in bytes of a request body'''
+    if body is None:
+        return 0
+    if isinstance(body, str):
+        return len(body.encode('utf8'))
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    # query protocol bodies (EC2, SQS, STS) are dicts until they are encoded
+    return len(json.dumps(body, default=str))
+
+
+def instrument(client, account_id=None, region=None):
+    '''counts the API calls of a boto3 client. Clients without botocore
+    events (e.g. fakes) are left as they are'''
+    if not METRICS_ENABLED or (events := getattr(getattr(client, 'meta', None),
+            'events', None)) is None:
+        return client
+    scope = (account_id or '-', region or getattr(client.meta, 'region_name', None) or '-')
+
+    def key(event_name):
+        _, service, operation = (event_name.split('.') + ['-', '-'])[:3]
+        return (service, operation) + scope
+
+    def before_call(event_name, context=None, **kwargs):
+        del event_name, kwargs
+        if context is not None:
+            context['metrics_start'] = time.perf_counter()
+
+    def request_created(event_name, request=None, **kwargs):
+        del kwargs
+        _add(_api, key(event_name), {'RequestBytes': _body_size(getattr(request, 'body', None))})
+
+    def needs_retry(event_name, response=None, **kwargs):
+        del kwargs
+        # emitted after every attempt, counts the throttles that were retried too
+        if response is not None and \
+                response[1].get('Error', {}).get('Code') in THROTTLE_CODES:
+            _add(_api, key(event_name), {'Throttles': 1})
+
+    def after_call(event_name, http_response=None, parsed=None, context=None, **kwargs):
+        del kwargs
+        parsed = parsed or {}
+        start = (context or {}).get('metrics_start')
+        latency = (time.perf_counter() - start) * 1000 if start else 0
+        _add(_api, key(event_name), {
+            'Calls': 1,
+            'Retries': parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0),
+            'Errors': 'Error' in parsed,
+            'ResponseBytes': len(getattr(http_response, 'content', b'') or b''),
+            'Latency': latency
+        }, {'MaxLatency': latency})
+
+    hooks = (('before-call', before_call), ('request-created', request_created),
+        ('needs-retry', needs_retry), ('after-call', after_call))
+    for event, handler in hooks:
+        events.register(event, handler, unique_id=f"metrics-{event}-{id(client)}")
+    return client
+
+
+@contextmanager
+def stage(name):
+    '''times a named stage of the handler. Stages run by several threads add up.
+    With MEMORY_PROFILE set the stage is memory profiled too'''
+    frame = memprof.enter_stage(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        memprof.leave_stage(frame)
+        _add(_stages, name, {'Duration': (time.perf_counter() - start) * 1000, 'Count': 1})
+
+
+def timed(name):
+    '''decorates a function, timing every call as the stage name'''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def reset():
+    '''forgets the totals of the previous invocation'''
+    with _lock:
+        _api.clear()
+        _stages.clear()
+
+
+def emf_documents(function_name, timestamp=None):
+    '''returns the Embedded Metric Format documents of the current totals'''
+    timestamp = int((timestamp or time.time()) * 1000)
+    documents = []
+    with _lock:
+        api = {key: dict(totals) for key, totals in _api.items()}
+        stages = {name: dict(totals) for name, totals in _stages.items()}
+
+    for (service, operation, account_id, region), totals in sorted(api.items()):
+        documents.append(dict({
+            '_aws': {'Timestamp': timestamp, 'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Function', 'Service', 'Operation']],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, unit in API_METRICS]
+            }]},
+            'Function': function_name,
+            'Service': service,
+            'Operation': operation,
+            # properties, searchable in the log line without multiplying metrics
+            'AccountId': account_id,
+            'Region': region
+        }, **{name: round(totals.get(name, 0), 3) for name, _ in API_METRICS}))
+
+    for name, totals in sorted(stages.items()):
+        documents.append(dict({
+            '_aws': {'Timestamp': timestamp, 'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Function', 'Stage']],
+                'Metrics': [{'Name': metric, 'Unit': unit} for metric, unit in STAGE_METRICS]
+            }]},
+            'Function': function_name,
+            'Stage': name
+        }, **{metric: round(totals.get(metric, 0), 3) for metric, _ in STAGE_METRICS}))
+    return documents
+
+
+def flush(function_name):
+    '''prints the totals of the invocation as EMF lines and resets them'''
+    for document in emf_documents(function_name):
+        # EMF lines have to be bare JSON, not formatted log records
+        print(json.dumps(document, separators=(',', ':')), flush=True)
+    reset()
+
+
+def emit_metrics(handler):
+    '''decorates a lambda handler: totals are collected for every invocation
+    and printed when it ends, with the memory profile when MEMORY_PROFILE is set.
+    The API calls are captured when TRACE_DIR is set'''
+    @wraps(handler)
+    def wrapper(event, context):
+        function_name = getattr(context, 'function_name', None) or handler.__module__
+        reset()
+        try:
+            with trace.invocation(handler.__module__, function_name, event), \
+                    memprof.invocation(function_name), stage('handler'):
+                return handler(event, context)
+        finally:
+            if METRICS_ENABLED:
+                flush(function_name)
+    return wrapper
@@ -0,0 +1,199 @@
+'''
+mirror.py
+Keeps the Packages indices of the local mirror (PACKAGE_MIRROR_DIR) up to date
+from a remote Debian/Ubuntu archive with pdiff patches (<index>.diff/Index).
+Patches are fetched concurrently and hashed while they are decompressed, all
+hunks are composed into one edit plan applied in a single pass over the local
+index, and the result replaces the index atomically. The remote can be an
+http(s):// or file:// URL or a local directory laid out like an archive
+'''
+
+import io
+import os
+import re
+import gzip
+import hashlib
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen
+
+from debian.debian_support import (PackageFile,
+    compose_patches,
+    iter_patched_lines,
+    patches_from_ed_script)
+
+from utils.config import MIRROR_TIMEOUT_SECONDS, PDIFF_WORKERS
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+CHUNK_SIZE = 1 << 20
+
+_whitespace_re = re.compile(r'\s+')
+
+
+def open_remote(url):
+    '''opens a remote file for reading bytes. Raises OSError when the server does
+    not answer within MIRROR_TIMEOUT_SECONDS'''
+    if '://' in url:
+        return urlopen(url, timeout=MIRROR_TIMEOUT_SECONDS)
+    return open(url, 'rb')
+
+
+def hash_file(path):
+    '''returns (sha256, number of lines) of a local file, read in chunks'''
+    digest = hashlib.sha256()
+    count = 0
+    last = b'\n'
+    with open(path, 'rb') as file:
+        while chunk := file.read(CHUNK_SIZE):
+            digest.update(chunk)
+            count += chunk.count(b'\n')
+            last = chunk[-1:]
+    # a last line without newline is a line too
+    return digest.hexdigest(), count + (last != b'\n')
+
+
+def fetch_lines(url, expected_hash=None):
+    '''downloads a gzip file, hashing the bytes while they are decompressed.
+    Returns its lines, raises ValueError when the hash differs'''
+    digest = hashlib.sha256()
+    data = io.BytesIO()
+    with open_remote(url) as remote, gzip.open(remote, 'rb') as file:
+        while chunk := file.read(CHUNK_SIZE):
+            digest.update(chunk)
+            data.write(chunk)
+    if expected_hash is not None and digest.hexdigest() != expected_hash:
+        raise ValueError(f"{url} was garbled")
+    data.seek(0)
+    return data.readlines()
+
+
+def write_temp(local, chunks):
+    '''writes chunks to a temporary file next to local.
+    Returns (temporary file, sha256 of the written bytes)'''
+    digest = hashlib.sha256()
+    directory = os.path.dirname(local) or '.'
+    os.makedirs(directory, exist_ok=True)
+    handle, temp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(handle, 'wb') as file:
+            for chunk in chunks:
+                digest.update(chunk)
+                file.write(chunk)
+            file.flush()
+            os.fsync(file.fileno())
+    except BaseException:
+        os.unlink(temp)
+        raise
+    return temp, digest.hexdigest()
+
+
+def replace_file(temp, local, expected_hash, digest):
+    '''moves the temporary file over local when its hash is the expected one'''
+    if expected_hash is not None and digest != expected_hash:
+        os.unlink(temp)
+        raise ValueError(f"patch failed, got {digest} instead of {expected_hash}")
+    os.replace(temp, local)
+
+
+def download_index(remote, local, expected_hash=None):
+    '''downloads the full gzip compressed index, hashing while decompressing'''
+    with open_remote(remote + '.gz') as response, gzip.open(response, 'rb') as file:
+        temp, digest = write_temp(local, iter(lambda: file.read(CHUNK_SIZE), b''))
+    replace_file(temp, local, expected_hash, digest)
+    return 'downloaded'
+
+
+def read_diff_index(remote):
+    '''returns the SHA256 fields of the pdiff Index of a remote index as
+    (current hash, [(hash, patch name)] history, {patch name: hash}, merged)'''
+    url = remote + '.diff/Index'
+    with open_remote(url) as response:
+        fields = [field for record in PackageFile(url, response) for field in record]
+
+    current = None
+    history = []
+    patch_hashes = {}
+    merged = False
+    for field, value in fields:
+        if field == 'SHA256-Current':
+            current = _whitespace_re.split(value)[0]
+        elif field == 'SHA256-History':
+            for entry in value.splitlines():
+                if entry:
+                    hist_hash, _, patch_name = _whitespace_re.split(entry)
+                    history.append((hist_hash, patch_name))
+        elif field == 'SHA256-Patches':
+            for entry in value.splitlines():
+                if entry:
+                    patch_hash, _, patch_name = _whitespace_re.split(entry)
+                    patch_hashes[patch_name] = patch_hash
+        elif field == 'X-Patch-Precedence':
+            # every patch of merged pdiffs leads to the current version
+            merged = value == 'merged'
+    return current, history, patch_hashes, merged
+
+
+def patch_names(local_hash, history, merged):
+    '''returns the names of the patches to apply to the local version'''
+    names = []
+    for hist_hash, patch_name in history:
+        # after the first patch, all remaining patches have to be applied
+        if names or hist_hash == local_hash:
+            names.append(patch_name)
+    return names[:1] if merged else names
+
+
+def update_index(remote, local, workers=PDIFF_WORKERS):
+    '''brings the local copy of a remote index (URL or path without .gz) up to date.
+    Returns "current", "patched" or "downloaded"'''
+    if not os.path.exists(local):
+        return download_index(remote, local)
+    try:
+        current, history, patch_hashes, merged = read_diff_index(remote)
+    except (OSError, ValueError) as err:
+        log.info(f"No usable pdiff Index for {remote}, downloading the index - {err}")
+        return download_index(remote, local)
+
+    local_hash, size = hash_file(local)
+    if local_hash == current:
+        return 'current'
+
+    names = patch_names(local_hash, history, merged)
+    if not names or any(name not in patch_hashes for name in names):
+        log.info(f"{local} is not in the pdiff history of {remote}, downloading the index")
+        return download_index(remote, local, current)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        patches = list(executor.map(lambda name: fetch_lines(
+            f"{remote}.diff/{name}.gz", patch_hashes[name]), names))
+
+    try:
+        edits = compose_patches([patches_from_ed_script(patch) for patch in patches], size)
+    except ValueError as err:
+        log.info(f"Invalid patch for {remote}, downloading the index - {err}")
+        return download_index(remote, local, current)
+
+    with open(local, 'rb') as file:
+        temp, digest = write_temp(local, iter_patched_lines(file, edits))
+    replace_file(temp, local, current, digest)
+    log.info(f"Applied {len(names)} patches ({len(edits)} edits) to {local}")
+    return 'patched'
+
+
+def sync_indices(remote_root, mirror_dir, paths):
+    '''updates the indices at paths (relative to the archive root, e.g.
+    dists/jammy-updates/main/binary-amd64/Packages) in the local mirror.
+    Returns {path: result of update_index or "failed"}'''
+    results = {}
+    for path in paths:
+        remote = remote_root.rstrip('/') + '/' + path
+        local = os.path.join(mirror_dir, path)
+        try:
+            results[path] = update_index(remote, local)
+        except (OSError, ValueError) as err:
+            log.error(f"Could not update {local} from {remote} - {err}")
+            results[path] = 'failed'
+    return results
@@ -0,0 +1,144 @@
+'''
+sampling.py
+Sampling mode of the scans: instead of every instance, list_instances draws
+a stratified random sample per (account, region, platform) and only the
+sample is validated. The sample size of a stratum is given, or derived from
+a target margin of error with Cochran's formula and the finite population
+correction. Findings of a sampled scan carry their stratum population and
+sample size, from which Rollup estimates the compliance of the fleet (or of
+any grouping) with confidence intervals
+'''
+
+import math
+import random
+from statistics import NormalDist
+
+# sampling of a scan, e.g. {'Size': 30} or {'MarginOfError': 5, 'Confidence': 0.95}.
+# The margin of error is in compliance percentage points
+DEFAULT_CONFIDENCE = 0.95
+# standard deviation of instance compliance percentages assumed to size samples.
+# Scores are bounded by 0 and 100, 50 is the worst case
+ASSUMED_STDDEV = 50
+
+GROUPINGS = {
+    'fleet': lambda stratum: ('fleet',),
+    'account': lambda stratum: stratum[:1],
+    'region': lambda stratum: stratum[1:2],
+    'platform': lambda stratum: stratum[2:],
+    'account-region': lambda stratum: stratum[:2],
+}
+
+
+def z_score(confidence):
+    '''returns the two-sided standard normal quantile of a confidence level'''
+    return NormalDist().inv_cdf((1 + confidence) / 2)
+
+
+def sample_size(population, sampling):
+    '''returns the number of instances to sample out of population. Strata of
+    several instances get at least 2, the spread of a single score is unknown'''
+    if 'Size' in sampling:
+        size = int(sampling['Size'])
+    else:
+        z_value = z_score(sampling.get('Confidence', DEFAULT_CONFIDENCE))
+        # Cochran's sample size for an infinite population, then the finite
+        # population correction
+        infinite = (z_value * ASSUMED_STDDEV / float(sampling['MarginOfError'])) ** 2
+        size = math.ceil(infinite / (1 + (infinite - 1) / population))
+    return max(min(2, population), min(population, size))
+
+
+def draw(instances, sampling, seed):
+    '''returns the sampled instances and {(platform name, platform version):
+    {'Population', 'Size'}} of the strata. seed makes the draw repeatable, an
+    account-region listed again by a later invocation gets the same sample'''
+    strata = {}
+    for instance in instances:
+        strata.setdefault((instance['PlatformName'], instance['PlatformVersion']),
+            []).append(instance)
+
+    rand = random.Random(seed)
+    sampled = []
+    samples = {}
+    for platform, members in sorted(strata.items()):
+        size = sample_size(len(members), sampling)
+        sampled.extend(rand.sample(members, size))
+        samples[platform] = {'Population': len(members), 'Size': size}
+    return sampled, samples
+
+
+def mean_variance(scores, population):
+    '''returns the variance of the mean of scores sampled out of population.
+    A single score has the spread of ASSUMED_STDDEV'''
+    count = len(scores)
+    if count >= population:
+        # a census has no sampling error
+        return 0.0
+    if count > 1:
+        mean = sum(scores) / count
+        spread = sum((score - mean) ** 2 for score in scores) / (count - 1)
+    else:
+        spread = ASSUMED_STDDEV ** 2
+    # finite population correction
+    return (1 - count / population) * spread / count
+
+
+class Rollup:
+    '''estimates compliance from the findings of a scan, sampled or not'''
+
+    def __init__(self, score='CompliancePercentage'):
+        self.score = score
+        # {(account id, region, platform name, platform version):
+        #  {'Population', 'Scores': {instance id: score}}}
+        self.strata = {}
+
+    def add(self, finding):
+        '''adds a findings record. Findings without a Sample are a census of
+        their stratum. Duplicates (queue redeliveries) count once'''
+        if self.score == 'CompliancePercentage':
+            score = finding.get('CompliancePercentage')
+        else:
+            score = finding.get('Scores', {}).get(self.score)
+        if score is None:
+            return
+        key = (finding['AccountId'], finding['Region'], finding['PlatformName'],
+            finding['PlatformVersion'])
+        stratum = self.strata.setdefault(key, {'Population': 0, 'Scores': {}})
+        stratum['Scores'][finding['InstanceId']] = score
+        stratum['Population'] = max(stratum['Population'],
+            finding.get('Sample', {}).get('Population', 0), len(stratum['Scores']))
+
+    def estimates(self, grouping='fleet', confidence=DEFAULT_CONFIDENCE):
+        '''returns {group: {'Estimate', 'Low', 'High', 'Population', 'Sampled',
+        'Unbounded'}}, the stratified mean compliance percentage and its confidence
+        interval. Strata with a single score out of several instances (samples of 1,
+        instances that failed validation) have no observed spread: ASSUMED_STDDEV is
+        used for them and the estimate is reported as Unbounded'''
+        groups = {}
+        for key, stratum in self.strata.items():
+            groups.setdefault(GROUPINGS[grouping](key), []).append(stratum)
+
+        z_value = z_score(confidence)
+        estimates = {}
+        for group, strata in sorted(groups.items()):
+            population = sum(stratum['Population'] for stratum in strata)
+            mean = variance = 0.0
+            unbounded = False
+            for stratum in strata:
+                scores = list(stratum['Scores'].values())
+                count = len(scores)
+                weight = stratum['Population'] / population
+                mean += weight * sum(scores) / count
+                variance += weight ** 2 * mean_variance(scores, stratum['Population'])
+                # a single score out of several instances has no observed spread
+                unbounded |= count == 1 < stratum['Population']
+            margin = z_value * math.sqrt(variance)
+            estimates[group] = {
+                'Estimate': round(mean, 2),
+                'Low': round(max(0.0, mean - margin), 2),
+                'High': round(min(100.0, mean + margin), 2),
+                'Population': population,
+                'Sampled': sum(len(stratum['Scores']) for stratum in strata),
+                'Unbounded': unbounded
+            }
+        return estimates
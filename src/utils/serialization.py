@@ -0,0 +1,50 @@
+'''
+serialization.py
+Pre-serialized JSON payload templates for per-instance messages.
+Fields shared by every message of a scan (baselines, scan and account
+details) are encoded once, only the per-instance fields are encoded per message.
+Payloads are checked against the AWS size limits before they are sent
+'''
+
+import json
+
+# fields describing one baseline in messages to validate_instance_compliance
+BASELINE_FIELDS = ('ComplaintPackages', 'BaselineId', 'PreviousBaselineId', 'BaselineDiff')
+
+# bytes of an EventBridge PutEvents request, an SQS message and a DynamoDB item
+EVENTS_MAX_BYTES = 256 * 1024
+MESSAGE_MAX_BYTES = 256 * 1024
+ITEM_MAX_BYTES = 400 * 1024
+
+
+class PayloadTooLarge(ValueError):
+    '''payload AWS would reject for its size'''
+
+
+def check_size(payload, limit, what):
+    '''raises PayloadTooLarge when the UTF-8 encoded payload is over limit bytes'''
+    if (size := len(payload.encode('utf8'))) > limit:
+        raise PayloadTooLarge(f"{what} of {size} bytes is over the {limit} bytes limit. \
+Baselines are carried whole, reduce the packages of the largest baselines \
+(e.g. fewer index_components for package index images)")
+
+
+class PayloadTemplate:
+    '''JSON object whose shared fields are encoded once.
+
+    render(fields) returns the same text as
+    json.dumps({**fields, **shared}, default=str), encoding only fields.
+    fields must not repeat keys of the shared part'''
+
+    def __init__(self, shared):
+        # encoded shared members without the surrounding braces
+        self.shared = json.dumps(shared, default=str)[1:-1]
+
+    def render(self, fields):
+        '''returns the JSON document for one message'''
+        own = json.dumps(fields, default=str)
+        if not self.shared:
+            return own
+        if own == '{}':
+            return '{' + self.shared + '}'
+        return own[:-1] + ', ' + self.shared + '}'
@@ -0,0 +1,186 @@
+'''
+store.py
+Small key-value state store shared by the PatchInspect functions.
+Uses DynamoDB when PATCH_INSPECT_TABLE_NAME is set, otherwise JSON files
+in a local directory (local runs and tests)
+'''
+
+import os
+import json
+import time
+import logging
+import hashlib
+from contextlib import contextmanager
+
+from utils.config import (CLAIM_LEASE_SECONDS, PATCH_INSPECT_TABLE_NAME, SCAN_CLAIM_TTL,
+    STATE_DIR)
+from utils.helpers import get_resource
+from utils.serialization import ITEM_MAX_BYTES, check_size
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+_STORE = None
+
+
+class DynamoStore:
+    '''stores JSON values in a DynamoDB table keyed by "pk".
+    Items carry an "expires_at" attribute used as the table TTL'''
+
+    def __init__(self, table):
+        self.table = table
+
+    def get(self, key):
+        '''returns the value stored for key or None when missing or expired'''
+        if (item := self.table.get_item(Key={'pk': key}).get('Item')) is None:
+            return None
+        # DynamoDB deletes expired items lazily, so check the expiry ourselves
+        if 'expires_at' in item and int(item['expires_at']) < time.time():
+            return None
+        return json.loads(item['data'])
+
+    def put(self, key, value, ttl=None):
+        '''stores value for key, expiring after ttl seconds if given'''
+        item = {
+            'pk': key,
+            'data': json.dumps(value, default=str)
+        }
+        check_size(item['data'], ITEM_MAX_BYTES, f"DynamoDB item {key}")
+        if ttl:
+            item['expires_at'] = int(time.time() + ttl)
+        self.table.put_item(Item=item)
+
+    def put_if_absent(self, key, value, ttl=None):
+        '''stores value for key unless an unexpired value is stored.
+        Returns True when value was stored'''
+        item = {
+            'pk': key,
+            'data': json.dumps(value, default=str)
+        }
+        if ttl:
+            item['expires_at'] = int(time.time() + ttl)
+        try:
+            self.table.put_item(Item=item,
+                ConditionExpression='attribute_not_exists(pk) OR expires_at < :now',
+                ExpressionAttributeValues={':now': int(time.time())})
+        except self.table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def delete(self, key):
+        '''removes key from the store'''
+        self.table.delete_item(Key={'pk': key})
+
+
+class LocalStore:
+    '''stores JSON values as files in a local directory'''
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        '''returns the file holding key'''
+        name = hashlib.sha256(key.encode('utf8')).hexdigest()
+        return os.path.join(self.path, f"{name}.json")
+
+    def get(self, key):
+        '''returns the value stored for key or None when missing or expired'''
+        try:
+            with open(self._file(key), 'r', encoding='utf8') as file:
+                item = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if item.get('expires_at') and item['expires_at'] < time.time():
+            return None
+        return item['data']
+
+    def put(self, key, value, ttl=None):
+        '''stores value for key, expiring after ttl seconds if given'''
+        item = {
+            'pk': key,
+            'data': value,
+            'expires_at': int(time.time() + ttl) if ttl else None
+        }
+        temp = self._file(key) + '.tmp'
+        with open(temp, 'w', encoding='utf8') as file:
+            json.dump(item, file, default=str)
+        os.replace(temp, self._file(key))
+
+    def put_if_absent(self, key, value, ttl=None):
+        '''stores value for key unless an unexpired value is stored.
+        Returns True when value was stored. Not atomic, local runs have one writer'''
+        if self.get(key) is not None:
+            return False
+        self.put(key, value, ttl)
+        return True
+
+    def delete(self, key):
+        '''removes key from the store'''
+        try:
+            os.unlink(self._file(key))
+        except FileNotFoundError:
+            pass
+
+
+def get_store():
+    '''returns the store configured for this environment'''
+    global _STORE # pylint: disable=global-statement
+    if _STORE is None:
+        if PATCH_INSPECT_TABLE_NAME:
+            table = get_resource('dynamodb').Table(PATCH_INSPECT_TABLE_NAME)
+            _STORE = DynamoStore(table)
+        else:
+            _STORE = LocalStore(STATE_DIR)
+    return _STORE
+
+
+def scan_key(scan_id, *parts):
+    '''returns the idempotency key of a unit of work of a scan, e.g. an
+    account-region listed or an instance validated'''
+    return '#'.join(['scan', scan_id, *parts])
+
+
+def acquire(store, key):
+    '''claims a unit of work, returns False when another delivery of the same work
+    holds or completed the claim. Claims of deliveries that died expire after
+    CLAIM_LEASE_SECONDS. Work without a key is always claimed'''
+    if store is None or key is None:
+        return True
+    if not store.put_if_absent(key, {'State': 'Claimed'}, ttl=CLAIM_LEASE_SECONDS):
+        log.info(f"Skipping {key}, it was already handled")
+        return False
+    return True
+
+
+def release(store, key):
+    '''gives up the claim of work that failed, so that a redelivery can do it'''
+    if store is not None and key is not None:
+        store.delete(key)
+
+
+def complete(store, key):
+    '''keeps the claim of work done for SCAN_CLAIM_TTL'''
+    if store is not None and key is not None:
+        store.put(key, {'State': 'Done'}, ttl=SCAN_CLAIM_TTL)
+
+
+@contextmanager
+def claim(store, key):
+    '''acquires the claim of a unit of work, yields False when it is to be
+    skipped. The claim is released when the work raises, completed otherwise'''
+    if not acquire(store, key):
+        yield False
+        return
+    try:
+        yield True
+    except BaseException:
+        release(store, key)
+        raise
+    complete(store, key)
+
+
+def set_store(store):
+    '''replaces the store returned by get_store, e.g. with a LocalStore in tests'''
+    global _STORE # pylint: disable=global-statement
+    _STORE = store
@@ -0,0 +1,145 @@
+'''
+trace.py
+Capture of the AWS API traffic of the lambda handlers for offline replays
+(benchmarks/replay.py). When TRACE_DIR is set every invocation writes one
+gzip compressed JSON lines file there: its event, then every call made by
+the clients of helpers.get_client with its parameters, response or error,
+HTTP status and latency. Values of the keys listed in TRACE_REDACT are
+replaced before anything is written
+'''
+
+import os
+import gzip
+import json
+import time
+import uuid
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+
+from utils.config import TRACE_DIR, TRACE_REDACT
+
+REDACTED = '<redacted>'
+DATETIME = '$datetime'
+
+_lock = threading.Lock()
+# calls of the running invocation, None when not capturing
+_CALLS = None
+
+
+def _default(value):
+    '''encodes the values JSON does not know, datetimes are decoded back by decode'''
+    if isinstance(value, datetime):
+        return {DATETIME: value.isoformat()}
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode('utf8', 'replace')
+    return str(value)
+
+
+def _decode(item):
+    '''json object hook restoring the datetimes encoded by _default'''
+    if len(item) == 1 and DATETIME in item:
+        return datetime.fromisoformat(item[DATETIME])
+    return item
+
+
+def redact(data, keys=TRACE_REDACT):
+    '''returns a copy of data with the values of keys replaced'''
+    if isinstance(data, dict):
+        return {key: REDACTED if key in keys else redact(value, keys) \
+            for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [redact(value, keys) for value in data]
+    if isinstance(data, str) and data[:1] == '{' and any(key in data for key in keys):
+        # SQS bodies and event details are JSON documents themselves
+        try:
+            return json.dumps(redact(json.loads(data), keys), default=str)
+        except ValueError:
+            pass
+    return data
+
+
+def encode(record):
+    '''returns the JSON line of a trace record'''
+    return json.dumps(record, default=_default, separators=(',', ':'))
+
+
+def decode(line):
+    '''returns the trace record of a JSON line'''
+    return json.loads(line, object_hook=_decode)
+
+
+def read_trace(path):
+    '''returns (invocation, calls) of a trace file'''
+    with gzip.open(path, 'rt', encoding='utf8') as file:
+        header = decode(file.readline())
+        return header, [decode(line) for line in file if line.strip()]
+
+
+def capture(client, account_id=None, region=None):
+    '''records the API calls of a boto3 client while an invocation is traced.
+    Clients without botocore events (e.g. fakes) are left as they are'''
+    if not TRACE_DIR or (events := getattr(getattr(client, 'meta', None),
+            'events', None)) is None:
+        return client
+    # pylint: disable=import-outside-toplevel
+    from botocore import xform_name
+    # account and region as passed to get_client, which is how replays look them up
+    service = client.meta.service_model.service_name
+
+    def before_parameter_build(params=None, context=None, **kwargs):
+        del kwargs
+        if _CALLS is not None and context is not None:
+            # copied right away, botocore handlers may still change params
+            context['trace'] = (time.perf_counter(), json.loads(encode(redact(params or {}))))
+
+    def after_call(http_response=None, parsed=None, model=None, context=None, **kwargs):
+        del kwargs
+        if _CALLS is None or (started := (context or {}).get('trace')) is None:
+            return
+        start, params = started
+        response = {key: value for key, value in (parsed or {}).items() \
+            if key != 'ResponseMetadata'}
+        record = encode({
+            'Service': service,
+            'Method': xform_name(model.name),
+            'AccountId': account_id,
+            'Region': region,
+            'Status': getattr(http_response, 'status_code', None),
+            'Latency': round(time.perf_counter() - start, 6),
+            'Params': params,
+            'Response': redact(response)
+        })
+        with _lock:
+            if _CALLS is not None:
+                _CALLS.append(record)
+
+    events.register('before-parameter-build', before_parameter_build,
+        unique_id=f"trace-params-{id(client)}")
+    events.register('after-call', after_call, unique_id=f"trace-call-{id(client)}")
+    return client
+
+
+@contextmanager
+def invocation(handler, function_name, event):
+    '''captures the API calls of an invocation of the handler module when
+    TRACE_DIR is set and writes them to its trace file'''
+    global _CALLS # pylint: disable=global-statement
+    if not TRACE_DIR or _CALLS is not None:
+        yield
+        return
+    header = encode(redact({'Handler': handler, 'Function': function_name, 'Event': event,
+        'CapturedAt': datetime.utcnow()}))
+    _CALLS = []
+    try:
+        yield
+    finally:
+        with _lock:
+            calls, _CALLS = _CALLS, None
+        os.makedirs(TRACE_DIR, exist_ok=True)
+        name = f"{handler}-{datetime.utcnow():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+        with gzip.open(os.path.join(TRACE_DIR, f"{name}.jsonl.gz"), 'wt',
+                encoding='utf8') as file:
+            file.write(header + '\n')
+            for call in calls:
+                file.write(call + '\n')
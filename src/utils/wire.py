@@ -0,0 +1,139 @@
+'''
+wire.py
+Compact encoding of package maps ({name: version}) travelling between the
+functions in events, SQS messages and the state store.
+
+Encoded form (version 1), before optional compression:
+    {"_pkgs": 1, "names": "...", "segments": "...", "versions": "..."}
+- names are sorted and front-coded, one "<shared prefix length> <suffix>" per line
+- versions are split in front of ".", "-", ":", "+" and "~"; every distinct
+  segment is stored once in "segments" (one per line) and each version is
+  written as its base 36 segment indexes joined by ".", versions separated by spaces
+Compressed form is the zlib compressed JSON document in base64, prefixed with
+"pkgz1:". Plain JSON maps (messages from older releases) are still accepted.
+'''
+
+import re
+import json
+import zlib
+import base64
+from functools import lru_cache
+
+from utils.config import COMPACT_WIRE_FORMAT
+
+WIRE_VERSION = 1
+COMPRESSED_PREFIX = f"pkgz{WIRE_VERSION}:"
+
+_segment_re = re.compile(r'[.\-:+~]?[^.\-:+~]*')
+_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def _base36(number):
+    '''returns number in base 36'''
+    digits = ''
+    while True:
+        number, digit = divmod(number, 36)
+        digits = _DIGITS[digit] + digits
+        if not number:
+            return digits
+
+
+def encode_pairs(pairs, compress=True):
+    '''encodes a list of (name, version) pairs.
+    Returns a str when compressed, otherwise a JSON serializable dict'''
+    names = []
+    segments = {}
+    versions = []
+
+    previous = ''
+    for name, version in sorted(pairs):
+        shared = 0
+        limit = min(len(name), len(previous))
+        while shared < limit and name[shared] == previous[shared]:
+            shared += 1
+        names.append(f"{_base36(shared)} {name[shared:]}")
+        previous = name
+
+        versions.append('.'.join([_base36(segments.setdefault(segment, len(segments))) \
+            for segment in _segment_re.findall(version)[:-1]]))
+
+    encoded = {
+        '_pkgs': WIRE_VERSION,
+        'names': '\n'.join(names),
+        'segments': '\n'.join(segments),
+        'versions': ' '.join(versions)
+    }
+    if not compress:
+        return encoded
+    data = zlib.compress(json.dumps(encoded, separators=(',', ':')).encode('utf8'), 9)
+    return COMPRESSED_PREFIX + base64.b64encode(data).decode('ascii')
+
+
+def decode_pairs(value):
+    '''decodes the output of encode_pairs. Plain lists of pairs and plain
+    {name: version} maps are returned as lists of pairs'''
+    if isinstance(value, str):
+        return list(_decode_text(value))
+    if isinstance(value, dict) and '_pkgs' in value:
+        return list(_decode(value))
+    if isinstance(value, dict):
+        return list(value.items())
+    return [tuple(pair) for pair in value]
+
+
+def encode_packages(packages, compress=True):
+    '''encodes a {name: version} map for transport, unless COMPACT_WIRE_FORMAT is off'''
+    if not COMPACT_WIRE_FORMAT:
+        return packages
+    return encode_pairs(packages.items(), compress)
+
+
+def encode_inventory(pairs):
+    '''encodes inventory (name, version) pairs, unless COMPACT_WIRE_FORMAT is off'''
+    if not COMPACT_WIRE_FORMAT:
+        return [list(pair) for pair in pairs]
+    return encode_pairs(pairs)
+
+
+def decode_packages(value):
+    '''returns the {name: version} map of an encoded or plain package map.
+    Decoded maps are shared between callers and must not be modified'''
+    if isinstance(value, str):
+        return _decode_map(value)
+    if isinstance(value, dict) and '_pkgs' not in value:
+        return value
+    return dict(decode_pairs(value))
+
+
+@lru_cache(maxsize=32)
+def _decode_map(text):
+    '''decodes a compressed package map. Every message of a batch carries
+    the same baselines, so they are decoded once'''
+    return dict(_decode_text(text))
+
+
+@lru_cache(maxsize=32)
+def _decode_text(text):
+    '''decompresses and decodes the pairs of a compressed package map'''
+    if not text.startswith(COMPRESSED_PREFIX):
+        raise ValueError(f"unknown package map encoding {text[:8]!r}")
+    data = zlib.decompress(base64.b64decode(text[len(COMPRESSED_PREFIX):]))
+    return tuple(_decode(json.loads(data)))
+
+
+def _decode(encoded):
+    '''decodes the pairs of an uncompressed package map'''
+    if encoded['_pkgs'] != WIRE_VERSION:
+        raise ValueError(f"unsupported package map version {encoded['_pkgs']}")
+    if not encoded['names']:
+        return []
+    segments = {_base36(index): segment \
+        for index, segment in enumerate(encoded['segments'].split('\n'))}
+    pairs = []
+    name = ''
+    for line, version in zip(encoded['names'].split('\n'), encoded['versions'].split(' ')):
+        shared, suffix = line.split(' ', 1)
+        name = name[:int(shared, 36)] + suffix
+        pairs.append((name, ''.join([segments[i] for i in version.split('.')]) \
+            if version else ''))
+    return pairs
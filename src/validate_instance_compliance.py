@@ -4,93 +4,97 @@ validates if all packages of an server are patch compliant
 '''
 
 import json
-import logging
 
 from datetime import datetime
-from debian.debian_support import version_compare as vc
 
-from utils.helpers import (publish_event, get_client,
-    get_instance_inventory, sanitize_iventory)
+from utils.compliance import assess_instance
+from utils.deadline import TimeBudget
+from utils.helpers import publish_event, get_client
+from utils.logs import SAMPLED, Message, Payload, configure_logging
+from utils.memprof import record
+from utils.metrics import emit_metrics, stage
+from utils.serialization import PayloadTemplate
+from utils.store import claim, get_store, scan_key
 
-default_log_args = {
-    "level": logging.INFO,
-    "format": "%(asctime)s [%(levelname)s] %(filename)s-%(lineno)d %(message)s",
-    "datefmt": "%Y-%m-%d %H:%M:%S",
-    "force": True,
-}
+log = configure_logging()
 
-logging.basicConfig(**default_log_args)
-log = logging.getLogger()
+# findings fields identical for every instance of an account, region and scan
+SHARED_FINDINGS_FIELDS = ('TypeName', 'Region', 'AccountId', 'AccountName', 'ScanType', 'ScanTime',
+    'ScanId')
 
 
+@emit_metrics
 def lambda_handler(event, context):
     '''lambda handlers to compare instance inventory with compliant instance inventory'''
-    del context
-    log.info(f"event - {json.dumps(event, default=str)}")
-
-    body_0 = event['Records'][0]['body']
-    account_id = body_0['AccountId']
-    region = body_0['Region']
+    log.info(Message("Event - {}", Payload(event)))
+    budget = TimeBudget(context)
 
     events = get_client('events')
-
-    first_record = True
-    for message in event['Records']:
-        entries = []
-        body = json.loads(message['body'])
-
-        if not(account_id == body['AccountId'] and region == body['Region']) or first_record:
-            account_id = body['AccountId']
-            region = body['Region']
-            ssm = get_client('ssm', region, account_id)
-            first_record = False
-
-        log.info(f"Initializing patch compliance for instance Id - {body['InstanceId']}")
-
-        complaint_packages = body.get('ComplaintPackages')
-
-        instance_inventory = get_instance_inventory(body['InstanceId'], ssm)
-
-        if instance_inventory['Entries'] == []:
-            instance_inventory['CompliancePercentage'] = 0
-        else:
-            # Compare packages versions with compliant versions
-            count_packages = 0
-            total_packages = 0
-            for entry in instance_inventory['Entries']:
-                if entry['Name'] in complaint_packages:
-                    total_packages += 1
-                    entry['CompliantVersion'] = complaint_packages[entry['Name']]
-                    res = vc(complaint_packages[entry['Name']], entry['Version'])
-                    if res > 0: # pylint: disable=consider-using-assignment-expr
-                        # compliant package version in greater
-                        entry['Compliant'] = False
-                    else:
-                        # compliant package version in lower or same
-                        entry['Compliant'] = True
-                        count_packages += 1
-            if count_packages == 0:
-                instance_inventory['CompliancePercentage'] = 0
-            else:
-                instance_inventory['CompliancePercentage'] = \
-                    int(round(count_packages*100/total_packages, 2))
-
-        instance_inventory = sanitize_iventory(instance_inventory, body)
-        log.info(f"Instance({instance_inventory['InstanceId']})patch \
-            compliance %age - {instance_inventory['CompliancePercentage']}")
-
-        entry = {
-            'Time': datetime.now(),
-            'Source': 'patchInspect',
-            'Detail': json.dumps(instance_inventory, default=str),
-            'DetailType': 'findings',
-            'EventBusName': 'default'
-        }
-
-        entries.append(entry)
-        publish_event(entries, events)
+    store = get_store()
+    templates = {}
+    # SSM client per (account, region), records of a batch mostly share one
+    clients = {}
+
+    # records not validated are returned to the queue (ReportBatchItemFailures)
+    failures = []
+    for index, message in enumerate(event['Records']):
+        if not budget.allows():
+            log.info(f"Out of time, returning {len(event['Records']) - index} \
+                records to the queue")
+            failures.extend(record['messageId'] for record in event['Records'][index:])
+            break
+
+        try:
+            with budget.unit(), record(message['messageId']):
+                validate_record(json.loads(message['body']), clients, events, store, templates)
+        except Exception as err: # pylint: disable=broad-except
+            log.error(f"Could not validate message {message['messageId']} - {err}")
+            failures.append(message['messageId'])
 
     return {
         'statusCode' : 200,
-        'Message' : 'Completed successfully'
+        'Message' : 'Completed successfully',
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failures]
+    }
+
+
+def validate_record(body, clients, events, store, templates):
+    '''validates the instance of one message and publishes its findings.
+    Redeliveries of an instance already validated in the scan are skipped'''
+    key = scan_key(body['ScanId'], body['AccountId'], body['Region'], body['InstanceId']) \
+        if body.get('ScanId') else None
+    with claim(store, key) as claimed:
+        if claimed:
+            publish_findings(body, clients, events, store, templates)
+
+
+def publish_findings(body, clients, events, store, templates):
+    '''validates the instance of one message and publishes its findings'''
+    entries = []
+    if (client_key := (body['AccountId'], body['Region'])) not in clients:
+        clients[client_key] = get_client('ssm', body['Region'], body['AccountId'])
+    ssm = clients[client_key]
+
+    log.info(Message("Initializing patch compliance for instance Id - {}",
+        body['InstanceId']), extra=SAMPLED)
+
+    instance_inventory = assess_instance(body, ssm, store)
+    log.info(Message("Instance({})patch compliance %age - {}",
+        instance_inventory['InstanceId'], instance_inventory['CompliancePercentage']),
+        extra=SAMPLED)
+
+    shared = {field: instance_inventory.pop(field, '-') for field in SHARED_FINDINGS_FIELDS}
+    if (template_key := tuple(shared.values())) not in templates:
+        templates[template_key] = PayloadTemplate(shared)
+
+    entry = {
+        'Time': datetime.now(),
+        'Source': 'patchInspect',
+        'Detail': templates[template_key].render(instance_inventory),
+        'DetailType': 'findings',
+        'EventBusName': 'default'
     }
+
+    entries.append(entry)
+    with stage('publish_findings'):
+        publish_event(entries, events)
@@ -0,0 +1,16 @@
+'''
+conftest.py
+Tests import the lambda code from src/, the same way the lambda runtime does,
+and the in-memory fakes of benchmarks/. State is kept in local stores
+'''
+
+import os
+import sys
+
+os.environ.setdefault('METRICS_ENABLED', 'false')
+os.environ['PATCH_INSPECT_TABLE_NAME'] = ''
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for directory in ('src', 'benchmarks'):
+    if (path := os.path.join(ROOT, directory)) not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,170 @@
+'''
+test_arch_table.py
+CompiledDpkgArchTable of debian._arch_table must give the results and raise
+the exceptions of DpkgArchTable for every architecture, wildcard and
+restriction list, in its scalar and batch APIs
+'''
+
+import random
+import itertools
+
+import pytest
+
+from debian._arch_table import DpkgArchTable, CompiledDpkgArchTable
+
+TUPLETABLE = '''# Version=1.0
+eabihf-musl-linux-arm\tmusl-linux-armhf
+base-musl-linux-<cpu>\tmusl-linux-<cpu>
+eabihf-gnu-linux-arm\tarmhf
+eabi-gnu-linux-arm\tarmel
+x32-gnu-linux-amd64\tx32
+base-gnu-linux-<cpu>\t<cpu>
+base-gnu-kfreebsd-<cpu>\tkfreebsd-<cpu>
+base-gnu-hurd-<cpu>\thurd-<cpu>
+'''
+CPUTABLE = '''# Version=1.0
+amd64\tx86_64\tx86_64\t64\tlittle
+arm\tarm.*\tarm.*\t32\tlittle
+arm64\taarch64\taarch64\t64\tlittle
+i386\ti686\t(i[34567]86|pentium)\t32\tlittle
+mips64el\tmips64el\tmips64el\t64\tlittle
+'''
+# architectures, wildcards, aliases that are not in the tables and names in the wrong case
+NAMES = ['amd64', 'i386', 'arm', 'armhf', 'armel', 'arm64', 'x32', 'mips64el', 'linux-amd64',
+    'linux-armhf', 'kfreebsd-amd64', 'kfreebsd-i386', 'hurd-i386', 'musl-linux-arm64',
+    'musl-linux-armhf', 'any', 'linux-any', 'any-amd64', 'any-arm', 'any-i386', 'any-mips64el',
+    'kfreebsd-any', 'hurd-any', 'gnu-any-any', 'musl-any-any', 'gnu-linux-any',
+    'eabihf-any-any-any', 'any-any-linux-any', 'all', 'foo', 'any-foo', 'linux-foo', 'AMD64',
+    'Linux-Any', '']
+# restriction lists with their results decided by the first match, by negatives only, by
+# nothing, or raising on mixing and unknown names
+RESTRICTIONS = [
+    [], [''], ['amd64'], ['AMD64'], ['linux-any'], ['any'], ['any-arm', 'i386'],
+    ['kfreebsd-any', 'hurd-any'], ['!amd64'], ['!linux-any'], ['!amd64', '!i386'],
+    ['!any-arm', '', '!x32'], ['!AMD64'], ['amd64', '!i386'], ['!linux-amd64', 'linux-any'],
+    ['linux-any', '!amd64'], ['!any', 'any'], ['foo'], ['!foo'], ['amd64', 'foo'],
+    ['foo', 'amd64'], ['!amd64', 'foo'], ['all'], ['any-foo'], ['gnu-any-any', '!musl-any-any'],
+]
+
+
+# pytest fixtures are parameters named after them
+# pylint: disable=redefined-outer-name
+
+
+@pytest.fixture(scope='module')
+def table_dir(tmp_path_factory):
+    '''a directory with the dpkg tables'''
+    path = tmp_path_factory.mktemp('dpkg')
+    (path / 'tupletable').write_text(TUPLETABLE, encoding='utf-8')
+    (path / 'cputable').write_text(CPUTABLE, encoding='utf-8')
+    return path
+
+
+@pytest.fixture(scope='module')
+def tables(table_dir):
+    '''the reference table and the compiled table, without the cache'''
+    return (DpkgArchTable.load_arch_table(table_dir),
+        CompiledDpkgArchTable.load_arch_table(table_dir, use_cache=False))
+
+
+def outcome(method, *args, **kwargs):
+    '''returns the result of a call, or the type of the exception it raised'''
+    try:
+        return method(*args, **kwargs)
+    except (KeyError, ValueError, IndexError) as error:
+        return type(error)
+
+
+def matches(table):
+    '''returns matches_architecture and architecture_equals for all pairs of names'''
+    return [(outcome(table.matches_architecture, name, alias),
+        outcome(table.architecture_equals, name, alias))
+        for name, alias in itertools.product(NAMES, repeat=2)]
+
+
+def concerned(table, restrictions, allow_mixing):
+    '''returns architecture_is_concerned for every name'''
+    return [outcome(table.architecture_is_concerned, name, restrictions,
+        allow_mixing_positive_and_negative=allow_mixing) for name in NAMES]
+
+
+def test_matches(tables):
+    '''aliases and equality match the same names'''
+    reference, compiled = tables
+    assert matches(compiled) == matches(reference)
+
+
+@pytest.mark.parametrize('name', NAMES)
+def test_is_wildcard(tables, name):
+    '''the same names are wildcards'''
+    reference, compiled = tables
+    assert outcome(compiled.is_wildcard, name) == outcome(reference.is_wildcard, name)
+
+
+@pytest.mark.parametrize('restrictions', RESTRICTIONS)
+@pytest.mark.parametrize('allow_mixing', [False, True])
+def test_concerned(tables, restrictions, allow_mixing):
+    '''restriction lists concern the same names and raise the same exceptions'''
+    reference, compiled = tables
+    assert concerned(compiled, restrictions, allow_mixing) == \
+        concerned(reference, restrictions, allow_mixing)
+
+
+@pytest.mark.parametrize('seed', range(100))
+@pytest.mark.parametrize('allow_mixing', [False, True])
+def test_random_restrictions(tables, seed, allow_mixing):
+    '''random restriction lists concern the same names'''
+    reference, compiled = tables
+    rand = random.Random(seed)
+    negative = rand.random() < 0.4
+    restrictions = []
+    for name in rand.sample(NAMES, rand.randint(1, 5)):
+        if name and (negative or rand.random() < 0.1):
+            name = '!' + name
+        restrictions.append(name)
+    assert concerned(compiled, restrictions, allow_mixing) == \
+        concerned(reference, restrictions, allow_mixing)
+
+
+def test_matches_architectures(tables):
+    '''the batch API gives the results of matches_architecture'''
+    reference, compiled = tables
+    pairs = [(name, alias) for name, alias in itertools.product(NAMES, repeat=2) if name]
+    assert compiled.matches_architectures(pairs) == \
+        [reference.matches_architecture(name, alias) for name, alias in pairs]
+
+
+@pytest.mark.parametrize('seed', range(100))
+@pytest.mark.parametrize('allow_mixing', [False, True])
+def test_batch_concerned(tables, seed, allow_mixing):
+    '''the batch API gives the results of architecture_is_concerned, or its first exception'''
+    reference, compiled = tables
+    rand = random.Random(seed)
+    # a raising list in some batches only, so that most batches run to the end
+    lists = [restrictions for restrictions in RESTRICTIONS
+        if not any(isinstance(result, type) for result in concerned(reference, restrictions,
+            allow_mixing))]
+    pairs = [(rand.choice(NAMES[:-1]), rand.choice(lists)) for _ in range(200)]
+    if rand.random() < 0.3:
+        pairs.insert(rand.randint(0, len(pairs)), (rand.choice(NAMES[:-1]),
+            rand.choice(RESTRICTIONS)))
+    expected = [outcome(reference.architecture_is_concerned, name, restrictions,
+        allow_mixing_positive_and_negative=allow_mixing) for name, restrictions in pairs]
+    if raised := [result for result in expected if isinstance(result, type)]:
+        with pytest.raises(raised[0]):
+            compiled.architectures_are_concerned(pairs, allow_mixing)
+    else:
+        assert compiled.architectures_are_concerned(pairs, allow_mixing) == expected
+
+
+def test_cached_table(tables, table_dir, tmp_path):
+    '''a table loaded from its cached compiled form gives the same results'''
+    reference, _ = tables
+    first = CompiledDpkgArchTable.load_arch_table(table_dir, cache_dir=tmp_path)
+    assert len(list(tmp_path.glob('*.marshal'))) == 1
+    cached = CompiledDpkgArchTable.load_arch_table(table_dir, cache_dir=tmp_path)
+    assert matches(first) == matches(cached) == matches(reference)
+    assert [cached.is_wildcard(name) for name in NAMES] == \
+        [reference.is_wildcard(name) for name in NAMES]
+    for restrictions in RESTRICTIONS:
+        assert concerned(cached, restrictions, False) == concerned(reference, restrictions, False)
@@ -0,0 +1,165 @@
+'''
+test_claims.py
+Claims of the units of work of a scan (utils.store) and the skipping of
+redelivered instance messages by validate_instance_compliance
+'''
+
+# pytest fixtures are parameters named after them
+# pylint: disable=redefined-outer-name
+
+import time
+
+import pytest
+
+from fake_aws import MemoryStore
+import validate_instance_compliance
+from utils import store as store_module
+from utils.store import LocalStore, acquire, claim, complete, release, scan_key
+
+KEY = scan_key('scan-1', '100000000000', 'us-east-1', 'i-0001')
+
+
+@pytest.fixture(params=['memory', 'local'])
+def store(request, tmp_path):
+    '''both stores used without DynamoDB'''
+    return MemoryStore() if request.param == 'memory' else LocalStore(str(tmp_path))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    '''time.time of the stores, advanced by the tests'''
+    now = [time.time()]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    return now
+
+
+def test_scan_key():
+    '''claim keys are built from the scan id and the parts of the work'''
+    assert KEY == 'scan#scan-1#100000000000#us-east-1#i-0001'
+
+
+def test_acquire_once(store):
+    '''a unit of work is claimed once'''
+    assert acquire(store, KEY)
+    assert not acquire(store, KEY)
+    assert store.get(KEY) == {'State': 'Claimed'}
+
+
+def test_release_allows_retry(store):
+    '''released work can be claimed again'''
+    assert acquire(store, KEY)
+    release(store, KEY)
+    assert store.get(KEY) is None
+    assert acquire(store, KEY)
+
+
+def test_complete_keeps_claim(store, clock):
+    '''completed work stays claimed after the lease'''
+    assert acquire(store, KEY)
+    complete(store, KEY)
+    assert store.get(KEY) == {'State': 'Done'}
+    clock[0] += store_module.CLAIM_LEASE_SECONDS + 1
+    assert not acquire(store, KEY)
+
+
+def test_lease_expires(store, clock):
+    '''the claim of a delivery that died expires with its lease'''
+    assert acquire(store, KEY)
+    clock[0] += store_module.CLAIM_LEASE_SECONDS - 1
+    assert not acquire(store, KEY)
+    clock[0] += 2
+    assert acquire(store, KEY)
+
+
+def test_work_without_key_or_store():
+    '''work without a scan id or a store is always done'''
+    assert acquire(None, KEY)
+    assert acquire(MemoryStore(), None)
+    with claim(None, KEY) as claimed:
+        assert claimed
+
+
+def test_claim_completes(store):
+    '''claim completes the work that did not raise'''
+    with claim(store, KEY) as claimed:
+        assert claimed
+    assert store.get(KEY) == {'State': 'Done'}
+    with claim(store, KEY) as claimed:
+        assert not claimed
+
+
+def test_claim_released_on_error(store):
+    '''claim releases the work that raised'''
+    with pytest.raises(RuntimeError):
+        with claim(store, KEY):
+            raise RuntimeError('throttled')
+    assert store.get(KEY) is None
+    with claim(store, KEY) as claimed:
+        assert claimed
+
+
+@pytest.fixture
+def failing():
+    '''instance ids publish_findings fails to validate'''
+    return set()
+
+
+@pytest.fixture
+def validated(monkeypatch, failing):
+    '''instance ids passed to publish_findings, raising for ids in failing'''
+    calls = []
+
+    def publish_findings(body, clients, events, store, templates):
+        '''records the instance instead of validating it'''
+        del clients, events, store, templates
+        calls.append(body['InstanceId'])
+        if body['InstanceId'] in failing:
+            raise RuntimeError('could not validate')
+
+    monkeypatch.setattr(validate_instance_compliance, 'publish_findings', publish_findings)
+    return calls
+
+
+def message(instance_id, scan_id='scan-1'):
+    '''instance message published by list_instances'''
+    body = {'AccountId': '100000000000', 'Region': 'us-east-1', 'InstanceId': instance_id}
+    if scan_id:
+        body['ScanId'] = scan_id
+    return body
+
+
+def validate(body, store):
+    '''validates one message'''
+    validate_instance_compliance.validate_record(body, {}, None, store, {})
+
+
+def test_duplicate_skipped(store, validated):
+    '''redeliveries of an instance are not validated again'''
+    validate(message('i-0001'), store)
+    validate(message('i-0001'), store)
+    validate(message('i-0002'), store)
+    assert validated == ['i-0001', 'i-0002']
+
+
+def test_other_scan_validated_again(store, validated):
+    '''an instance is validated once per scan'''
+    validate(message('i-0001'), store)
+    validate(message('i-0001', 'scan-2'), store)
+    assert validated == ['i-0001', 'i-0001']
+
+
+def test_failure_released(store, validated, failing):
+    '''an instance that failed is validated by its redelivery'''
+    failing.add('i-0001')
+    with pytest.raises(RuntimeError):
+        validate(message('i-0001'), store)
+    failing.clear()
+    validate(message('i-0001'), store)
+    assert validated == ['i-0001', 'i-0001']
+
+
+def test_message_without_scan_id(store, validated):
+    '''messages published before scan ids are always validated'''
+    validate(message('i-0001', None), store)
+    validate(message('i-0001', None), store)
+    assert validated == ['i-0001', 'i-0001']
@@ -0,0 +1,188 @@
+'''
+test_compliance.py
+Scores of instance inventories against baselines: the incremental
+re-evaluation of cached inventories must give the scores of a full one
+'''
+
+# pytest fixtures are parameters named after them
+# pylint: disable=redefined-outer-name
+
+import random
+
+import pytest
+
+from fake_aws import MemoryStore
+from utils import compliance
+from utils.compliance import (baseline_id, cached_score, diff_baselines, evaluate_entries,
+    inventory_key, rescore)
+from utils.wire import decode_pairs
+
+VERSIONS = ['1.0', '1.0-1', '1.0-2', '1.1~rc1', '1.1', '1:0.9', '2.0+dfsg-1', '2.0']
+
+
+def random_packages(rand, names, share=0.7):
+    '''returns a {name: version} map of about share of names'''
+    return {name: rand.choice(VERSIONS) for name in names if rand.random() < share}
+
+
+def score(inventory, packages):
+    '''returns the full evaluation of inventory pairs against packages'''
+    entries = [{'Name': name, 'Version': version} for name, version in inventory]
+    result = evaluate_entries(entries, {'n-1': {'ComplaintPackages': packages}})['n-1']
+    return {'Compliant': result['Compliant'], 'Total': result['Total']}
+
+
+def test_diff_baselines():
+    '''changed, added and removed packages are listed with both versions'''
+    assert diff_baselines({'a': '1', 'b': '1', 'c': '1'}, {'a': '1', 'b': '2', 'd': '1'}) == {
+        'b': ['1', '2'],
+        'c': ['1', None],
+        'd': [None, '1']
+    }
+    assert not diff_baselines({'a': '1'}, {'a': '1'})
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_rescore_is_full_score(seed):
+    '''rescoring the packages of the baseline diff gives the full evaluation'''
+    rand = random.Random(seed)
+    names = [f"pkg{index}" for index in range(rand.randint(0, 30))]
+    inventory = list(random_packages(rand, names, 0.8).items())
+    # several versions of a package installed at once
+    if inventory and rand.random() < 0.3:
+        inventory.append((inventory[0][0], rand.choice(VERSIONS)))
+    previous = random_packages(rand, names)
+    current = dict(previous)
+    for name in names:
+        if rand.random() < 0.3:
+            # changed or added
+            current[name] = rand.choice(VERSIONS)
+        elif rand.random() < 0.15:
+            current.pop(name, None)
+
+    assert rescore(inventory, score(inventory, previous), diff_baselines(previous, current)) \
+        == score(inventory, current)
+
+
+def test_rescore_counts():
+    '''known answer: an added, a removed and an upgraded package'''
+    inventory = [('a', '1.0'), ('b', '1.0'), ('c', '2.0')]
+    previous = {'a': '1.0', 'b': '1.0'}
+    current = {'b': '1.1', 'c': '2.0'}
+    assert score(inventory, previous) == {'Compliant': 2, 'Total': 2}
+    assert rescore(inventory, {'Compliant': 2, 'Total': 2},
+        diff_baselines(previous, current)) == {'Compliant': 1, 'Total': 2}
+
+
+def cached_entry(scan_id='scan-1', baseline='old'):
+    '''cache entry of an instance scored against a baseline'''
+    return {'Inventory': [['a', '1.0']], 'CachedAt': 0, 'ScanId': scan_id,
+        'Scores': {'n-1': {'BaselineId': baseline, 'Compliant': 1, 'Total': 1}}}
+
+
+def test_cached_score_same_scan():
+    '''redeliveries within the scan reuse the score of the same baseline'''
+    assert cached_score(cached_entry(), 'n-1', {'BaselineId': 'old'}, 'scan-1') == \
+        {'BaselineId': 'old', 'Compliant': 1, 'Total': 1}
+
+
+def test_cached_score_later_scan():
+    '''later scans do not reuse the score of an unchanged baseline'''
+    assert cached_score(cached_entry(), 'n-1', {'BaselineId': 'old'}, 'scan-2') is None
+    assert cached_score(cached_entry(), 'n-1', {'BaselineId': 'old'}) is None
+
+
+def test_cached_score_new_baseline():
+    '''a moved baseline re-evaluates the changed packages of the cached inventory'''
+    baseline = {'BaselineId': 'new', 'PreviousBaselineId': 'old',
+        'BaselineDiff': {'a': ['1.0', '1.1']}}
+    assert cached_score(cached_entry(), 'n-1', baseline, 'scan-2') == \
+        {'BaselineId': 'new', 'Compliant': 0, 'Total': 1}
+
+
+def test_cached_score_unusable():
+    '''unknown scan types, baselines without ids or diffs are evaluated again'''
+    assert cached_score(cached_entry(), 'n', {'BaselineId': 'old'}, 'scan-1') is None
+    assert cached_score(cached_entry(), 'n-1', {}, 'scan-1') is None
+    assert cached_score(cached_entry(), 'n-1', {'BaselineId': 'new'}, 'scan-2') is None
+
+
+@pytest.fixture
+def fetched(monkeypatch):
+    '''inventory entries returned by SSM, and the instances fetched'''
+    inventory = {'Entries': [{'Name': 'a', 'Version': '1.0'}, {'Name': 'b', 'Version': '1.0'}],
+        'Fetched': []}
+
+    def get_instance_inventory(instance_id, ssm):
+        '''returns the entries instead of calling SSM'''
+        del ssm
+        inventory['Fetched'].append(instance_id)
+        return {'TypeName': compliance.INVENTORY_TYPE, 'InstanceId': instance_id,
+            'Entries': [dict(entry) for entry in inventory['Entries']]}
+
+    monkeypatch.setattr(compliance, 'get_instance_inventory', get_instance_inventory)
+    return inventory
+
+
+def message(scan_id, baselines, scan_type='n-1'):
+    '''instance message with a baseline of every scan type'''
+    return {'AccountId': '100000000000', 'Region': 'us-east-1', 'InstanceId': 'i-0001',
+        'ScanId': scan_id, 'ScanType': scan_type, 'Baselines': {name: dict(baseline,
+        BaselineId=baseline_id(baseline['ComplaintPackages'])) \
+        for name, baseline in baselines.items()}}
+
+
+def cache(store):
+    '''returns the cache entry of the instance'''
+    return store.get(inventory_key('100000000000', 'us-east-1', 'i-0001'))
+
+
+def test_assess_incremental(fetched):
+    '''a moved baseline is re-evaluated on the cached inventory, without SSM calls'''
+    store = MemoryStore()
+    old = {'a': '1.0', 'b': '1.0'}
+    new = {'a': '1.1', 'b': '1.0', 'c': '1.0'}
+
+    finding = compliance.assess_instance(message('scan-1', {'n-1': {'ComplaintPackages': old}}),
+        None, store)
+    assert (finding['EvaluationMode'], finding['CompliancePercentage']) == ('full', 100)
+
+    finding = compliance.assess_instance(message('scan-2', {'n-1': {'ComplaintPackages': new,
+        'PreviousBaselineId': baseline_id(old), 'BaselineDiff': diff_baselines(old, new)}}),
+        None, store)
+    assert (finding['EvaluationMode'], finding['CompliancePercentage']) == ('incremental', 50)
+    assert fetched['Fetched'] == ['i-0001']
+    assert cache(store)['Scores']['n-1'] == \
+        {'BaselineId': baseline_id(new), 'Compliant': 1, 'Total': 2}
+
+
+def test_assess_same_baseline(fetched):
+    '''redeliveries reuse the score, the next scan fetches a patched inventory'''
+    store = MemoryStore()
+    baselines = {'n-1': {'ComplaintPackages': {'a': '1.1', 'b': '1.0'}}}
+    assert compliance.assess_instance(message('scan-1', baselines), None,
+        store)['CompliancePercentage'] == 50
+    assert compliance.assess_instance(message('scan-1', baselines), None,
+        store)['EvaluationMode'] == 'incremental'
+
+    fetched['Entries'][0]['Version'] = '1.1'
+    finding = compliance.assess_instance(message('scan-2', baselines), None, store)
+    assert (finding['EvaluationMode'], finding['CompliancePercentage']) == ('full', 100)
+    assert fetched['Fetched'] == ['i-0001', 'i-0001']
+    assert cache(store)['ScanId'] == 'scan-2'
+
+
+def test_assess_other_scan_types(fetched):
+    '''a message for one scan type keeps the cached scores of the others while the
+    inventory did not change, and drops them when it did'''
+    store = MemoryStore()
+    first = {'n-1': {'ComplaintPackages': {'a': '1.0'}},
+        'n-2': {'ComplaintPackages': {'b': '0.9'}}}
+    compliance.assess_instance(message('scan-1', first), None, store)
+    compliance.assess_instance(message('scan-2', {'n-1': first['n-1']}), None, store)
+    assert set(cache(store)['Scores']) == {'n-1', 'n-2'}
+
+    fetched['Entries'].append({'Name': 'c', 'Version': '1.0'})
+    compliance.assess_instance(message('scan-3', {'n-1': first['n-1']}), None, store)
+    assert set(cache(store)['Scores']) == {'n-1'}
+    assert ('c', '1.0') in decode_pairs(cache(store)['Inventory'])
@@ -0,0 +1,187 @@
+'''
+test_mirror.py
+utils.mirror updating a local index from a mirror directory laid out like
+a Debian archive: <index>.gz, <index>.diff/Index and its pdiffs
+'''
+
+# pytest fixtures are parameters named after them
+# pylint: disable=redefined-outer-name
+
+import os
+import gzip
+import hashlib
+import difflib
+
+import pytest
+
+from utils.mirror import sync_indices, update_index
+
+INDEX = 'dists/jammy-updates/main/binary-amd64/Packages'
+
+
+def version(number, size=40):
+    '''lines of the index at a version: packages are upgraded, added and removed'''
+    lines = []
+    for index in range(size + number * 3):
+        if (index + number) % 7 == 0:
+            continue
+        lines += [f"Package: pkg{index}\n", f"Version: 1.{index}-{number if index % 3 else 0}\n",
+            "\n"]
+    return ''.join(lines).encode('utf8')
+
+
+def ed_script(old, new):
+    '''returns the diff -e script turning old into new, hunks in descending order'''
+    old_lines = old.splitlines(True)
+    new_lines = new.splitlines(True)
+    script = []
+    opcodes = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False).get_opcodes()
+    for tag, first, last, new_first, new_last in reversed(opcodes):
+        address = f"{first + 1},{last}" if last - first > 1 else f"{last}"
+        if tag == 'delete':
+            script.append(f"{address}d\n".encode('utf8'))
+            continue
+        if tag == 'insert':
+            script.append(f"{first}a\n".encode('utf8'))
+        elif tag == 'replace':
+            script.append(f"{address}c\n".encode('utf8'))
+        else:
+            continue
+        script.extend(new_lines[new_first:new_last])
+        script.append(b".\n")
+    return b''.join(script)
+
+
+def sha256(data):
+    '''returns the hex SHA256 of bytes'''
+    return hashlib.sha256(data).hexdigest()
+
+
+class Mirror:
+    '''remote archive directory with the pdiffs between versions of an index'''
+
+    def __init__(self, root, versions):
+        self.root = str(root)
+        self.remote = os.path.join(self.root, INDEX)
+        self.versions = versions
+        os.makedirs(self.remote + '.diff')
+        self.patches = {}
+        history = []
+        for number, (old, new) in enumerate(zip(versions, versions[1:])):
+            name = f"2024-01-0{number + 1}-0000.00"
+            self.patches[name] = ed_script(old, new)
+            with gzip.open(f"{self.remote}.diff/{name}.gz", 'wb') as file:
+                file.write(self.patches[name])
+            history.append((sha256(old), len(old), name))
+        with gzip.open(self.remote + '.gz', 'wb') as file:
+            file.write(versions[-1])
+        self.write_index(sha256(versions[-1]), history)
+
+    def write_index(self, current, history, patch_hashes=None):
+        '''writes the pdiff Index'''
+        patch_hashes = patch_hashes or {name: sha256(patch) \
+            for name, patch in self.patches.items()}
+        lines = [f"SHA256-Current: {current} {len(self.versions[-1])}", "SHA256-History:"]
+        lines += [f" {digest} {size} {name}" for digest, size, name in history]
+        lines += ["SHA256-Patches:"]
+        lines += [f" {patch_hashes[name]} {len(patch)} {name}" \
+            for name, patch in self.patches.items()]
+        with open(self.remote + '.diff/Index', 'w', encoding='utf8') as file:
+            file.write('\n'.join(lines) + '\n')
+        self.history = history
+
+
+@pytest.fixture
+def mirror(tmp_path):
+    '''mirror of 5 versions of the index, 4 pdiffs'''
+    return Mirror(tmp_path / 'remote', [version(number) for number in range(5)])
+
+
+def local_copy(tmp_path, data):
+    '''returns the path of a local index holding data'''
+    path = tmp_path / 'local' / 'Packages'
+    path.parent.mkdir(exist_ok=True)
+    path.write_bytes(data)
+    return str(path)
+
+
+def leftovers(path):
+    '''temporary files left next to path'''
+    return [name for name in os.listdir(os.path.dirname(path)) if name.startswith('.tmp-')]
+
+
+@pytest.mark.parametrize('start', range(4))
+def test_patched(tmp_path, mirror, start):
+    '''every older version in the history is patched to the current one'''
+    local = local_copy(tmp_path, mirror.versions[start])
+    assert update_index(mirror.remote, local, workers=2) == 'patched'
+    with open(local, 'rb') as file:
+        assert file.read() == mirror.versions[-1]
+    assert not leftovers(local)
+
+
+def test_current(tmp_path, mirror):
+    '''an up to date copy is left alone'''
+    local = local_copy(tmp_path, mirror.versions[-1])
+    assert update_index(mirror.remote, local) == 'current'
+
+
+def test_missing_local_downloaded(tmp_path, mirror):
+    '''a missing copy is downloaded'''
+    local = str(tmp_path / 'local' / 'Packages')
+    assert update_index(mirror.remote, local) == 'downloaded'
+    with open(local, 'rb') as file:
+        assert file.read() == mirror.versions[-1]
+
+
+def test_too_old_downloaded(tmp_path, mirror):
+    '''a copy older than the pdiff history is replaced by the full index'''
+    local = local_copy(tmp_path, version(-1))
+    assert update_index(mirror.remote, local) == 'downloaded'
+    with open(local, 'rb') as file:
+        assert file.read() == mirror.versions[-1]
+
+
+def test_no_diff_index_downloaded(tmp_path, mirror):
+    '''mirrors without pdiffs serve the full index'''
+    os.unlink(mirror.remote + '.diff/Index')
+    local = local_copy(tmp_path, mirror.versions[0])
+    assert update_index(mirror.remote, local) == 'downloaded'
+    with open(local, 'rb') as file:
+        assert file.read() == mirror.versions[-1]
+
+
+def test_garbled_patch_rejected(tmp_path, mirror):
+    '''a patch that does not match its SHA256 is not applied'''
+    patch_hashes = {name: sha256(patch) for name, patch in mirror.patches.items()}
+    patch_hashes[mirror.history[1][2]] = sha256(b'garbled')
+    mirror.write_index(sha256(mirror.versions[-1]), mirror.history, patch_hashes)
+    local = local_copy(tmp_path, mirror.versions[0])
+    with pytest.raises(ValueError, match='garbled'):
+        update_index(mirror.remote, local)
+    with open(local, 'rb') as file:
+        assert file.read() == mirror.versions[0]
+
+
+def test_hash_mismatch_keeps_local(tmp_path, mirror):
+    '''a patched result that does not match SHA256-Current never replaces the copy'''
+    mirror.write_index(sha256(b'another index'), mirror.history)
+    local = local_copy(tmp_path, mirror.versions[1])
+    with pytest.raises(ValueError, match='patch failed'):
+        update_index(mirror.remote, local)
+    with open(local, 'rb') as file:
+        assert file.read() == mirror.versions[1]
+    assert not leftovers(local)
+
+
+def test_sync_reports_failures(tmp_path, mirror):
+    '''sync_indices updates every index and reports the ones that failed'''
+    mirror_dir = tmp_path / 'mirror'
+    os.makedirs(mirror_dir / os.path.dirname(INDEX))
+    (mirror_dir / INDEX).write_bytes(mirror.versions[2])
+    missing = INDEX.replace('main', 'universe')
+    assert sync_indices(mirror.root, str(mirror_dir), [INDEX, missing]) == {
+        INDEX: 'patched',
+        missing: 'failed'
+    }
+    assert (mirror_dir / INDEX).read_bytes() == mirror.versions[-1]
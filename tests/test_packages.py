@@ -0,0 +1,157 @@
+'''
+test_packages.py
+MappedPackageFile of debian.debian_support must yield the records of
+PackageFile and raise the same ParseError, with or without field filtering
+'''
+
+import io
+import random
+
+import pytest
+
+from debian.debian_support import MappedPackageFile, PackageFile, ParseError
+
+PACKAGES = b'''Package: adduser
+Architecture: all
+Version: 3.118ubuntu5
+Multi-Arch: foreign
+Priority: important
+Section: admin
+Origin: Ubuntu
+Installed-Size: 624
+Depends: passwd, debconf (>= 0.5) | debconf-2.0
+Filename: pool/main/a/adduser/adduser_3.118ubuntu5_all.deb
+SHA256: 1c0a9bd6ef1e6e0e43b2c9c0c1d6a0d7b8a1b7e5f2e6c4a3b9d8e7f6a5b4c3d2
+Description: add and remove users and groups
+ This package includes the 'adduser' and 'deluser' commands for creating
+ and removing users.
+ .
+ Both commands can be configured.
+
+Package: libc6
+Version: 2.35-0ubuntu3.6
+Source: glibc
+Description: GNU C Library: Shared libraries
+\tContains the standard libraries that are used by nearly all programs on
+\tthe system.
+Description-md5: 5cb8a7e7b3b5f39c5f1cb2cbe8bbd70b
+Breaks:\x20
+X_Custom-Field: kept by the regex
+Task:minimal
+
+Package: python3-caf\xc3\xa9
+Version: 1:3.10.6-1~22.04
+Maintainer: Ren\xc3\xa9e <renee@example.org>\x20\x20
+Description: accents \xc3\xa0 la carte
+  .
+ last line
+'''
+
+MALFORMED = [
+    b'\nPackage: a\n',
+    b'Package: a\n\n\nPackage: b\n',
+    b' continuation first\n',
+    b'Package: a\nno colon here\n',
+    b'Package: a\n1digit: x\n',
+    b'Package: a\nV: single letter\n',
+    b'Package: a\n\n \n',
+    b'Package: a\nVersion: 1\n\t\nPackage: b\n',
+    b'Package: a\n:\n',
+    b'Package: a\r\nVersion: 1\r\n\r\nPackage: b\r\n',
+]
+
+
+def reference(data, fields=None):
+    '''returns the records PackageFile yields before its ParseError, and the error'''
+    records = []
+    error = None
+    try:
+        for record in PackageFile('Packages', io.BytesIO(data)):
+            records.append(record if fields is None else \
+                [field for field in record if field[0] in fields])
+    except ParseError as err:
+        error = (err.filename, err.lineno, err.msg)
+    return records, error
+
+
+def mapped(data, fields=None, path=None):
+    '''returns the records MappedPackageFile yields before its ParseError, and the error'''
+    records = []
+    error = None
+    with MappedPackageFile(path or 'Packages', data=None if path else data) as packages:
+        try:
+            for record in packages.iter_records(fields):
+                records.append(record)
+        except ParseError as err:
+            error = (err.filename, err.lineno, err.msg)
+    return records, error
+
+
+@pytest.mark.parametrize('fields', [None, ('Package', 'Version'), ('Description',),
+    ('X_Custom-Field', 'Task', 'Breaks'), ()])
+def test_fixture(fields):
+    '''records and continuation lines of a Packages file, all or some fields'''
+    expected = reference(PACKAGES, fields)
+    assert expected[1] is None and len(expected[0]) == 3
+    assert mapped(PACKAGES, fields) == expected
+
+
+def test_mapped_file(tmp_path):
+    '''files are memory-mapped'''
+    path = tmp_path / 'Packages'
+    path.write_bytes(PACKAGES)
+    records, error = mapped(None, path=str(path))
+    assert error is None
+    assert records == reference(PACKAGES)[0]
+
+
+def test_package_versions():
+    '''the Package and Version projection'''
+    assert MappedPackageFile('Packages', data=PACKAGES).package_versions() == {
+        'adduser': '3.118ubuntu5',
+        'libc6': '2.35-0ubuntu3.6',
+        'python3-caf\xe9': '1:3.10.6-1~22.04'
+    }
+
+
+@pytest.mark.parametrize('data', MALFORMED)
+@pytest.mark.parametrize('fields', [None, ('Package',)])
+def test_malformed(data, fields):
+    '''errors are raised with the message and line number of PackageFile'''
+    assert mapped(data, fields) == reference(data, fields)
+
+
+FIELDS = [b'Version: 1.0-1\n', b'Depends: libc6 (>= 2.34)\n', b'Task:minimal\n', b'Breaks: \n',
+    b'Field_Name: underscore\n', b'Maintainer: Ren\xc3\xa9e\n', b'Trailing: spaces  \n',
+    b'Name:: colon\n', b'X-a: x\n']
+CONTINUATIONS = [b' long description\n', b'\tindented with a tab\n', b' .\n', b'  .\n']
+# lines breaking records anywhere in a file
+UNUSUAL = [b' \n', b'\t\n', b'\n', b'a: single\n', b'1x: digit\n', b'no colon\n',
+    b'Caf\xc3\xa9: not ascii\n', b'Cr: line\r\n', b'\r\n', b'Package:pkg\n', b'Package: \n',
+    b' continuation\n']
+
+
+def stanza(rand):
+    '''returns the lines of a valid record'''
+    lines = [b'Package: pkg\n'] + rand.sample(FIELDS, rand.randint(0, len(FIELDS)))
+    position = rand.randint(1, len(lines))
+    lines[position:position] = [b'Description: short\n'] + \
+        rand.choices(CONTINUATIONS, k=rand.randint(0, 4))
+    return lines + [b'\n']
+
+
+@pytest.mark.parametrize('seed', range(400))
+def test_random_files(seed):
+    '''random files of valid records and unusual lines parse the same'''
+    rand = random.Random(seed)
+    lines = []
+    for _ in range(rand.randint(1, 30)):
+        if rand.random() < 0.95:
+            lines.extend(stanza(rand))
+        else:
+            lines.insert(rand.randint(0, len(lines)), rand.choice(UNUSUAL))
+    data = b''.join(lines)
+    if rand.random() < 0.2:
+        data = data.rstrip(b'\n')
+    for fields in (None, ('Package', 'Version'), ('Description', 'Task')):
+        assert mapped(data, fields) == reference(data, fields)
@@ -0,0 +1,134 @@
+'''
+test_pdiff.py
+compose_patches and iter_patched_lines of debian.debian_support must give
+the exact output of applying every ed-script patch in turn with patch_lines
+'''
+
+import random
+
+import pytest
+
+from debian.debian_support import (compose_patches, iter_patched_lines, patch_lines,
+    patches_from_ed_script)
+
+
+class Chain:
+    '''random ed scripts applied to a model of the file'''
+
+    def __init__(self, seed):
+        self.rand = random.Random(seed)
+        self.counter = 0
+        self.lines = self.new_lines(self.rand.randint(0, 40))
+
+    def new_lines(self, count):
+        '''returns count lines never seen before'''
+        lines = []
+        for _ in range(count):
+            self.counter += 1
+            lines.append(f"line {self.counter}\n")
+        return lines
+
+    def address(self, line):
+        '''returns the ed address of a line, "$" for the last one half of the time'''
+        if line == len(self.lines) and self.rand.random() < 0.5:
+            return '$'
+        return str(line)
+
+    def near_end(self, bound):
+        '''returns a line number up to bound, often the last line'''
+        if bound == len(self.lines) and self.rand.random() < 0.3:
+            return bound
+        return self.rand.randint(1, bound)
+
+    def hunk(self, bound):
+        '''returns the command lines of one hunk addressing lines up to bound, applied
+        to the model, and the bound left to the next hunk of a diff -e script'''
+        if (kind := self.rand.choice('acdce' if bound else 'a')) == 'a':
+            line = self.near_end(bound) if bound and self.rand.random() < 0.9 else 0
+            added = self.new_lines(self.rand.choice([0, 1, 1, 2, 5]))
+            script = [f"{self.address(line)}a\n"] + added + [".\n"]
+            self.lines[line:line] = added
+            return script, line
+        last = self.near_end(bound)
+        first = max(1, last - self.rand.choice([0, 0, 1, 3, 10]))
+        address = self.address(last) if first == last else \
+            f"{self.address(first)},{self.address(last)}"
+        if kind == 'd':
+            script = [f"{address}d\n"]
+            self.lines[first - 1:last] = []
+        else:
+            # "e" is an empty change, deleting the lines
+            added = [] if kind == 'e' else self.new_lines(self.rand.randint(1, 4))
+            script = [f"{address}c\n"] + added + [".\n"]
+            self.lines[first - 1:last] = added
+        return script, first - 1
+
+    def patch(self):
+        '''returns a random ed script: descending hunks as written by diff -e, or
+        hunks in any order, sometimes none'''
+        script = []
+        descending = self.rand.random() < 0.7
+        bound = len(self.lines)
+        for _ in range(self.rand.choice([0, 1, 2, 5, 10])):
+            hunk, lowest = self.hunk(bound)
+            script.extend(hunk)
+            bound = lowest if descending else len(self.lines)
+        return script
+
+
+@pytest.mark.parametrize('seed', range(300))
+def test_compose_is_sequential(seed):
+    '''long chains of patches compose to the sequential result'''
+    chain = Chain(seed)
+    original = list(chain.lines)
+    patches = []
+    sequential = list(original)
+    for _ in range(chain.rand.randint(1, 30)):
+        script = chain.patch()
+        patches.append(script)
+        patch_lines(sequential, patches_from_ed_script(script))
+        assert sequential == chain.lines
+
+    edits = compose_patches([patches_from_ed_script(script) for script in patches],
+        len(original))
+    assert list(iter_patched_lines(iter(original), edits)) == sequential
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_compose_bytes(seed):
+    '''pdiffs are read as bytes'''
+    chain = Chain(seed)
+    original = [line.encode('utf8') for line in chain.lines]
+    patches = [[line.encode('utf8') for line in chain.patch()] for _ in range(10)]
+    sequential = list(original)
+    for script in patches:
+        patch_lines(sequential, patches_from_ed_script(script))
+    edits = compose_patches([patches_from_ed_script(script) for script in patches],
+        len(original))
+    assert b''.join(iter_patched_lines(iter(original), edits)) == b''.join(sequential)
+
+
+@pytest.mark.parametrize('script, expected', [
+    (['$d\n'], ['a\n', 'b\n']),
+    (['$a\n', 'd\n', '.\n'], ['a\n', 'b\n', 'c\n', 'd\n']),
+    (['2,$d\n'], ['a\n']),
+    (['$c\n', 'd\n', '.\n'], ['a\n', 'b\n', 'd\n']),
+    (['$,$c\n', '.\n'], ['a\n', 'b\n']),
+    (['0a\n', 'd\n', '.\n'], ['d\n', 'a\n', 'b\n', 'c\n']),
+    (['3a\n', '.\n'], ['a\n', 'b\n', 'c\n']),
+    (['3d\n', '1c\n', '.\n'], ['b\n']),
+])
+def test_ed_addresses(script, expected):
+    '''known answers of the addresses and empty hunks'''
+    lines = ['a\n', 'b\n', 'c\n']
+    patch_lines(lines, patches_from_ed_script(script))
+    assert lines == expected
+    edits = compose_patches([patches_from_ed_script(script)], 3)
+    assert list(iter_patched_lines(['a\n', 'b\n', 'c\n'], edits)) == expected
+
+
+@pytest.mark.parametrize('script', [['x\n'], ['1,2a\n', '.\n'], ['$$d\n'], ['$,1x\n']])
+def test_invalid_scripts(script):
+    '''unknown commands and addresses, and ranges appended to are rejected'''
+    with pytest.raises(ValueError):
+        list(patches_from_ed_script(script))
@@ -0,0 +1,146 @@
+'''
+test_sampling.py
+Sample sizes, stratified draws and the estimates of utils.sampling on
+known answers
+'''
+
+import math
+
+import pytest
+
+from utils.sampling import Rollup, draw, sample_size, z_score
+
+
+def instance(instance_id, platform=('Ubuntu', '22.04')):
+    '''instance listed by list_instances'''
+    return {'InstanceId': instance_id, 'PlatformName': platform[0],
+        'PlatformVersion': platform[1]}
+
+
+def finding(instance_id, score, population=None, *, account='a1', region='r1',
+        platform='22.04'):
+    '''findings record of a validated instance'''
+    record = {'AccountId': account, 'Region': region, 'PlatformName': 'Ubuntu',
+        'PlatformVersion': platform, 'InstanceId': instance_id, 'CompliancePercentage': score}
+    if population is not None:
+        record['Sample'] = {'Population': population, 'Size': 0}
+    return record
+
+
+@pytest.mark.parametrize('population, sampling, size', [
+    (100, {'Size': 30}, 30),
+    (20, {'Size': 30}, 20),
+    (5, {'Size': 1}, 2),
+    (1, {'Size': 1}, 1),
+    (1, {'Size': 30}, 1),
+    # Cochran's 384.15 for a 5 points margin at 95%, then the population correction
+    (100000, {'MarginOfError': 5}, 383),
+    (1000, {'MarginOfError': 5}, 278),
+    (50, {'MarginOfError': 5}, 45),
+    (1000, {'MarginOfError': 5, 'Confidence': 0.99}, 400),
+])
+def test_sample_size(population, sampling, size):
+    '''sample sizes of given sizes and margins of error'''
+    assert sample_size(population, sampling) == size
+
+
+def test_z_score():
+    '''two-sided quantiles of usual confidence levels'''
+    assert z_score(0.95) == pytest.approx(1.959964, abs=1e-6)
+    assert z_score(0.99) == pytest.approx(2.575829, abs=1e-6)
+
+
+def test_draw_repeatable():
+    '''the same seed draws the same sample, strata are sampled separately'''
+    instances = [instance(f"i-{index:04}") for index in range(50)] + \
+        [instance(f"i-{index:04}", ('Ubuntu', '20.04')) for index in range(50, 60)]
+    first, samples = draw(instances, {'Size': 5}, 'scan#a1#r1')
+    assert draw(instances, {'Size': 5}, 'scan#a1#r1') == (first, samples)
+    assert samples == {('Ubuntu', '20.04'): {'Population': 10, 'Size': 5},
+        ('Ubuntu', '22.04'): {'Population': 50, 'Size': 5}}
+    assert sum(item['PlatformVersion'] == '20.04' for item in first) == 5
+    assert len({item['InstanceId'] for item in first}) == 10
+    assert draw(instances, {'Size': 5}, 'scan#a1#r2')[0] != first
+
+
+def test_draw_census():
+    '''strata no larger than the sample size are validated entirely'''
+    instances = [instance(f"i-{index}") for index in range(4)]
+    sampled, samples = draw(instances, {'Size': 30}, 'seed')
+    assert sorted(item['InstanceId'] for item in sampled) == ['i-0', 'i-1', 'i-2', 'i-3']
+    assert samples == {('Ubuntu', '22.04'): {'Population': 4, 'Size': 4}}
+
+
+def test_census_has_no_interval():
+    '''findings without Sample are a census, their mean is exact'''
+    rollup = Rollup()
+    for index, score in enumerate([50, 70, 90]):
+        rollup.add(finding(f"i-{index}", score))
+    assert rollup.estimates()[('fleet',)] == {'Estimate': 70.0, 'Low': 70.0, 'High': 70.0,
+        'Population': 3, 'Sampled': 3, 'Unbounded': False}
+
+
+def test_population_correction():
+    '''known answer: 2 scores out of 10 instances'''
+    rollup = Rollup()
+    rollup.add(finding('i-1', 60, 10))
+    rollup.add(finding('i-2', 80, 10))
+    # sample variance 200, corrected by 1 - 2/10 and divided by 2
+    margin = z_score(0.95) * math.sqrt(0.8 * 200 / 2)
+    estimate = rollup.estimates()[('fleet',)]
+    assert estimate['Estimate'] == 70.0
+    assert estimate['Low'] == round(70 - margin, 2) == 52.47
+    assert estimate['High'] == round(70 + margin, 2)
+    assert not estimate['Unbounded']
+
+
+def test_redeliveries_count_once():
+    '''duplicate findings of an instance do not weigh twice'''
+    rollup = Rollup()
+    rollup.add(finding('i-1', 60, 10))
+    rollup.add(finding('i-2', 80, 10))
+    rollup.add(finding('i-2', 80, 10))
+    assert rollup.estimates()[('fleet',)]['Sampled'] == 2
+    assert rollup.estimates()[('fleet',)]['Estimate'] == 70.0
+
+
+def test_strata_weighted():
+    '''the fleet estimate weighs every stratum by its population'''
+    rollup = Rollup()
+    rollup.add(finding('i-1', 100, 30, platform='22.04'))
+    rollup.add(finding('i-2', 100, 30, platform='22.04'))
+    rollup.add(finding('i-3', 0, 10, platform='20.04'))
+    rollup.add(finding('i-4', 0, 10, platform='20.04'))
+    assert rollup.estimates()[('fleet',)]['Estimate'] == 75.0
+    assert rollup.estimates()[('fleet',)]['Population'] == 40
+
+
+def test_groupings():
+    '''estimates are keyed by the fields of their grouping'''
+    rollup = Rollup()
+    rollup.add(finding('i-1', 100, account='a1', region='r1'))
+    rollup.add(finding('i-2', 50, account='a1', region='r2', platform='20.04'))
+    rollup.add(finding('i-3', 0, account='a2', region='r1'))
+    assert {group: estimate['Estimate'] for group, estimate in
+        rollup.estimates('account').items()} == {('a1',): 75.0, ('a2',): 0.0}
+    assert set(rollup.estimates('region')) == {('r1',), ('r2',)}
+    assert set(rollup.estimates('platform')) == {('Ubuntu', '20.04'), ('Ubuntu', '22.04')}
+    assert set(rollup.estimates('account-region')) == {('a1', 'r1'), ('a1', 'r2'),
+        ('a2', 'r1')}
+
+
+def test_single_score_unbounded():
+    '''a stratum with one score out of several instances is not a tight interval'''
+    rollup = Rollup()
+    rollup.add(finding('i-1', 80, 10))
+    estimate = rollup.estimates()[('fleet',)]
+    assert estimate['Unbounded']
+    assert (estimate['Low'], estimate['High']) == (0.0, 100.0)
+
+
+def test_other_scores():
+    '''scores of other baselines are estimated from Scores'''
+    rollup = Rollup('n-2')
+    rollup.add(dict(finding('i-1', 80), Scores={'n-2': 40}))
+    rollup.add(finding('i-2', 80))
+    assert rollup.estimates()[('fleet',)]['Estimate'] == 40.0
@@ -0,0 +1,85 @@
+'''
+test_wire.py
+Round trips of package maps and inventories through the compact wire
+format of utils.wire
+'''
+
+import pytest
+
+from utils.wire import (COMPRESSED_PREFIX, decode_packages, decode_pairs, encode_inventory,
+    encode_packages, encode_pairs)
+
+PACKAGES = {
+    'adduser': '3.118ubuntu5',
+    'apt': '2.4.11',
+    'bash': '5.1-6ubuntu1.1',
+    'libc6': '2.35-0ubuntu3.6',
+    'libc6-dev': '2.35-0ubuntu3.6',
+    'openssl': '3.0.2-0ubuntu1.15',
+    'python3': '3.10.6-1~22.04',
+    # epochs and tildes
+    'libpam0g': '1:1.4.0-11ubuntu2.4',
+    'vim': '2:8.2.3995-1ubuntu2.15',
+    'linux-image': '5.15.0~rc1+really5.14-1',
+    'curl': '7.81.0-1ubuntu1.15~esm1',
+    # unversioned entries
+    'meta': '',
+}
+
+
+@pytest.mark.parametrize('compress', [True, False])
+def test_packages_round_trip(compress):
+    '''package maps come back as they were sent'''
+    encoded = encode_packages(PACKAGES, compress)
+    assert isinstance(encoded, str) == compress
+    assert decode_packages(encoded) == PACKAGES
+
+
+@pytest.mark.parametrize('compress', [True, False])
+def test_empty_map(compress):
+    '''empty maps and inventories are kept empty'''
+    assert not decode_packages(encode_packages({}, compress))
+    assert not decode_pairs(encode_pairs([], compress))
+    assert not decode_pairs(encode_inventory([]))
+
+
+def test_single_package():
+    '''a map of one package has no shared prefix to encode'''
+    assert decode_packages(encode_packages({'zlib1g': '1:1.2.11.dfsg-2ubuntu9.2'})) == \
+        {'zlib1g': '1:1.2.11.dfsg-2ubuntu9.2'}
+
+
+def test_inventory_round_trip():
+    '''inventories keep every pair, in name order'''
+    pairs = list(PACKAGES.items())
+    assert decode_pairs(encode_inventory(pairs)) == sorted(pairs)
+
+
+def test_duplicate_names():
+    '''inventories of instances with several versions of a package keep them all'''
+    pairs = [('linux-image', '5.15.0-91.101'), ('linux-image', '5.15.0-89.99'),
+        ('linux-image', '5.15.0-91.101'), ('apt', '2.4.11')]
+    assert decode_pairs(encode_inventory(pairs)) == sorted(pairs)
+
+
+def test_plain_maps_accepted():
+    '''messages of releases without the wire format are still decoded'''
+    assert decode_packages(PACKAGES) == PACKAGES
+    assert decode_pairs(PACKAGES) == list(PACKAGES.items())
+    assert decode_pairs([['apt', '2.4.11']]) == [('apt', '2.4.11')]
+
+
+def test_unknown_version_rejected():
+    '''package maps of another wire version are rejected'''
+    encoded = encode_packages(PACKAGES, compress=False)
+    encoded['_pkgs'] += 1
+    with pytest.raises(ValueError, match='unsupported package map version'):
+        decode_packages(encoded)
+
+
+def test_unknown_prefix_rejected():
+    '''compressed maps with another prefix are rejected'''
+    encoded = encode_packages(PACKAGES)
+    assert encoded.startswith(COMPRESSED_PREFIX)
+    with pytest.raises(ValueError, match='unknown package map encoding'):
+        decode_packages('pkgz9:' + encoded[len(COMPRESSED_PREFIX):])